@@ -0,0 +1,89 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark of how long instances take to boot, broken down by boot phase.
+
+Each iteration boots an instance, up to the point where it can be reached
+by ssh, and then deletes it. The latency of each phase of the boot, from
+creating the keypair to connecting with ssh, is reported separately, so a
+slow boot can be put down to the scheduler (run_instances and pending),
+the hypervisor and guest (ssh_ready) or networking (public_ip).
+"""
+import optparse
+import threading
+from nova_volume_testing.util.novaexerciser import Instance
+from common import OperationTimer, add_common_options, report, \
+                   run_concurrently
+
+
+# The boot phases recorded by Instance, in the order they happen
+PHASES = ['keypair', 'image', 'run_instances', 'pending', 'public_ip',
+          'ssh_ready', 'ssh_failed', 'console', 'ssh_connect', 'total',
+          'delete']
+
+
+class BootBenchmark(object):
+    """
+    Boots instances and collects the timings of their boot phases.
+    """
+    def __init__(self):
+        self.timer = OperationTimer()
+        self._lock = threading.Lock()
+        # The boot phases of each instance, with their start and end times
+        self.timelines = []
+
+    def _iteration(self, i):
+        instance = self.timer.time('total', Instance)
+        try:
+            for phase, start, end in instance.boot_phases:
+                self.timer.record(phase, end - start, start)
+            with self._lock:
+                self.timelines.append({
+                    'instance': instance.id,
+                    'phases': [{'phase': phase, 'start': start, 'end': end}
+                               for phase, start, end in
+                               instance.boot_phases]})
+        finally:
+            self.timer.time('delete', instance.delete)
+
+    def run(self, iterations, concurrency):
+        """
+        Boot iterations instances, up to concurrency at a time, and return
+        the results for each phase.
+        """
+        failed = run_concurrently(self._iteration, iterations, concurrency)
+        if failed:
+            print "%d of %d boots failed" % (failed, iterations)
+        return self.timer.results()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog boot [options]")
+    add_common_options(parser)
+    options, args = parser.parse_args(argv)
+
+    benchmark = BootBenchmark()
+    results = benchmark.run(options.iterations, options.concurrency)
+    report('boot', {'iterations': options.iterations,
+                    'concurrency': options.concurrency},
+           results, options.output, title="phase", order=PHASES,
+           timelines=benchmark.timelines)
+    for summary in results.values():
+        if summary['errors']:
+            return 1
+    return 0
@@ -0,0 +1,168 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Timing and reporting shared by the benchmarks.
+"""
+import json
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+from nova_volume_testing.util.latency import LatencyRecorder, format_table, \
+                                             ordered_names
+
+
+class OperationTimer(object):
+    """
+    Times the operations a benchmark performs, keeping the latency of each
+    one and the span of time over which each kind of operation ran, from
+    which its throughput is worked out.
+    """
+    def __init__(self):
+        self.latencies = LatencyRecorder()
+        self._lock = threading.Lock()
+        # Operation name to [first start, last end]
+        self._spans = {}
+        self.errors = {}
+
+    def time(self, operation, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), recording how long it took as a sample
+        of operation, and return what it returns. Failures are counted and
+        re-raised.
+        """
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+            raise
+        end = time.time()
+        self.latencies.record(operation, end - start)
+        with self._lock:
+            span = self._spans.setdefault(operation, [start, end])
+            span[0] = min(span[0], start)
+            span[1] = max(span[1], end)
+        return result
+
+    def record(self, operation, seconds, start=None):
+        """
+        Record a latency that was measured some other way, for an operation
+        that started at start.
+        """
+        self.latencies.record(operation, seconds)
+        if start != None:
+            with self._lock:
+                span = self._spans.setdefault(operation,
+                                              [start, start + seconds])
+                span[0] = min(span[0], start)
+                span[1] = max(span[1], start + seconds)
+
+    def results(self):
+        """
+        Return a dictionary mapping each operation to its latency summary,
+        with the number of failures and the throughput in operations per
+        minute added.
+        """
+        results = self.latencies.summary()
+        for operation, summary in results.items():
+            summary['errors'] = self.errors.get(operation, 0)
+            span = self._spans.get(operation)
+            if span != None:
+                summary['per_minute'] = \
+                        summary['count'] * 60 / max(span[1] - span[0], 1e-6)
+        for operation, count in self.errors.items():
+            if operation not in results:
+                results[operation] = {'count': 0, 'errors': count}
+        return results
+
+
+def run_concurrently(func, count, concurrency):
+    """
+    Call func(i) for i in range(count), with up to concurrency calls running
+    at once. Calls that fail are reported and counted, and do not stop the
+    others. Returns the number of failed calls.
+    """
+    def call(i):
+        try:
+            func(i)
+            return 0
+        except Exception:
+            print "Iteration %d failed: %s" % (i, traceback.format_exc())
+            return 1
+
+    pool = ThreadPool(max(1, min(concurrency, count)))
+    try:
+        # A timeout makes the wait interruptible
+        return sum(pool.map_async(call, range(count)).get(sys.maxint))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def format_results(results, title="operation", order=None):
+    """
+    Format a benchmark's results as a table of latencies followed by the
+    throughput and failures of each operation. The operations in order are
+    listed first, in that order.
+    """
+    summaries = dict((op, s) for op, s in results.items() if s['count'])
+    width = max([len(title)] + [len(op) for op in results])
+    lines = [format_table(summaries, title, order=order), ""]
+    lines.append("%-*s %12s %8s" % (width, title, 'per minute', 'errors'))
+    for operation in ordered_names(results, order):
+        summary = results[operation]
+        lines.append("%-*s %12.2f %8d" % (width, operation,
+                                          summary.get('per_minute', 0),
+                                          summary['errors']))
+    return "\n".join(lines)
+
+
+def add_common_options(parser, iterations=10, concurrency=4):
+    """
+    Add the options every benchmark takes to an optparse parser.
+    """
+    parser.add_option('-n', '--iterations', type='int', default=iterations,
+                      help="Number of times to run through the operations")
+    parser.add_option('-c', '--concurrency', type='int', default=concurrency,
+                      help="Number of iterations to run at the same time")
+    parser.add_option('-o', '--output',
+                      help="Write the results to this file as JSON")
+
+
+def report(name, parameters, results, output=None, title="operation",
+           order=None, **details):
+    """
+    Print a benchmark's results and, if output is given, save them there as
+    JSON along with the parameters the benchmark was run with and any other
+    details given as keyword arguments.
+    """
+    print
+    print "%s results (%s):" % (name, ", ".join(
+                    "%s=%s" % item for item in sorted(parameters.items())))
+    print format_results(results, title, order)
+    if output:
+        with open(output, 'w') as fd:
+            json.dump(dict(details,
+                           benchmark=name,
+                           time=time.time(),
+                           parameters=parameters,
+                           results=results), fd, indent=1, sort_keys=True)
+        print "Results written to %s" % output
@@ -0,0 +1,53 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Entry point for the nova-volume-bench command, which runs one of the
+benchmarks by name.
+"""
+import sys
+import boot
+import snapshot_chain
+import soak
+import volume_ops
+
+
+BENCHMARKS = {
+    'boot': boot.main,
+    'snapshot-chain': snapshot_chain.main,
+    'soak': soak.main,
+    'volume-ops': volume_ops.main,
+}
+
+
+def usage():
+    print "usage: nova-volume-bench BENCHMARK [options]"
+    print
+    print "Benchmarks:"
+    for name in sorted(BENCHMARKS):
+        print "    %s" % name
+    print
+    print "Run nova-volume-bench BENCHMARK --help for a benchmark's options."
+
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in BENCHMARKS:
+        usage()
+        return 2
+    return BENCHMARKS[argv[0]](argv[1:])
@@ -0,0 +1,246 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark of how volume performance changes as a chain of snapshots and
+clones grows deeper.
+
+A base volume has a pattern written to it, then is snapshotted and cloned,
+the clone is written and snapshotted and cloned in turn, and so on until
+the chain is as deep as asked for. Each new leaf is benchmarked before it is
+written, so that its reads go through every level of the chain beneath it:
+its sequential read throughput, and the rate and latency of its random 4KB
+reads and writes, all bypassing the guest's page cache. After each level
+every volume in the chain is checked to still hold its own pattern, since
+writing a clone must not change what it was cloned from.
+
+Volumes are spread over the instances, as each can only have so many
+attached at once.
+"""
+import optparse
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from nova_volume_testing.guest.agent import BLOCK_SIZE
+from nova_volume_testing.util.instance_pool import get_instance, \
+                                                   release_instance
+from nova_volume_testing.util.novaexerciser import Volume, Snapshot
+from nova_volume_testing.util.volume_pool import get_volume, release_volume
+from common import OperationTimer, report
+from volume_ops import wait_until_gone
+
+
+class SnapshotChain(object):
+    """
+    Builds a chain of snapshots and clones, benchmarking each level.
+    """
+    def __init__(self, depth, size=1, percentage=10, instances=1,
+                 read_length=0, count=1000):
+        self.depth = depth
+        self.size = size
+        self.percentage = percentage
+        self.instance_count = instances
+        self.read_length = read_length
+        self.count = count
+        self.timer = OperationTimer()
+        self.instances = []
+        # The volume at each depth, the base volume first
+        self.volumes = []
+        self.snapshots = []
+        # The measurements of each level
+        self.levels = []
+
+    def _benchmark(self, level, volume, mode, **kwargs):
+        start = time.time()
+        # The page cache is bypassed, or reads after the first would come
+        # from memory rather than from the chain
+        result = volume.benchmark(mode, direct=True, **kwargs)
+        self.timer.record(mode, result['seconds'], start)
+        for name in ('mb_per_sec', 'iops', 'p50', 'p99'):
+            if name in result:
+                level['%s_%s' % (mode, name)] = result[name]
+
+    def _verify(self):
+        """
+        Check every volume in the chain still holds its own pattern.
+        Returns the depths that do not.
+        """
+        by_instance = {}
+        for depth, volume in enumerate(self.volumes):
+            by_instance.setdefault(volume.instance, []).append(
+                    (depth, (volume, depth, self.percentage, True)))
+        failed = []
+        for instance, checks in by_instance.items():
+            results = instance.check_test_patterns([c for d, c in checks])
+            failed.extend(d for (d, c), ok in zip(checks, results) if not ok)
+        return sorted(failed)
+
+    def _add_level(self, depth):
+        """
+        Snapshot and clone the current leaf, making the next level.
+        """
+        timed = self.timer.time
+        level = {'depth': depth}
+        leaf = self.volumes[-1]
+        instance = leaf.instance
+        timed('volume.detach', leaf.detach)
+        start = time.time()
+        snapshot = timed('snapshot.create', Snapshot, leaf)
+        self.snapshots.append(snapshot)
+        level['snapshot_seconds'] = time.time() - start
+        start = time.time()
+        clone = timed('volume.clone', Volume, snapshot=snapshot)
+        self.volumes.append(clone)
+        level['clone_seconds'] = time.time() - start
+        timed('volume.attach', leaf.attach, instance)
+        timed('volume.attach', clone.attach,
+              self.instances[depth % len(self.instances)])
+        return level, clone
+
+    def _run_level(self, depth):
+        if depth == 0:
+            level = {'depth': 0, 'inherited': True}
+            volume = self.timer.time('volume.create', get_volume, self.size)
+            self.volumes.append(volume)
+            self.timer.time('volume.attach', volume.attach,
+                            self.instances[0])
+        else:
+            level, volume = self._add_level(depth)
+        # Reads are measured before anything is written, so that on a clone
+        # they go down through the chain
+        self._benchmark(level, volume, 'seqread', length=self.read_length)
+        self._benchmark(level, volume, 'randread', count=self.count,
+                        block_size=BLOCK_SIZE)
+        if depth:
+            level['inherited'] = volume.check_test_pattern(
+                    percentage=self.percentage, key=depth - 1)
+        self._benchmark(level, volume, 'randwrite', count=self.count,
+                        block_size=BLOCK_SIZE)
+        # The random writes have spoilt the pattern inherited from the level
+        # below, so the level gets one of its own
+        self.timer.time('volume.write', volume.write_test_pattern,
+                        percentage=self.percentage, key=depth)
+        failed = self._verify()
+        level['failed'] = failed
+        level['verified'] = level['inherited'] and not failed
+        self.levels.append(level)
+        if not level['verified']:
+            print "Depth %d: inherited pattern %s, levels %s corrupted" % \
+                    (depth, "intact" if level['inherited'] else "corrupted",
+                     ", ".join(str(d) for d in failed) or "none")
+
+    def _cleanup(self):
+        # Each clone goes before the snapshot it came from, and each
+        # snapshot before the volume it was taken of
+        resources = []
+        for volume, snapshot in zip(self.volumes[1:], self.snapshots):
+            resources.extend([snapshot, volume])
+        for resource in reversed(resources):
+            try:
+                resource.delete()
+                wait_until_gone(resource.kind, resource.id)
+            except Exception as e:
+                print "Failed to delete %s %s: %s" % \
+                        (resource.kind, resource.id, e)
+        if self.volumes:
+            release_volume(self.volumes[0])
+        for instance in self.instances:
+            release_instance(instance)
+
+    def run(self):
+        """
+        Build and benchmark the chain, then delete it. Returns the results
+        for each operation; the measurements of each level are left in
+        levels.
+        """
+        pool = ThreadPool(self.instance_count)
+        try:
+            self.instances = pool.map_async(
+                    lambda i: get_instance(),
+                    range(self.instance_count)).get(sys.maxint)
+        finally:
+            pool.close()
+        try:
+            for depth in xrange(self.depth + 1):
+                self._run_level(depth)
+        finally:
+            self._cleanup()
+        return self.timer.results()
+
+    def format_levels(self):
+        """
+        Format the measurements of each level as a table of depth against
+        performance.
+        """
+        lines = ["%5s %9s %9s %9s %9s %9s %9s %9s %9s" %
+                 ('depth', 'snapshot', 'clone', 'seq MB/s', '4k iops',
+                  'rd p50', 'wr p50', 'wr p99', 'verified')]
+        for level in self.levels:
+            lines.append("%5d %9s %9s %9.1f %9.0f %7.2fms %7.2fms %7.2fms "
+                         "%9s" %
+                         (level['depth'],
+                          '%.2fs' % level['snapshot_seconds']
+                                if 'snapshot_seconds' in level else '-',
+                          '%.2fs' % level['clone_seconds']
+                                if 'clone_seconds' in level else '-',
+                          level['seqread_mb_per_sec'],
+                          level['randread_iops'],
+                          level['randread_p50'] * 1000,
+                          level['randwrite_p50'] * 1000,
+                          level['randwrite_p99'] * 1000,
+                          'yes' if level['verified'] else 'NO'))
+        return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog snapshot-chain [options]")
+    parser.add_option('-d', '--depth', type='int', default=8,
+                      help="Number of snapshot and clone levels to build on "
+                           "the base volume")
+    parser.add_option('-i', '--instances', type='int', default=1,
+                      help="Number of instances to spread the volumes over")
+    parser.add_option('-s', '--size', type='int', default=1,
+                      help="Size of the volumes to create, in GB")
+    parser.add_option('-p', '--percentage', type='int', default=10,
+                      help="Percentage of each volume to write a pattern to")
+    parser.add_option('-l', '--read-length', type='int', default=0,
+                      help="Megabytes to read sequentially from each level, "
+                           "0 for the whole volume")
+    parser.add_option('-b', '--blocks', type='int', default=1000,
+                      help="Number of random 4KB blocks to read and to "
+                           "write on each level")
+    parser.add_option('-o', '--output',
+                      help="Write the results to this file as JSON")
+    options, args = parser.parse_args(argv)
+
+    chain = SnapshotChain(options.depth, options.size, options.percentage,
+                          options.instances, options.read_length * 1024 * 1024,
+                          options.blocks)
+    results = chain.run()
+    report('snapshot-chain', {'depth': options.depth,
+                              'instances': options.instances,
+                              'size': options.size,
+                              'percentage': options.percentage,
+                              'read_length': options.read_length,
+                              'blocks': options.blocks},
+           results, options.output, levels=chain.levels)
+    print
+    print chain.format_levels()
+    if len(chain.levels) < options.depth + 1 or \
+            not all(level['verified'] for level in chain.levels):
+        return 1
+    return 0
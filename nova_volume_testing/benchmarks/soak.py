@@ -0,0 +1,335 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Soak test: keep volumes and snapshots churning for hours, to find leaks and
+slowdowns that only show up under sustained load.
+
+A number of workers each repeatedly run a volume lifecycle against one of a
+pool of instances: create a volume, attach it, write a test pattern to it
+and detach it, then take snapshots of it, each of which is cloned to a new
+volume that is attached, verified and detached, and finally delete the
+clones, snapshots and volume. The number of workers is the number of
+volumes kept in flight, and each holds up to --snapshots snapshots.
+
+API calls can be rate limited per operation with --rates. Every --window
+seconds the throughput, failures and latencies of each operation over that
+window are printed, along with how far its median latency has drifted from
+the first window it was seen in.
+"""
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+from nova_volume_testing.util.latency import ordered_names, percentile
+from nova_volume_testing.util.novaexerciser import ATTACH_DEVICES, Instance, \
+                                                   Volume, Snapshot
+from common import OperationTimer, add_common_options, report
+from volume_ops import wait_until_gone
+
+
+# The operations of a lifecycle, in the order they happen
+OPERATIONS = ['volume.create', 'volume.attach', 'volume.write',
+              'volume.detach', 'snapshot.create', 'volume.clone',
+              'volume.verify', 'volume.delete', 'snapshot.delete',
+              'lifecycle']
+
+
+class VerifyError(Exception):
+    """
+    A clone did not hold the test pattern written to its source volume.
+    """
+    pass
+
+
+class WindowStats(object):
+    """
+    The latencies and failures of each operation, in successive windows of
+    time.
+    """
+    def __init__(self, length):
+        self.length = length
+        self.start = time.time()
+        self._lock = threading.Lock()
+        # For each window, each operation's latencies and failure count
+        self.windows = []
+
+    def _window(self, index):
+        while len(self.windows) <= index:
+            self.windows.append({'latencies': {}, 'errors': {}})
+        return self.windows[index]
+
+    def record(self, operation, seconds=None):
+        """
+        Record an operation that took seconds, or that failed if seconds is
+        None, counting it in the window it finished in.
+        """
+        with self._lock:
+            window = self._window(int((time.time() - self.start) //
+                                      self.length))
+            if seconds == None:
+                window['errors'][operation] = \
+                        window['errors'].get(operation, 0) + 1
+            else:
+                window['latencies'].setdefault(operation,
+                                               []).append(seconds)
+
+    def summary(self, index):
+        """
+        Summarise a window: for each operation the number that completed
+        and failed, the throughput, the median and 90th percentile latency,
+        and the change in median latency, as a percentage, since the first
+        window the operation completed in.
+        """
+        with self._lock:
+            windows = [dict((op, list(values)) for op, values in
+                            w['latencies'].items()) for w in
+                       self.windows[:index + 1]]
+            errors = dict(self._window(index)['errors'])
+        latencies = windows[index] if index < len(windows) else {}
+
+        summary = {}
+        for operation in set(latencies) | set(errors):
+            values = latencies.get(operation, [])
+            entry = {'count': len(values),
+                     'errors': errors.get(operation, 0),
+                     'per_minute': len(values) * 60.0 / self.length}
+            if values:
+                entry['p50'] = percentile(values, 50)
+                entry['p90'] = percentile(values, 90)
+                baseline = [percentile(w[operation], 50) for w in windows
+                            if w.get(operation)][0]
+                if baseline > 0:
+                    entry['drift'] = (entry['p50'] / baseline - 1) * 100
+            summary[operation] = entry
+        return summary
+
+    def format(self, index):
+        """
+        Format the summary of a window as a table.
+        """
+        summary = self.summary(index)
+        width = max([len('operation')] + [len(op) for op in summary])
+        lines = ["Window %d (%ds-%ds):" % (index + 1, index * self.length,
+                                          (index + 1) * self.length),
+                 "%-*s %6s %6s %10s %9s %9s %8s" %
+                 (width, 'operation', 'count', 'errors', 'per minute',
+                  'p50', 'p90', 'drift')]
+        for operation in ordered_names(summary, OPERATIONS):
+            s = summary[operation]
+            lines.append("%-*s %6d %6d %10.1f %9s %9s %8s" %
+                         (width, operation, s['count'], s['errors'],
+                          s['per_minute'],
+                          '%.2fs' % s['p50'] if 'p50' in s else '-',
+                          '%.2fs' % s['p90'] if 'p90' in s else '-',
+                          '%+.0f%%' % s['drift'] if 'drift' in s else '-'))
+        return "\n".join(lines)
+
+
+class SoakTest(object):
+    """
+    Runs volume lifecycles continuously and collects their timings.
+    """
+    def __init__(self, volumes, instances, snapshots=1, size=1,
+                 percentage=10, window=60):
+        self.volumes = volumes
+        self.instance_count = instances
+        self.snapshots = snapshots
+        self.size = size
+        self.percentage = percentage
+        self.timer = OperationTimer()
+        self.windows = WindowStats(window)
+        self.instances = []
+        self.lifecycles = 0
+        # Stop after this many lifecycles, if not 0
+        self.limit = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _time(self, operation, func, *args, **kwargs):
+        start = time.time()
+        try:
+            result = self.timer.time(operation, func, *args, **kwargs)
+        except Exception:
+            self.windows.record(operation)
+            raise
+        self.windows.record(operation, time.time() - start)
+        return result
+
+    def _verify(self, volume, key):
+        if not volume.check_test_pattern(percentage=self.percentage,
+                                         key=key):
+            raise VerifyError("%s does not hold pattern %d" %
+                              (volume.id, key))
+
+    def _delete(self, resource):
+        resource.delete()
+        wait_until_gone(resource.kind, resource.id)
+
+    def _lifecycle(self, instance):
+        created = []
+        key = random.randint(1, 1 << 30)
+        try:
+            volume = self._time('volume.create', Volume, size=self.size)
+            created.append(volume)
+            self._time('volume.attach', volume.attach, instance)
+            self._time('volume.write', volume.write_test_pattern,
+                       percentage=self.percentage, key=key)
+            self._time('volume.detach', volume.detach)
+            for i in xrange(self.snapshots):
+                snapshot = self._time('snapshot.create', Snapshot, volume)
+                created.append(snapshot)
+                clone = self._time('volume.clone', Volume, snapshot=snapshot)
+                created.append(clone)
+                self._time('volume.attach', clone.attach, instance)
+                self._time('volume.verify', self._verify, clone, key)
+                self._time('volume.detach', clone.detach)
+        finally:
+            # Clones go before the snapshots they came from, and snapshots
+            # before the volume
+            for resource in reversed(created):
+                try:
+                    self._time('%s.delete' % resource.kind, self._delete,
+                               resource)
+                except Exception as e:
+                    print "Failed to delete %s %s: %s" % \
+                            (resource.kind, resource.id, e)
+
+    def _worker(self, worker):
+        n = 0
+        while not self._stop.is_set():
+            with self._lock:
+                if self.limit and self.lifecycles >= self.limit:
+                    return
+                self.lifecycles += 1
+            instance = self.instances[(worker + n) % len(self.instances)]
+            n += 1
+            try:
+                self._time('lifecycle', self._lifecycle, instance)
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                print "Worker %d lifecycle failed: %s" % \
+                        (worker, traceback.format_exc())
+
+    def _report_windows(self):
+        index = 0
+        while True:
+            end = self.windows.start + (index + 1) * self.windows.length
+            if self._stop.wait(max(0, end - time.time())):
+                return
+            print
+            print self.windows.format(index)
+            sys.stdout.flush()
+            index += 1
+
+    def _start_instances(self):
+        pool = ThreadPool(self.instance_count)
+        try:
+            self.instances = pool.map_async(
+                    lambda i: Instance(),
+                    range(self.instance_count)).get(sys.maxint)
+        finally:
+            pool.close()
+
+    def run(self, duration, limit=0):
+        """
+        Run lifecycles for duration seconds, or until limit lifecycles have
+        been started if limit is not 0, then wait for those running to
+        finish. Returns the results for each operation over the whole run.
+        """
+        self.limit = limit
+        self._start_instances()
+        self.windows.start = time.time()
+        reporter = threading.Thread(target=self._report_windows)
+        reporter.daemon = True
+        reporter.start()
+        timer = threading.Timer(duration, self._stop.set)
+        timer.daemon = True
+        timer.start()
+
+        workers = ThreadPool(self.volumes)
+        try:
+            workers.map_async(self._worker,
+                              range(self.volumes)).get(sys.maxint)
+        finally:
+            self._stop.set()
+            timer.cancel()
+            workers.close()
+            for instance in self.instances:
+                instance.delete()
+        print "%d lifecycles, %d failed" % (self.lifecycles, self.failures)
+        return self.timer.results()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog soak [options]")
+    add_common_options(parser, iterations=0, concurrency=4)
+    parser.get_option('-n').help = "Stop after this many lifecycles, 0 " \
+                                   "to run for the whole duration"
+    parser.get_option('-c').help = "Number of volumes to keep in flight"
+    parser.add_option('-d', '--duration', type='int', default=3600,
+                      help="Seconds to keep the load up for")
+    parser.add_option('-i', '--instances', type='int', default=2,
+                      help="Number of instances to attach volumes to")
+    parser.add_option('-k', '--snapshots', type='int', default=1,
+                      help="Snapshots to take, clone and verify in each "
+                           "volume's lifecycle")
+    parser.add_option('-s', '--size', type='int', default=1,
+                      help="Size of the volumes to create, in GB")
+    parser.add_option('-p', '--percentage', type='int', default=10,
+                      help="Percentage of each volume to write and verify")
+    parser.add_option('-w', '--window', type='int', default=60,
+                      help="Seconds in each reporting window")
+    parser.add_option('-r', '--rates',
+                      default=os.environ.get('NOVA_VOLUME_TEST_API_RATES'),
+                      help="API calls per second allowed for each "
+                           "operation, e.g. create_volume=0.5,*=10")
+    options, args = parser.parse_args(argv)
+    # Each volume in flight takes a device name on one of the instances
+    if options.concurrency > options.instances * len(ATTACH_DEVICES):
+        parser.error("each instance can only have %d volumes attached, use "
+                     "more instances for %d volumes" %
+                     (len(ATTACH_DEVICES), options.concurrency))
+
+    if options.rates:
+        # Read when the first API connection is made
+        os.environ['NOVA_VOLUME_TEST_API_RATES'] = options.rates
+
+    soak = SoakTest(options.concurrency, options.instances,
+                    options.snapshots, options.size, options.percentage,
+                    options.window)
+    results = soak.run(options.duration, options.iterations)
+    windows = [soak.windows.summary(i)
+               for i in xrange(len(soak.windows.windows))]
+    report('soak', {'duration': options.duration,
+                    'volumes': options.concurrency,
+                    'instances': options.instances,
+                    'snapshots': options.snapshots,
+                    'size': options.size,
+                    'percentage': options.percentage,
+                    'window': options.window,
+                    'rates': options.rates},
+           results, options.output, order=OPERATIONS, windows=windows)
+    if soak.failures:
+        return 1
+    return 0
@@ -0,0 +1,144 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark of the latency and throughput of the volume lifecycle operations.
+
+Each iteration creates a volume, attaches it to an instance and detaches it
+again, snapshots it, creates a volume from the snapshot, and deletes all of
+them, timing each step. Iterations run concurrently, spread over the
+instances.
+"""
+import optparse
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+from nova_volume_testing.util.instance_pool import get_instance, \
+                                                   release_instance
+from nova_volume_testing.util.novaexerciser import ATTACH_DEVICES, Volume, \
+                                                   Snapshot, get_status_poller
+from nova_volume_testing.util.status_poller import ResourceNotFound
+from nova_volume_testing.util.waiter import wait_for
+from common import OperationTimer, add_common_options, report, \
+                   run_concurrently
+
+
+def wait_until_gone(kind, resource_id):
+    """
+    Wait for a deleted volume or snapshot to disappear.
+    """
+    def status():
+        try:
+            return get_status_poller().lookup(kind, resource_id).status
+        except ResourceNotFound:
+            return 'deleted'
+    wait_for('%s.delete' % kind, resource_id, status,
+             lambda status: status == 'deleted',
+             error_states=('error_deleting',))
+
+
+class VolumeOpsBenchmark(object):
+    """
+    Runs the volume lifecycle iterations and collects their timings.
+    """
+    def __init__(self, size=1, instances=1):
+        self.size = size
+        self.instance_count = instances
+        self.timer = OperationTimer()
+        self.instances = []
+        # The number of iterations using each instance
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def _delete(self, resource):
+        resource.delete()
+        wait_until_gone(resource.kind, resource.id)
+
+    def _take_instance(self):
+        with self._lock:
+            instance = min(self.instances,
+                           key=lambda instance: self._users[instance])
+            self._users[instance] += 1
+        return instance
+
+    def _iteration(self, i):
+        time = self.timer.time
+        volume = time('volume.create', Volume, size=self.size)
+        instance = self._take_instance()
+        try:
+            time('volume.attach', volume.attach, instance)
+            time('volume.detach', volume.detach)
+        finally:
+            with self._lock:
+                self._users[instance] -= 1
+        snapshot = time('snapshot.create', Snapshot, volume)
+        snapvol = time('volume.create_from_snapshot', Volume,
+                       snapshot=snapshot)
+        time('volume.delete', self._delete, snapvol)
+        time('snapshot.delete', self._delete, snapshot)
+        time('volume.delete', self._delete, volume)
+
+    def run(self, iterations, concurrency):
+        """
+        Run the iterations, up to concurrency at a time, and return the
+        results for each operation.
+        """
+        pool = ThreadPool(self.instance_count)
+        try:
+            self.instances = pool.map_async(
+                    lambda i: get_instance(),
+                    range(self.instance_count)).get(sys.maxint)
+        finally:
+            pool.close()
+        self._users = dict((instance, 0) for instance in self.instances)
+        try:
+            failed = run_concurrently(self._iteration, iterations,
+                                      concurrency)
+        finally:
+            for instance in self.instances:
+                release_instance(instance)
+        if failed:
+            print "%d of %d iterations failed" % (failed, iterations)
+        return self.timer.results()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog volume-ops [options]")
+    add_common_options(parser)
+    parser.add_option('-s', '--size', type='int', default=1,
+                      help="Size of the volumes to create, in GB")
+    parser.add_option('-i', '--instances', type='int', default=1,
+                      help="Number of instances to spread the iterations "
+                           "over")
+    options, args = parser.parse_args(argv)
+    # Each iteration has one volume attached at a time
+    if options.concurrency > options.instances * len(ATTACH_DEVICES):
+        parser.error("each instance can only have %d volumes attached, use "
+                     "more instances for a concurrency of %d" %
+                     (len(ATTACH_DEVICES), options.concurrency))
+
+    benchmark = VolumeOpsBenchmark(options.size, options.instances)
+    results = benchmark.run(options.iterations, options.concurrency)
+    report('volume-ops', {'iterations': options.iterations,
+                          'concurrency': options.concurrency,
+                          'instances': options.instances,
+                          'size': options.size},
+           results, options.output)
+    for summary in results.values():
+        if summary['errors']:
+            return 1
+    return 0
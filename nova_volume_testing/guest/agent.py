@@ -0,0 +1,882 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Agent that runs on a VM instance and performs volume operations for the
+tests.
+
+This file is copied onto the instance and run there, so it must only use the
+python standard library and must run on whatever python the guest image has.
+
+The agent reads one JSON request per line from stdin, of the form
+    {"id": 1, "op": "write_pattern", "args": {...}}
+and writes one JSON reply per line to stdout, of the form
+    {"id": 1, "ok": true, "result": ...}
+or, if the operation failed,
+    {"id": 1, "ok": false, "error": "..."}
+It exits when stdin is closed.
+
+Run with --watch, the agent instead writes one JSON line per change to the
+instance's block devices, starting with the devices it has now:
+    {"event": "list", "devices": [...]}
+    {"event": "add", "device": {"name": "/dev/vdc", ...}}
+    {"event": "remove", "device": {"name": "/dev/vdc"}}
+
+When NOVA_VOLUME_TEST_AGENT_ROOT is set the agent treats that directory as
+the root of the guest, and the files in its dev directory as the block
+devices. The fake cloud uses this to run the agent on the test host.
+"""
+import base64
+import io
+import json
+import math
+import mmap
+import os
+import random
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+
+BLOCK_SIZE = 4096
+
+# Pattern I/O is done in chunks of this many bytes, which must be a multiple
+# of BLOCK_SIZE
+CHUNK_SIZE = 1024 * 1024
+
+
+# Every block of the test pattern starts with a header holding a magic
+# string, the key and the index of the block on the device, so that blocks
+# written with a different key, or written to the wrong place, are detected.
+HEADER = struct.Struct('<8sQQ')
+MAGIC = b'NVTPATRN'
+
+# The netlink protocol, and multicast group, that the kernel sends uevents on
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+# How often to read /proc/partitions when uevents cannot be had
+WATCH_POLL_INTERVAL = 0.1
+
+# The directory standing in for the root of the guest, or '' for the real
+# root
+ROOT = os.environ.get('NOVA_VOLUME_TEST_AGENT_ROOT', '').rstrip('/')
+
+
+def _pattern_block(key):
+    """
+    Return the BLOCK_SIZE block of test pattern for key, with a header for
+    block 0.
+    """
+    block = bytearray((i + key) % 255 for i in range(BLOCK_SIZE))
+    HEADER.pack_into(block, 0, MAGIC, key, 0)
+    return block
+
+
+class PatternBuffer(object):
+    """
+    A buffer of test pattern for one key that is built once and then
+    pointed at different blocks of the device by rewriting only the block
+    index in each block header.
+    """
+    def __init__(self, key, size=CHUNK_SIZE, direct=False):
+        self.size = size
+        self.data = _pattern_block(key) * (size // BLOCK_SIZE)
+        self.direct = direct
+        if direct:
+            self.aligned = mmap.mmap(-1, size)
+
+    def fill(self, first_block, length):
+        """
+        Set up the first length bytes of the buffer to hold the pattern for
+        the blocks starting at first_block, and return them.
+        """
+        index_offset = HEADER.size - 8
+        for i in range(length // BLOCK_SIZE):
+            struct.pack_into('<Q', self.data, i * BLOCK_SIZE + index_offset,
+                             first_block + i)
+        if length == self.size:
+            data = self.data
+        else:
+            data = self.data[:length]
+        if not self.direct:
+            return data
+        if length == self.size:
+            self.aligned[:] = bytes(data)
+            return self.aligned
+        # The last, short, chunk needs its own aligned buffer
+        return _aligned_copy(bytes(data))
+
+
+def _device_size(fd):
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return size
+
+
+def pattern_blocks(size, percentage):
+    """
+    Return the number of blocks of pattern that cover percentage of a device
+    of the given size.
+    """
+    return int((size // BLOCK_SIZE) / (float(100) / percentage))
+
+
+def _open_device(device, flags, direct):
+    """
+    Open a device, bypassing the page cache if direct is True and the
+    platform supports it.
+    """
+    path = ROOT + device
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError:
+            pass
+    return os.open(path, flags), False
+
+
+def _aligned_copy(data):
+    """
+    Return a page aligned buffer holding a copy of data, as O_DIRECT I/O
+    needs aligned buffers.
+    """
+    buf = mmap.mmap(-1, len(data))
+    buf[:] = data
+    return buf
+
+
+def _throughput(nbytes, start):
+    elapsed = max(time.time() - start, 1e-6)
+    return {'bytes': nbytes,
+            'seconds': elapsed,
+            'mb_per_sec': nbytes / elapsed / (1024 * 1024)}
+
+
+def _split_ranges(ranges, streams):
+    """
+    Split a list of block aligned [start, end) byte ranges into at most
+    streams lists of ranges, each holding about the same number of bytes.
+    """
+    total_blocks = sum(e - s for s, e in ranges) // BLOCK_SIZE
+    share = -(-total_blocks // max(1, streams)) * BLOCK_SIZE
+    if share == 0:
+        return [ranges]
+    lists = [[]]
+    room = share
+    for start, end in ranges:
+        while start < end:
+            if room == 0:
+                lists.append([])
+                room = share
+            length = min(end - start, room)
+            lists[-1].append([start, start + length])
+            start += length
+            room -= length
+    return lists
+
+
+def _run_streams(func, work):
+    """
+    Call func on every item of work, each in its own thread, and return the
+    results in the same order. The threads spend their time in read and
+    write system calls, which release the interpreter lock, so the streams
+    run in parallel on the device.
+    """
+    if len(work) == 1:
+        return [func(work[0])]
+    results = [None] * len(work)
+    errors = []
+
+    def run(i):
+        try:
+            results[i] = func(work[i])
+        except Exception:
+            errors.append(traceback.format_exc())
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(work))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception("I/O stream failed: %s" % errors[0])
+    return results
+
+
+def _write_ranges(device, ranges, key, direct, chunk_size):
+    """
+    Write the test pattern for key over each of the byte ranges given,
+    through a file descriptor of its own.
+    """
+    fd, direct = _open_device(device, os.O_RDWR, direct)
+    dev = io.FileIO(fd, 'w')
+    try:
+        pattern = PatternBuffer(key, chunk_size, direct)
+        for start, end in ranges:
+            dev.seek(start)
+            pos = start
+            while pos < end:
+                length = min(chunk_size, end - pos)
+                pos += dev.write(pattern.fill(pos // BLOCK_SIZE, length))
+        os.fsync(fd)
+    finally:
+        dev.close()
+
+
+def write_pattern(device, key=0, percentage=100, direct=False,
+                  chunk_size=CHUNK_SIZE, streams=1):
+    """
+    Write the test pattern for key over the first percentage of the device.
+
+    The pattern is written from a buffer of chunk_size bytes that is built
+    once, and the data is synced to the device before returning. If streams
+    is more than one the area is split into that many parts which are
+    written at the same time.
+    """
+    start = time.time()
+    fd, direct = _open_device(device, os.O_RDONLY, direct)
+    try:
+        total = pattern_blocks(_device_size(fd), percentage) * BLOCK_SIZE
+    finally:
+        os.close(fd)
+    work = _split_ranges([[0, total]], streams)
+    _run_streams(lambda ranges: _write_ranges(device, ranges, key, direct,
+                                              chunk_size), work)
+    result = _throughput(total, start)
+    result.update({'direct': direct, 'streams': len(work)})
+    return result
+
+
+def _zero_ranges(device, ranges, direct, chunk_size):
+    """
+    Write zeros over each of the byte ranges given, through a file
+    descriptor of its own.
+    """
+    fd, direct = _open_device(device, os.O_RDWR, direct)
+    dev = io.FileIO(fd, 'w')
+    try:
+        # Anonymous maps are page aligned and start out zeroed
+        zeros = mmap.mmap(-1, chunk_size)
+        for start, end in ranges:
+            dev.seek(start)
+            pos = start
+            while pos < end:
+                length = min(chunk_size, end - pos)
+                if length == chunk_size:
+                    pos += dev.write(zeros)
+                else:
+                    pos += dev.write(mmap.mmap(-1, length))
+        os.fsync(fd)
+    finally:
+        dev.close()
+
+
+def wipe(device, direct=False, chunk_size=CHUNK_SIZE, streams=1):
+    """
+    Write zeros over the whole of the device.
+    """
+    start = time.time()
+    fd, direct = _open_device(device, os.O_RDONLY, direct)
+    try:
+        total = _device_size(fd)
+    finally:
+        os.close(fd)
+    work = _split_ranges([[0, total]], streams)
+    _run_streams(lambda ranges: _zero_ranges(device, ranges, direct,
+                                             chunk_size), work)
+    result = _throughput(total, start)
+    result.update({'direct': direct, 'streams': len(work)})
+    return result
+
+
+def _first_bad_block(data, expected):
+    """
+    Return the index of the first whole block of data that does not match
+    expected, or None if they all match.
+    """
+    for i in range(len(data) // BLOCK_SIZE):
+        block = slice(i * BLOCK_SIZE, (i + 1) * BLOCK_SIZE)
+        if data[block] != expected[block]:
+            return i
+    return None
+
+
+def _check_sequential(fd, dev, start, end, key, direct, chunk_size,
+                      stop=None):
+    """
+    Read bytes start to end of the device, checking them against the
+    pattern for key. Returns (bytes checked, index of the first bad block
+    or None). Gives up early if the stop event is set.
+    """
+    pattern = PatternBuffer(key, chunk_size)
+    if direct:
+        buf = mmap.mmap(-1, chunk_size)
+    os.lseek(fd, start, os.SEEK_SET)
+    done = 0
+    while start + done < end:
+        if stop != None and stop.is_set():
+            break
+        length = min(chunk_size, end - start - done)
+        if direct:
+            nread = dev.readinto(buf)
+            data = buf[:min(nread, length)]
+        else:
+            data = os.read(fd, length)
+        if not data:
+            break
+        # Only whole blocks are checked, as the old check did
+        whole = len(data) - len(data) % BLOCK_SIZE
+        first_block = (start + done) // BLOCK_SIZE
+        expected = pattern.fill(first_block, whole)
+        if data[:whole] != expected:
+            if stop != None:
+                stop.set()
+            return done, first_block + _first_bad_block(data, expected)
+        done += len(data)
+    return done, None
+
+
+def _check_ranges(device, ranges, key, direct, chunk_size, stop):
+    """
+    Check each of the byte ranges given, through a file descriptor of its
+    own. Returns (bytes checked, index of the first bad block or None).
+    """
+    fd, direct = _open_device(device, os.O_RDONLY, direct)
+    dev = io.FileIO(fd, 'r')
+    try:
+        done = 0
+        for start, end in ranges:
+            checked, bad = _check_sequential(fd, dev, start, end, key,
+                                             direct, chunk_size, stop)
+            done += checked
+            if bad != None:
+                return done, bad
+        return done, None
+    finally:
+        dev.close()
+
+
+def _check_sample(dev, ranges, key, sample, seed):
+    """
+    Check sample blocks, chosen at random from the byte ranges given,
+    against the pattern for key. Returns (bytes checked, index of the first
+    bad block or None).
+    """
+    # (first block, number of blocks) for each range
+    block_ranges = [(s // BLOCK_SIZE, (e - s) // BLOCK_SIZE)
+                    for s, e in ranges]
+    blocks = sum(n for first, n in block_ranges)
+    if blocks == 0:
+        return 0, None
+    rand = random.Random(seed)
+    if sample >= blocks:
+        chosen = range(blocks)
+    else:
+        chosen = set()
+        while len(chosen) < sample:
+            chosen.add(rand.randrange(blocks))
+        chosen = sorted(chosen)
+
+    pattern = PatternBuffer(key, BLOCK_SIZE)
+    buf = mmap.mmap(-1, BLOCK_SIZE)
+    done = 0
+    ranges = iter(block_ranges)
+    first, count = next(ranges)
+    passed = 0
+    for n in chosen:
+        # Map the n'th block of all the ranges onto a block of the device
+        while n - passed >= count:
+            passed += count
+            first, count = next(ranges)
+        block = first + n - passed
+        dev.seek(block * BLOCK_SIZE)
+        if dev.readinto(buf) != BLOCK_SIZE:
+            continue
+        done += BLOCK_SIZE
+        if buf[:] != pattern.fill(block, BLOCK_SIZE):
+            return done, block
+    return done, None
+
+
+def check_pattern(device, key=0, percentage=100, direct=False,
+                  chunk_size=CHUNK_SIZE, sample=0, seed=None, ranges=None,
+                  sample_ranges=None, streams=1):
+    """
+    Check that the first percentage of the device holds the test pattern for
+    key.
+
+    If sample is non zero only that many blocks, chosen at random from the
+    whole of the checked area, are read. The reply includes the seed used to
+    choose the blocks so that a failing check can be repeated.
+
+    Alternatively ranges and sample_ranges give lists of [start, end) byte
+    ranges, in place of percentage. Every block in ranges is checked, and
+    sample blocks are checked from sample_ranges.
+
+    If streams is more than one the blocks to be checked in full are split
+    into that many parts which are checked at the same time. All of the
+    streams stop as soon as one of them finds a bad block, and the lowest
+    bad block found is reported.
+    """
+    start = time.time()
+    fd, direct = _open_device(device, os.O_RDONLY, direct)
+    dev = io.FileIO(fd, 'r')
+    try:
+        size = _device_size(fd)
+        blocks = pattern_blocks(size, percentage)
+        if ranges == None and sample_ranges == None:
+            if sample:
+                ranges, sample_ranges = [], [[0, blocks * BLOCK_SIZE]]
+            else:
+                ranges, sample_ranges = [[0, blocks * BLOCK_SIZE]], []
+        else:
+            ranges = ranges or []
+            sample_ranges = sample_ranges or []
+            blocks = sum(e - s for s, e in ranges + sample_ranges) // \
+                        BLOCK_SIZE
+
+        work = _split_ranges(ranges, streams)
+        stop = threading.Event()
+        results = _run_streams(lambda r: _check_ranges(device, r, key,
+                                                       direct, chunk_size,
+                                                       stop), work)
+        done = sum(checked for checked, bad in results)
+        bad_blocks = [bad for checked, bad in results if bad != None]
+        if bad_blocks:
+            bad = min(bad_blocks)
+        else:
+            bad = None
+
+        sampled = 0
+        if bad == None and sample and sample_ranges:
+            if seed == None:
+                seed = random.randrange(2 ** 32)
+            checked, bad = _check_sample(dev, sample_ranges, key, sample,
+                                         seed)
+            done += checked
+            sampled = checked // BLOCK_SIZE
+    finally:
+        dev.close()
+    if bad == None:
+        result = "Pass"
+    else:
+        result = "Fail sector %d of %d" % (bad, size // BLOCK_SIZE)
+    reply = _throughput(done, start)
+    reply.update({'result': result,
+                  'passed': bad == None,
+                  'direct': direct,
+                  'blocks': blocks,
+                  'sampled': sampled,
+                  'seed': seed,
+                  'streams': len(work)})
+    return reply
+
+
+def check_mount(device, mount_dir='/tmp/bocktest_mnt'):
+    """
+    Check that the device holds a file system that can be mounted.
+    """
+    if not os.path.isdir(mount_dir):
+        os.makedirs(mount_dir)
+    for cmd in (['mount', ROOT + device, mount_dir], ['umount', mount_dir]):
+        # Capture the output of mount so that it does not end up in the
+        # replies on stdout
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            return {'passed': False, 'output': output.decode('ascii',
+                                                             'replace')}
+    os.rmdir(mount_dir)
+    return {'passed': True}
+
+
+def digest(data):
+    """
+    Return the digest of an extent, as used in manifests.
+    """
+    return zlib.crc32(data) & 0xffffffff
+
+
+def pack_digests(digests):
+    """
+    Pack a list of extent digests into a compact string for sending over
+    the agent's channel.
+    """
+    packed = struct.pack('<%dI' % len(digests), *digests)
+    return base64.b64encode(zlib.compress(packed)).decode('ascii')
+
+
+def unpack_digests(packed):
+    data = zlib.decompress(base64.b64decode(packed))
+    return list(struct.unpack('<%dI' % (len(data) // 4), data))
+
+
+def manifest(device, extent_size=CHUNK_SIZE, length=0, direct=False):
+    """
+    Read the first length bytes of the device, or all of it, once and
+    return the digest of every extent_size extent of it.
+    """
+    start = time.time()
+    fd, direct = _open_device(device, os.O_RDONLY, direct)
+    dev = io.FileIO(fd, 'r')
+    try:
+        size = _device_size(fd)
+        if not length or length > size:
+            length = size
+        buf = mmap.mmap(-1, extent_size)
+        digests = []
+        done = 0
+        while done < length:
+            nread = dev.readinto(buf)
+            if not nread:
+                break
+            nread = min(nread, length - done)
+            digests.append(digest(buf[:nread]))
+            done += nread
+    finally:
+        dev.close()
+    reply = _throughput(done, start)
+    reply.update({'extent_size': extent_size,
+                  'length': done,
+                  'digests': pack_digests(digests),
+                  'direct': direct})
+    return reply
+
+
+def _device_serials():
+    """
+    Map the name of each block device to the serial number it was given by
+    the hypervisor, as published under /dev/disk/by-id by udev or, failing
+    that, by the virtio driver in sysfs.
+    """
+    serials = {}
+    by_id = ROOT + '/dev/disk/by-id'
+    if os.path.isdir(by_id):
+        for link in os.listdir(by_id):
+            if not link.startswith('virtio-'):
+                continue
+            name = os.path.basename(os.path.realpath(
+                                        os.path.join(by_id, link)))
+            serials[name] = link[len('virtio-'):]
+    if os.path.isdir(ROOT + '/sys/block'):
+        for name in os.listdir(ROOT + '/sys/block'):
+            if name in serials:
+                continue
+            try:
+                with open(ROOT + '/sys/block/%s/serial' % name) as fd:
+                    serial = fd.read().strip()
+            except (IOError, OSError):
+                continue
+            if serial:
+                serials[name] = serial
+    return serials
+
+
+def list_devices():
+    """
+    List the block devices the kernel knows about, with their sizes in
+    bytes and their serial numbers, or None for devices without one.
+    """
+    if ROOT:
+        return _file_devices()
+    serials = _device_serials()
+    devices = []
+    for line in open('/proc/partitions'):
+        words = line.split()
+        if len(words) < 4 or words[3] == 'name':
+            continue
+        devices.append({'name': '/dev/%s' % words[3],
+                        'size': int(words[2]) * 1024,
+                        'serial': serials.get(words[3])})
+    return devices
+
+
+def _file_devices():
+    """
+    List the files standing in for block devices in the dev directory under
+    ROOT, as list_devices() does.
+    """
+    serials = _device_serials()
+    devices = []
+    for name in sorted(os.listdir(ROOT + '/dev')):
+        path = os.path.join(ROOT + '/dev', name)
+        try:
+            if not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+        except OSError:
+            # Removed while being listed
+            continue
+        devices.append({'name': '/dev/%s' % name,
+                        'size': size,
+                        'serial': serials.get(name)})
+    return devices
+
+
+def _latency_stats(latencies):
+    latencies.sort()
+    count = len(latencies)
+    return {'count': count,
+            'mean': sum(latencies) / count,
+            'p50': latencies[int(math.ceil(count * 0.50)) - 1],
+            'p99': latencies[int(math.ceil(count * 0.99)) - 1],
+            'max': latencies[-1]}
+
+
+def benchmark(device, mode='seqread', length=0, block_size=CHUNK_SIZE,
+              count=1000, direct=False):
+    """
+    Measure the performance of the device.
+
+    mode is one of
+        seqread    read length bytes (default the whole device) sequentially
+        randread   read count random blocks
+        randwrite  write count random blocks of zeros, each synced to disk
+    Random writes destroy the data on the device. If direct is True the
+    page cache is bypassed.
+    """
+    flags = os.O_RDONLY
+    if mode == 'randwrite':
+        flags = os.O_RDWR | getattr(os, 'O_DSYNC', os.O_SYNC)
+    fd, direct = _open_device(device, flags, direct)
+    dev = io.FileIO(fd, 'r+' if mode == 'randwrite' else 'r')
+    try:
+        size = _device_size(fd)
+        if not length or length > size:
+            length = size
+        blocks = length // block_size
+        buf = mmap.mmap(-1, block_size)
+        start = time.time()
+        if mode == 'seqread':
+            done = 0
+            while done < length:
+                nread = dev.readinto(buf)
+                if not nread:
+                    break
+                done += nread
+            result = _throughput(done, start)
+            result['direct'] = direct
+            return result
+
+        latencies = []
+        for i in range(count):
+            dev.seek(random.randrange(blocks) * block_size)
+            op_start = time.time()
+            if mode == 'randread':
+                dev.readinto(buf)
+            elif mode == 'randwrite':
+                dev.write(buf)
+            else:
+                raise ValueError("Unknown benchmark mode %s" % mode)
+            latencies.append(time.time() - op_start)
+        elapsed = time.time() - start
+        result = _latency_stats(latencies)
+        result.update({'seconds': elapsed,
+                       'iops': count / elapsed,
+                       'mb_per_sec': count * block_size / elapsed /
+                                        (1024 * 1024),
+                       'direct': direct})
+        return result
+    finally:
+        dev.close()
+
+
+def ping():
+    return 'pong'
+
+
+def batch(requests):
+    """
+    Perform a list of requests at the same time and return the list of
+    replies, in the same order.
+    """
+    return _run_streams(handle, requests)
+
+
+OPERATIONS = {
+    'write_pattern': write_pattern,
+    'check_pattern': check_pattern,
+    'wipe': wipe,
+    'check_mount': check_mount,
+    'list_devices': list_devices,
+    'manifest': manifest,
+    'benchmark': benchmark,
+    'batch': batch,
+    'ping': ping,
+}
+
+
+def handle(request):
+    """
+    Perform one request and return the reply to it.
+    """
+    reply = {'id': request.get('id')}
+    try:
+        op = OPERATIONS[request['op']]
+        args = dict((str(k), v) for k, v in request.get('args', {}).items())
+        reply['result'] = op(**args)
+        reply['ok'] = True
+    except Exception:
+        reply['ok'] = False
+        reply['error'] = traceback.format_exc()
+    return reply
+
+
+def _block_device(name):
+    """
+    Describe the block device called name, as in list_devices(), from sysfs
+    and the serial numbers _device_serials() finds.
+    """
+    device = {'name': '/dev/%s' % name, 'size': 0,
+              'serial': _device_serials().get(name)}
+    try:
+        with open(ROOT + '/sys/class/block/%s/size' % name) as fd:
+            device['size'] = int(fd.read()) * 512
+    except (IOError, OSError, ValueError):
+        pass
+    return device
+
+
+def _uevent_socket():
+    """
+    Subscribe to the uevents the kernel sends when devices come and go.
+    Returns None if this is not possible.
+    """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_GROUP_KERNEL))
+    except (AttributeError, socket.error):
+        return None
+    return sock
+
+
+def _uevent_changes(sock):
+    """
+    Read a uevent and return the block device changes it describes.
+    """
+    fields = {}
+    for field in sock.recv(65536).split(b'\0'):
+        if b'=' in field:
+            key, value = field.split(b'=', 1)
+            fields[key.decode('ascii', 'replace')] = \
+                    value.decode('ascii', 'replace')
+    if fields.get('SUBSYSTEM') != 'block' or 'DEVNAME' not in fields:
+        return []
+    name = os.path.basename(fields['DEVNAME'])
+    if fields.get('ACTION') in ('add', 'change'):
+        return [{'event': 'add', 'device': _block_device(name)}]
+    if fields.get('ACTION') == 'remove':
+        return [{'event': 'remove', 'device': {'name': '/dev/%s' % name}}]
+    return []
+
+
+def _device_identity(device):
+    """
+    Return what tells apart two devices that came under the same name one
+    after the other: the inode of a file standing in for one, otherwise the
+    device's description.
+    """
+    if ROOT:
+        try:
+            return os.stat(ROOT + device['name']).st_ino
+        except OSError:
+            # Removed since being listed; it will not be there next time
+            return None
+    return tuple(sorted(device.items()))
+
+
+def _partition_changes(known):
+    """
+    Read /proc/partitions and return how it differs from the devices in
+    known, which is updated to match. A device that went and another that
+    came under the same name between two reads shows as both.
+    """
+    devices = dict((d['name'], (_device_identity(d), d))
+                   for d in list_devices())
+    changes = []
+    for name in sorted(known):
+        if name not in devices or devices[name][0] != known[name][0]:
+            changes.append({'event': 'remove', 'device': {'name': name}})
+            del known[name]
+    for name in sorted(set(devices) - set(known)):
+        changes.append({'event': 'add', 'device': devices[name][1]})
+        known[name] = devices[name]
+    return changes
+
+
+def watch_devices():
+    """
+    Write the block devices on the instance, and then every change to
+    them, to stdout until stdin is closed.
+
+    Changes are taken from the kernel's uevents as they happen. If those
+    cannot be subscribed to /proc/partitions is polled instead.
+    """
+    # Files standing in for devices do not send uevents
+    sock = None if ROOT else _uevent_socket()
+    known = {}
+    events = [{'event': 'list',
+               'devices': [event['device']
+                           for event in _partition_changes(known)]}]
+    while True:
+        for event in events:
+            sys.stdout.write(json.dumps(event) + '\n')
+        sys.stdout.flush()
+
+        if sock != None:
+            readable = select.select([sys.stdin, sock], [], [])[0]
+        else:
+            readable = select.select([sys.stdin], [], [],
+                                     WATCH_POLL_INTERVAL)[0]
+        if sys.stdin in readable and not os.read(sys.stdin.fileno(), 4096):
+            break
+        if sock == None:
+            events = _partition_changes(known)
+        elif sock in readable:
+            events = _uevent_changes(sock)
+        else:
+            events = []
+
+
+def main():
+    if sys.argv[1:] == ['--watch']:
+        watch_devices()
+        return
+
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        sys.stdout.write(json.dumps(handle(json.loads(line))) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
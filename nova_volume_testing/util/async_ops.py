@@ -0,0 +1,289 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Non blocking versions of the resource operations in novaexerciser.
+
+Each function here starts an operation on a pool of worker threads and
+returns a Future for its result straight away. Any argument may itself be a
+Future, in which case the operation starts once that Future has finished, so
+a scenario can describe what depends on what and let independent steps run
+at the same time:
+
+    instance = start_instance()
+    volume = create_volume(size=1)
+    attached = attach(volume, instance)
+    snapshots = [create_snapshot(attached) for i in range(3)]
+    gather(snapshots)
+
+The size of the worker pool can be set with NOVA_VOLUME_TEST_WORKERS.
+"""
+import os
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+from instance_pool import get_instance, release_instance
+from novaexerciser import Volume, Snapshot
+
+
+class Future(object):
+    """
+    The result of an operation that may not have finished yet.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def _finish(self, result=None, exc_info=None):
+        with self._cond:
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._cond.notify_all()
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        """
+        Check if the operation has finished.
+        """
+        with self._cond:
+            return self._done
+
+    def failed(self):
+        """
+        Check if the operation has finished by raising an exception.
+        """
+        with self._cond:
+            return self._done and self._exc_info != None
+
+    def result(self):
+        """
+        Wait for the operation to finish and return its result, or raise the
+        exception it raised.
+        """
+        with self._cond:
+            while not self._done:
+                # A timeout makes the wait interruptible
+                self._cond.wait(1)
+        if self._exc_info != None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with this Future once the operation has finished,
+        straight away if it already has.
+        """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+class Executor(object):
+    """
+    Runs operations on a pool of worker threads.
+    """
+    def __init__(self, workers):
+        self._pool = ThreadPool(workers)
+
+    def _run(self, future, func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except:
+            future._finish(exc_info=sys.exc_info())
+        else:
+            future._finish(result)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Start func(*args, **kwargs) and return a Future for its result.
+        """
+        future = Future()
+        self._pool.apply_async(self._run, (future, func, args, kwargs))
+        return future
+
+    def after(self, futures, func, *args, **kwargs):
+        """
+        Start func(*args, **kwargs) once all of futures have finished, and
+        return a Future for its result. If any of futures fails, so does the
+        returned Future, without func being called.
+
+        No worker thread is tied up waiting for futures to finish.
+        """
+        future = Future()
+        # Dependencies still to finish, or None once the outcome is decided
+        pending = [len(futures)]
+        lock = threading.Lock()
+
+        def finished(dependency):
+            with lock:
+                if pending[0] == None:
+                    return
+                pending[0] -= 1
+                failed = dependency.failed()
+                start = not failed and pending[0] == 0
+                if failed or start:
+                    pending[0] = None
+            if failed:
+                future._finish(exc_info=dependency._exc_info)
+            elif start:
+                self._pool.apply_async(self._run,
+                                       (future, func, args, kwargs))
+
+        if not futures:
+            self._pool.apply_async(self._run, (future, func, args, kwargs))
+        for dependency in futures:
+            dependency.add_done_callback(finished)
+        return future
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Get the Executor shared by every operation in this process.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor == None:
+            workers = int(os.environ.get('NOVA_VOLUME_TEST_WORKERS', 16))
+            _executor = Executor(workers)
+        return _executor
+
+
+def _resolved(value):
+    if isinstance(value, Future):
+        return value.result()
+    return value
+
+
+def run(func, *args, **kwargs):
+    """
+    Start func(*args, **kwargs) once any of args and kwargs that are Futures
+    have finished, calling it with their results. Returns a Future for what
+    func returns.
+    """
+    futures = [a for a in list(args) + kwargs.values()
+               if isinstance(a, Future)]
+
+    def call():
+        return func(*[_resolved(a) for a in args],
+                    **dict((k, _resolved(v)) for k, v in kwargs.items()))
+    return get_executor().after(futures, call)
+
+
+def gather(futures):
+    """
+    Wait for all of futures to finish and return the list of their results.
+    If any of them failed, the first failure is raised once they have all
+    finished, so that nothing is still running when the caller moves on.
+    """
+    for future in futures:
+        try:
+            future.result()
+        except:
+            pass
+    return [future.result() for future in futures]
+
+
+def start_instance():
+    """
+    Start an instance, or take one from the instance pool.
+    """
+    return run(get_instance)
+
+
+def release(instance):
+    """
+    Give back an instance from start_instance().
+    """
+    return run(release_instance, instance)
+
+
+def create_volume(size=None, snapshot=None, zone=None):
+    """
+    Create a volume, either empty of the specified size or from the
+    specified snapshot.
+    """
+    return run(Volume, zone=zone, size=size, snapshot=snapshot)
+
+
+def create_snapshot(volume):
+    """
+    Snapshot a volume.
+    """
+    return run(Snapshot, volume)
+
+
+def _attach(volume, instance):
+    volume.attach(instance)
+    return volume
+
+
+def attach(volume, instance):
+    """
+    Attach a volume to an instance. The Future's result is the volume.
+    """
+    return run(_attach, volume, instance)
+
+
+def _detach(volume):
+    volume.detach()
+    return volume
+
+
+def detach(volume):
+    """
+    Detach a volume. The Future's result is the volume.
+    """
+    return run(_detach, volume)
+
+
+def write_test_pattern(volume, **kwargs):
+    """
+    Write a test pattern to an attached volume, as
+    Volume.write_test_pattern(). The Future's result is the volume.
+    """
+    def write(volume):
+        volume.write_test_pattern(**kwargs)
+        return volume
+    return run(write, volume)
+
+
+def check_test_pattern(volume, **kwargs):
+    """
+    Check the test pattern on an attached volume, as
+    Volume.check_test_pattern().
+    """
+    return run(lambda volume: volume.check_test_pattern(**kwargs), volume)
+
+
+def delete(resource):
+    """
+    Delete a volume or snapshot.
+    """
+    return run(lambda resource: resource.delete(), resource)
@@ -0,0 +1,172 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A pool of API connections shared by every thread in a process.
+
+Connections are kept open between calls, so their HTTP connections are kept
+alive and reused, rather than a new connection being set up for every
+resource object.
+"""
+import errno
+import httplib
+import socket
+import threading
+import time
+from rate_limit import get_rate_limiter
+from tracing import get_tracer
+
+
+# Errors that can mean a connection that has been sitting idle was closed by
+# the other end
+STALE_ERRORS = (socket.error, httplib.HTTPException)
+
+# Calls that only look at resources, so are safe to make twice
+IDEMPOTENT_PREFIXES = ('describe_', 'get_')
+
+
+def _retryable(method, error):
+    """
+    Decide whether a call to method that failed with error on a reused
+    connection can be made again on a new connection. Calls that change
+    something are only made again when the error shows the server closed
+    the connection before taking the request, as otherwise the change would
+    be made twice, for example booting two instances.
+    """
+    if method.startswith(IDEMPOTENT_PREFIXES):
+        return True
+    if isinstance(error, httplib.BadStatusLine):
+        # The connection was closed without a response being started
+        return True
+    return isinstance(error, socket.error) and \
+           error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+def _resource_id(args, kwargs):
+    """
+    Guess which resource an API call acts on from its arguments: the first
+    argument that is a string, or the first string in a list argument, such
+    as the ids given to a describe call.
+    """
+    for arg in list(args) + sorted(kwargs.values()):
+        if isinstance(arg, (list, tuple)) and arg:
+            arg = arg[0]
+        if isinstance(arg, basestring):
+            return arg
+    return None
+
+
+class ConnectionPool(object):
+    """
+    Up to size connections made by calling factory(), handed out to one
+    thread at a time.
+    """
+    def __init__(self, factory, size, max_idle=60):
+        """
+        Connections that have been idle for more than max_idle seconds are
+        closed rather than reused.
+        """
+        self.factory = factory
+        self.size = size
+        self.max_idle = max_idle
+        self._cond = threading.Condition()
+        # Idle connections, as (connection, time it was last used)
+        self._idle = []
+        self._count = 0
+
+    def get(self):
+        """
+        Take a connection from the pool, waiting for one to be returned if
+        size connections are in use. Returns the connection and whether it
+        has been used before.
+        """
+        with self._cond:
+            while True:
+                while self._idle:
+                    conn, last_used = self._idle.pop()
+                    if time.time() - last_used <= self.max_idle:
+                        return conn, True
+                    self._count -= 1
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                self._cond.wait(1)
+
+        try:
+            return self.factory(), False
+        except:
+            self.discard(None)
+            raise
+
+    def put(self, conn):
+        """
+        Give a connection back to the pool.
+        """
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        """
+        Give up on a connection that has stopped working.
+        """
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call method on a connection from the pool. If a connection that had
+        been used before turns out to have gone stale the call is made
+        again on a new connection, when it is safe to. Each call is traced,
+        and held back if calls to method are rate limited.
+        """
+        with get_tracer().span('euca.%s' % method,
+                               _resource_id(args, kwargs)) as span:
+            throttled = get_rate_limiter().acquire(method)
+            if throttled:
+                span.set(throttled=throttled)
+            while True:
+                conn, reused = self.get()
+                try:
+                    result = getattr(conn, method)(*args, **kwargs)
+                except STALE_ERRORS as e:
+                    self.discard(conn)
+                    if reused and _retryable(method, e):
+                        span.retries += 1
+                        continue
+                    raise
+                except:
+                    self.put(conn)
+                    raise
+                self.put(conn)
+                return result
+
+
+class PooledConnection(object):
+    """
+    Stands in for a single connection, making each method call on whichever
+    connection in pool is free.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            return self._pool.call(name, *args, **kwargs)
+        call.__name__ = name
+        return call
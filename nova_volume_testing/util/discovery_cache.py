@@ -0,0 +1,153 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A cache, kept on disk, of what has been discovered about the cloud under
+test, such as which image to boot and which user to log in to it as.
+
+Entries are kept per API endpoint and expire after a time to live, so that
+instances launched by later test runs, or by other scenarios running at the
+same time, can skip the discovery.
+
+The cache file is NOVA_VOLUME_TEST_CACHE_FILE, by default
+~/.cache/nova-volume-test/discovery.json, and the time to live in seconds is
+NOVA_VOLUME_TEST_CACHE_TTL, by default an hour. A time to live of 0 turns
+the cache off.
+"""
+import fcntl
+import json
+import os
+import os.path
+import threading
+import time
+
+
+DEFAULT_CACHE_FILE = os.path.join('~', '.cache', 'nova-volume-test',
+                                  'discovery.json')
+DEFAULT_TTL = 3600
+
+
+class DiscoveryCache(object):
+    """
+    The entries in a cache file for one endpoint.
+    """
+    def __init__(self, path, endpoint, ttl=DEFAULT_TTL):
+        self.path = path
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _update(self, change=None):
+        """
+        Read the cache file, holding a lock on it so that other processes do
+        not change it at the same time, and if change is given apply it to
+        the entries for this endpoint and write the file back. Returns the
+        entries for this endpoint.
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        with self._lock:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(self.path) as fd:
+                        contents = json.load(fd)
+                except (IOError, ValueError):
+                    contents = {}
+                entries = contents.setdefault(self.endpoint, {})
+                if change != None:
+                    change(entries)
+                    with open(self.path + '.tmp', 'w') as fd:
+                        json.dump(contents, fd, indent=1, sort_keys=True)
+                    os.rename(self.path + '.tmp', self.path)
+                return entries
+
+    def get(self, name):
+        """
+        Return the value cached as name, or None if there is no such entry
+        or it has expired.
+        """
+        if self.ttl <= 0:
+            return None
+        entry = self._update().get(name)
+        if entry == None or time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['value']
+
+    def set(self, name, value):
+        """
+        Cache value as name.
+        """
+        if self.ttl <= 0:
+            return
+
+        def change(entries):
+            entries[name] = {'time': time.time(), 'value': value}
+        self._update(change)
+
+    def invalidate(self, name=None):
+        """
+        Forget the entry called name, or every entry for the endpoint if no
+        name is given.
+        """
+        def change(entries):
+            if name == None:
+                entries.clear()
+            else:
+                entries.pop(name, None)
+        self._update(change)
+
+    def lookup(self, name, discover):
+        """
+        Return the value cached as name. If there is none, call discover()
+        to find the value and cache what it returns.
+        """
+        value = self.get(name)
+        if value == None:
+            value = discover()
+            self.set(name, value)
+        return value
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_discovery_cache():
+    """
+    Get the DiscoveryCache for the endpoint being tested, which is taken
+    from EC2_URL.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache == None:
+            path = os.environ.get('NOVA_VOLUME_TEST_CACHE_FILE',
+                                  DEFAULT_CACHE_FILE)
+            ttl = float(os.environ.get('NOVA_VOLUME_TEST_CACHE_TTL',
+                                       DEFAULT_TTL))
+            endpoint = os.environ.get('EC2_URL', '')
+            if os.environ.get('NOVA_VOLUME_TEST_FAKE_CLOUD'):
+                # Keep what is found in a fake cloud apart from the real one
+                endpoint = 'fake:' + os.environ['NOVA_VOLUME_TEST_FAKE_CLOUD']
+            _cache = DiscoveryCache(os.path.expanduser(path), endpoint, ttl)
+        return _cache
@@ -0,0 +1,92 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Track what has been written to which parts of a volume.
+"""
+
+
+class ExtentMap(object):
+    """
+    A map from non overlapping byte ranges [start, end) of a device to a
+    value, such as the key of the test pattern written there.
+    """
+    def __init__(self, extents=None):
+        # Sorted list of [start, end, value]
+        self.extents = [list(e) for e in extents or []]
+
+    def copy(self):
+        return ExtentMap(self.extents)
+
+    def clear(self, start, end):
+        """
+        Forget the value of every byte in [start, end).
+        """
+        kept = []
+        for s, e, value in self.extents:
+            if e <= start or s >= end:
+                kept.append([s, e, value])
+                continue
+            if s < start:
+                kept.append([s, start, value])
+            if e > end:
+                kept.append([end, e, value])
+        self.extents = kept
+
+    def set(self, start, end, value):
+        """
+        Record that every byte in [start, end) now has value.
+        """
+        if start >= end:
+            return
+        self.clear(start, end)
+        self.extents.append([start, end, value])
+        self.extents.sort()
+
+        # Join neighbouring extents with the same value
+        merged = []
+        for extent in self.extents:
+            if merged and merged[-1][1] == extent[0] and \
+                    merged[-1][2] == extent[2]:
+                merged[-1][1] = extent[1]
+            else:
+                merged.append(extent)
+        self.extents = merged
+
+    def pieces(self, start, end):
+        """
+        Return a list of (start, end, value) covering [start, end), with a
+        value of None for the parts that have no value.
+        """
+        result = []
+        pos = start
+        for s, e, value in self.extents:
+            if e <= pos:
+                continue
+            if s >= end:
+                break
+            if s > pos:
+                result.append((pos, s, None))
+                pos = s
+            result.append((pos, min(e, end), value))
+            pos = min(e, end)
+        if pos < end:
+            result.append((pos, end, None))
+        return result
+
+    def __repr__(self):
+        return "ExtentMap(%r)" % self.extents
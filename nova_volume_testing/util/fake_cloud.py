@@ -0,0 +1,734 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A fake of the EC2 API calls the tests make, for running the harness without
+a cloud: to test it, to measure its own overhead, and to load test it with
+more concurrent operations than a real deployment would allow.
+
+Set NOVA_VOLUME_TEST_FAKE_CLOUD to a directory and the tests use the fake
+instead of euca2ools. The fake keeps the state of its instances, volumes and
+snapshots in that directory, so that every test process sees the same cloud.
+Volumes and snapshots are sparse files there, each GB of a volume being
+NOVA_VOLUME_TEST_FAKE_GB bytes, 64MB by default. Each instance gets a
+directory that plays its root file system, with the volumes attached to it
+linked into its dev directory, and ssh to an instance runs commands on the
+test host against that directory (see fake_guest). As with KVM, a volume
+appears in the guest under the first free device name rather than the one
+asked for. Set NOVA_VOLUME_TEST_FAKE_SERIALS=0 to attach volumes without
+serial numbers.
+
+Resources move through the same states as in nova, taking a time drawn from
+a latency model for each transition. NOVA_VOLUME_TEST_FAKE_LATENCY overrides
+the distributions in DEFAULT_LATENCIES, for example
+
+    volume.create=uniform:1:3,api=const:0.05
+
+where a distribution is one of const:SECONDS, uniform:LOW:HIGH,
+normal:MEAN:STDDEV and lognormal:MEDIAN:SIGMA. 'api' is the time every API
+call takes. NOVA_VOLUME_TEST_FAKE_TIME_SCALE multiplies every latency, so
+0.01 runs the model a hundred times faster.
+
+NOVA_VOLUME_TEST_FAKE_ERRORS injects failures, for example
+
+    delete_volume=0.1,volume.create=0.05,*=0.01
+
+A rate for an API method name makes that fraction of calls to it raise
+EC2ResponseError, '*' applying to every method without a rate of its own.
+A rate for instance.start, volume.create or snapshot.create sends that
+fraction of new resources into the error state.
+"""
+import atexit
+import errno
+import fcntl
+import json
+import math
+import os
+import os.path
+import random
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from StringIO import StringIO
+import boto.exception
+from paramiko.rsakey import RSAKey
+from fake_guest import FakeSSHClient
+
+
+FAKE_CLOUD_ENV = 'NOVA_VOLUME_TEST_FAKE_CLOUD'
+
+DEFAULT_LATENCIES = {
+    'api': 'const:0.02',
+    'instance.start': 'lognormal:30:0.3',
+    'instance.terminate': 'uniform:2:5',
+    'volume.create': 'lognormal:5:0.5',
+    'volume.delete': 'uniform:1:3',
+    'volume.attach': 'lognormal:3:0.4',
+    'volume.detach': 'lognormal:2:0.4',
+    'snapshot.create': 'lognormal:10:0.5',
+    'snapshot.delete': 'uniform:1:3',
+}
+
+DEFAULT_GB = 64 * 1024 * 1024
+
+# How often each process using the fake moves resources on to their next
+# state, which is what makes attached volumes appear on instances.
+SETTLE_INTERVAL = 0.05
+
+# Terminated instances are still described for this long
+TERMINATED_TTL = 60
+
+IMAGE = {'id': 'ami-00000001', 'type': 'machine', 'kernel_id': 'aki-00000001',
+         'displayName': 'fake-oneiric', 'name': 'fake-oneiric'}
+
+ZONE = 'nova'
+
+
+def _parse_spec(spec):
+    """
+    Parse "name=value,name=value" into a dictionary.
+    """
+    values = {}
+    for part in (spec or '').split(','):
+        if not part.strip():
+            continue
+        name, value = part.split('=', 1)
+        values[name.strip()] = value.strip()
+    return values
+
+
+class LatencyModel(object):
+    """
+    How long each kind of transition, and each API call, takes.
+    """
+    def __init__(self, distributions=None, scale=1.0):
+        self.distributions = dict(DEFAULT_LATENCIES)
+        self.distributions.update(distributions or {})
+        self.scale = scale
+
+    def sample(self, name):
+        """
+        Draw a latency, in seconds, for the named transition.
+        """
+        spec = self.distributions.get(name, 'const:0').split(':')
+        kind, params = spec[0], [float(p) for p in spec[1:]]
+        if kind == 'const':
+            value = params[0]
+        elif kind == 'uniform':
+            value = random.uniform(params[0], params[1])
+        elif kind == 'normal':
+            value = random.normalvariate(params[0], params[1])
+        elif kind == 'lognormal':
+            value = random.lognormvariate(math.log(params[0]), params[1])
+        else:
+            raise Exception("Unknown latency distribution %s for %s" %
+                            (kind, name))
+        return max(0, value) * self.scale
+
+
+class ErrorModel(object):
+    """
+    How often API calls fail, and how often new resources end up in the
+    error state.
+    """
+    def __init__(self, rates=None):
+        self.rates = dict((name, float(rate)) for name, rate in
+                          (rates or {}).items())
+
+    def fails(self, name):
+        rate = self.rates.get(name)
+        if rate == None and '.' not in name:
+            rate = self.rates.get('*')
+        return random.random() < (rate or 0)
+
+
+def _ec2_error(status, code, message):
+    body = ('<?xml version="1.0"?><Response><Errors><Error><Code>%s</Code>'
+            '<Message>%s</Message></Error></Errors><RequestID>fake'
+            '</RequestID></Response>' % (code, message))
+    return boto.exception.EC2ResponseError(status, code, body)
+
+
+def _not_found(kind, resource_id):
+    code = {'instance': 'InvalidInstanceID.NotFound',
+            'volume': 'InvalidVolume.NotFound',
+            'snapshot': 'InvalidSnapshot.NotFound'}[kind]
+    return _ec2_error(400, code, "%s %s not found" % (kind, resource_id))
+
+
+def _ids(ids):
+    """
+    Turn the resource ids given to an API call into a list. Like boto, a
+    single id may be given on its own, and like nova, an id may be given as
+    boto's description of the resource, such as Instance:i-00000001.
+    """
+    if ids == None:
+        return []
+    if isinstance(ids, basestring):
+        ids = [ids]
+    return [i.split(':')[-1] for i in ids]
+
+
+class FakeObject(object):
+    """
+    Stands in for the boto objects describing resources.
+    """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __repr__(self):
+        return '%s:%s' % (self.__class__.__name__,
+                          getattr(self, 'id', getattr(self, 'name', '')))
+
+
+class FakeCloud(object):
+    """
+    The state of the fake cloud, kept in state_dir and shared between
+    processes.
+    """
+    def __init__(self, state_dir, latency=None, errors=None,
+                 gb=DEFAULT_GB, serials=True):
+        self.state_dir = state_dir
+        self.latency = latency or LatencyModel()
+        self.errors = errors or ErrorModel()
+        self.gb = gb
+        self.serials = serials
+        self._lock = threading.Lock()
+        self._settler = None
+        self._stop = threading.Event()
+        for d in ['volumes', 'snapshots', 'instances']:
+            path = os.path.join(state_dir, d)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise
+
+    def _path(self, kind, resource_id):
+        return os.path.join(self.state_dir, kind + 's', resource_id)
+
+    def _update(self, change=None):
+        """
+        Read the state, holding a lock on it so that other processes do not
+        change it at the same time, move resources that are due on to their
+        next state, and call change(state) if given. The state is written
+        back if anything changed, even when change raises: the effects of
+        the resources that moved on have already happened. Returns what
+        change returns.
+        """
+        path = os.path.join(self.state_dir, 'state.json')
+        with self._lock:
+            with open(path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(path) as fd:
+                        state = json.load(fd)
+                except (IOError, ValueError):
+                    state = {'next_id': 1, 'instance': {}, 'volume': {},
+                             'snapshot': {}, 'keypairs': [],
+                             'addresses': {}}
+                changed = self._settle(state)
+                try:
+                    result = None
+                    if change != None:
+                        result = change(state)
+                        changed = True
+                finally:
+                    if changed:
+                        with open(path + '.tmp', 'w') as fd:
+                            json.dump(state, fd)
+                        os.rename(path + '.tmp', path)
+                return result
+
+    def _start_settling(self):
+        """
+        Start the thread that moves resources on to their next state when
+        they are due, even when nothing is calling the API.
+        """
+        with self._lock:
+            if self._settler != None:
+                return
+            self._settler = threading.Thread(target=self._settle_forever)
+            self._settler.daemon = True
+            self._settler.start()
+        atexit.register(self._stop_settling)
+
+    def _stop_settling(self):
+        # Stop before the interpreter starts tearing down modules
+        self._stop.set()
+        self._settler.join(1)
+
+    def _settle_forever(self):
+        while not self._stop.is_set():
+            try:
+                self._update()
+            except Exception as e:
+                print "Fake cloud failed to update its state: %s" % e
+            self._stop.wait(SETTLE_INTERVAL)
+
+    def _schedule(self, resource, transition, status, effect=None):
+        """
+        Move resource to status, and call the effect, once the time the
+        latency model gives for transition has passed.
+        """
+        resource['next'] = {'time': time.time() +
+                                    self.latency.sample(transition),
+                            'status': status,
+                            'effect': effect}
+
+    def _settle(self, state):
+        """
+        Move every resource that is due on to its next state. Returns
+        whether anything changed.
+        """
+        now = time.time()
+        changed = False
+        for kind in ['instance', 'volume', 'snapshot']:
+            for resource in state[kind].values():
+                step = resource.get('next')
+                if step == None or step['time'] > now:
+                    continue
+                del resource['next']
+                resource['status'] = step['status']
+                if step['effect'] != None:
+                    getattr(self, '_' + step['effect'])(state, resource)
+                changed = True
+            if kind == 'instance':
+                for resource in state[kind].values():
+                    if resource['status'] == 'terminated' and \
+                            now - resource['changed'] > TERMINATED_TTL:
+                        del state[kind][resource['id']]
+                        changed = True
+        return changed
+
+    def _new_id(self, state, prefix):
+        state['next_id'] += 1
+        return '%s-%08x' % (prefix, state['next_id'])
+
+    def _get(self, state, kind, resource_id):
+        try:
+            return state[kind][resource_id]
+        except KeyError:
+            raise _not_found(kind, resource_id)
+
+    # The effects of transitions, called with the state locked
+
+    def _boot(self, state, instance):
+        root = self._path('instance', instance['id'])
+        os.makedirs(os.path.join(root, 'dev'))
+        with open(os.path.join(root, 'dev', 'vda'), 'w') as fd:
+            fd.truncate(self.gb)
+
+    def _terminate(self, state, instance):
+        instance['changed'] = time.time()
+        for volume in state['volume'].values():
+            if volume['instance_id'] == instance['id']:
+                volume.update(status='available', instance_id=None,
+                              device=None, guest_device=None)
+                volume.pop('next', None)
+        for ip, instance_id in state['addresses'].items():
+            if instance_id == instance['id']:
+                state['addresses'][ip] = None
+        shutil.rmtree(self._path('instance', instance['id']),
+                      ignore_errors=True)
+
+    def _guest_device(self, volume):
+        """
+        Return the paths of the device file and serial number file of a
+        volume attached to an instance.
+        """
+        root = self._path('instance', volume['instance_id'])
+        name = volume['guest_device']
+        return (os.path.join(root, 'dev', name),
+                os.path.join(root, 'sys', 'block', name, 'serial'))
+
+    def _attach(self, state, volume):
+        # The guest names the device itself, taking the first free name
+        root = self._path('instance', volume['instance_id'])
+        in_use = os.listdir(os.path.join(root, 'dev'))
+        volume['guest_device'] = [name for name in
+                                  ['vd' + chr(c) for c in
+                                   range(ord('a'), ord('z') + 1)]
+                                  if name not in in_use][0]
+        device, serial = self._guest_device(volume)
+        if self.serials:
+            if not os.path.isdir(os.path.dirname(serial)):
+                os.makedirs(os.path.dirname(serial))
+            with open(serial, 'w') as fd:
+                fd.write(volume['id'][:20] + '\n')
+        os.symlink(self._path('volume', volume['id']), device)
+
+    def _detach(self, state, volume):
+        device, serial = self._guest_device(volume)
+        for path in [device, serial]:
+            if os.path.lexists(path):
+                os.unlink(path)
+        volume.update(instance_id=None, device=None, guest_device=None)
+
+    def _delete(self, state, resource):
+        path = self._path(resource['kind'], resource['id'])
+        if os.path.exists(path):
+            os.unlink(path)
+        del state[resource['kind']][resource['id']]
+
+    def _copy(self, source, dest, size=None):
+        if source == None:
+            with open(dest, 'w') as fd:
+                fd.truncate(size)
+        else:
+            subprocess.check_call(['cp', '--sparse=always', source, dest])
+
+    # The API
+
+    def call(self, method, change):
+        """
+        Make an API call: wait for the call's latency, maybe fail it, and
+        then apply change to the state.
+        """
+        self._start_settling()
+        time.sleep(self.latency.sample('api'))
+        if self.errors.fails(method):
+            raise _ec2_error(503, 'ServiceUnavailable',
+                             "Injected failure of %s" % method)
+        return self._update(change)
+
+    def ssh_connect(self, ip, user):
+        """
+        Connect to the instance with the public address ip, refusing the
+        connection as a booting instance would until it is running.
+        """
+        def find(state):
+            instance_id = state['addresses'].get(ip)
+            if instance_id == None or \
+                    state['instance'][instance_id]['status'] != 'running':
+                return None
+            return instance_id
+        instance_id = self._update(find)
+        if instance_id == None:
+            raise socket.error(errno.ECONNREFUSED, "Connection refused")
+        return FakeSSHClient(self._path('instance', instance_id), user)
+
+
+class FakeEC2Connection(object):
+    """
+    Stands in for the boto EC2 connection euca2ools makes, implementing the
+    calls the tests use on a FakeCloud.
+    """
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def _describe(self, kind, ids, describe):
+        ids = _ids(ids)
+
+        def change(state):
+            wanted = ids or state[kind].keys()
+            return [describe(state, self.cloud._get(state, kind, i))
+                    for i in wanted]
+        return self.cloud.call('describe_%ss' % kind, change)
+
+    def _instance(self, state, instance):
+        return FakeObject(id=instance['id'], state=instance['status'],
+                          image_id=instance['image_id'],
+                          key_name=instance['key_name'],
+                          instance_type=instance['instance_type'],
+                          placement=ZONE,
+                          ip_address=instance['ip_address'],
+                          private_ip_address=instance['ip_address'],
+                          public_dns_name=instance['ip_address'])
+
+    def _volume(self, state, volume):
+        return FakeObject(id=volume['id'], status=volume['status'],
+                          size=volume['size'], zone=ZONE,
+                          snapshot_id=volume['snapshot_id'],
+                          create_time=volume['create_time'],
+                          attach_data=FakeObject(
+                                instance_id=volume['instance_id'],
+                                device=volume['device'],
+                                status='attached' if volume['instance_id']
+                                                  else None))
+
+    def _snapshot(self, state, snapshot):
+        return FakeObject(id=snapshot['id'], status=snapshot['status'],
+                          volume_id=snapshot['volume_id'],
+                          volume_size=snapshot['size'],
+                          progress='100%' if snapshot['status'] ==
+                                             'available' else '0%',
+                          start_time=snapshot['create_time'])
+
+    def get_all_images(self, *args, **kwargs):
+        return self.cloud.call('get_all_images',
+                               lambda state: [FakeObject(**IMAGE)])
+
+    def get_all_zones(self, *args, **kwargs):
+        return self.cloud.call('get_all_zones',
+                               lambda state: [FakeObject(name=ZONE)])
+
+    def create_key_pair(self, key_name):
+        key = RSAKey.generate(1024)
+        material = StringIO()
+        key.write_private_key(material)
+
+        def change(state):
+            if key_name in state['keypairs']:
+                raise _ec2_error(400, 'InvalidKeyPair.Duplicate',
+                                 "Key pair %s already exists" % key_name)
+            state['keypairs'].append(key_name)
+            return FakeObject(name=key_name, material=material.getvalue())
+        return self.cloud.call('create_key_pair', change)
+
+    def delete_key_pair(self, key_name):
+        def change(state):
+            if key_name in state['keypairs']:
+                state['keypairs'].remove(key_name)
+            return True
+        return self.cloud.call('delete_key_pair', change)
+
+    def get_all_key_pairs(self, *args, **kwargs):
+        return self.cloud.call('get_all_key_pairs',
+                               lambda state: [FakeObject(name=name) for name
+                                              in state['keypairs']])
+
+    def run_instances(self, image_id, min_count=1, max_count=1,
+                      key_name=None, instance_type=None, **kwargs):
+        def change(state):
+            instances = []
+            for i in xrange(max_count):
+                instance = {'id': self.cloud._new_id(state, 'i'),
+                            'status': 'pending', 'image_id': image_id,
+                            'key_name': key_name,
+                            'instance_type': instance_type,
+                            'ip_address': None, 'changed': time.time()}
+                status = 'running'
+                if self.cloud.errors.fails('instance.start'):
+                    status = 'error'
+                self.cloud._schedule(instance, 'instance.start', status,
+                                     'boot' if status == 'running' else None)
+                state['instance'][instance['id']] = instance
+                instances.append(self._instance(state, instance))
+            return FakeObject(id=self.cloud._new_id(state, 'r'),
+                              instances=instances)
+        return self.cloud.call('run_instances', change)
+
+    def get_all_instances(self, instance_ids=None, *args, **kwargs):
+        instances = self._describe('instance', instance_ids, self._instance)
+        return [FakeObject(id='r-%s' % instance.id[2:], instances=[instance])
+                for instance in instances]
+
+    def terminate_instances(self, instance_ids):
+        def change(state):
+            for instance_id in _ids(instance_ids):
+                instance = self.cloud._get(state, 'instance', instance_id)
+                if instance['status'] in ('shutting-down', 'terminated'):
+                    continue
+                instance['status'] = 'shutting-down'
+                self.cloud._schedule(instance, 'instance.terminate',
+                                     'terminated', 'terminate')
+            return True
+        return self.cloud.call('terminate_instances', change)
+
+    def get_console_output(self, instance):
+        instance_id = getattr(instance, 'id', instance)
+
+        def change(state):
+            status = self.cloud._get(state, 'instance', instance_id)['status']
+            output = ''
+            if status == 'running':
+                output = 'cloud-init boot finished\n'
+            return FakeObject(instance_id=instance_id, output=output)
+        return self.cloud.call('get_console_output', change)
+
+    def allocate_address(self):
+        def change(state):
+            for n in xrange(1, 65536):
+                ip = '198.18.%d.%d' % (n // 256, n % 256)
+                if ip not in state['addresses']:
+                    state['addresses'][ip] = None
+                    return FakeObject(public_ip=ip, instance_id=None)
+            raise _ec2_error(400, 'AddressLimitExceeded',
+                             "No more addresses")
+        return self.cloud.call('allocate_address', change)
+
+    def associate_address(self, instance_id, public_ip):
+        def change(state):
+            instance = self.cloud._get(state, 'instance', instance_id)
+            state['addresses'][public_ip] = instance_id
+            instance['ip_address'] = public_ip
+            return True
+        return self.cloud.call('associate_address', change)
+
+    def disassociate_address(self, public_ip):
+        def change(state):
+            instance_id = state['addresses'].get(public_ip)
+            if instance_id in state['instance']:
+                state['instance'][instance_id]['ip_address'] = None
+            state['addresses'][public_ip] = None
+            return True
+        return self.cloud.call('disassociate_address', change)
+
+    def release_address(self, public_ip):
+        def change(state):
+            state['addresses'].pop(public_ip, None)
+            return True
+        return self.cloud.call('release_address', change)
+
+    def get_all_addresses(self, *args, **kwargs):
+        return self.cloud.call('get_all_addresses',
+                               lambda state: [FakeObject(public_ip=ip,
+                                                         instance_id=i)
+                                              for ip, i in
+                                              state['addresses'].items()])
+
+    def create_volume(self, size, zone, snapshot=None):
+        def change(state):
+            source = None
+            volume_size = size
+            if snapshot != None:
+                source = self.cloud._path('snapshot', snapshot)
+                volume_size = volume_size or \
+                        self.cloud._get(state, 'snapshot', snapshot)['size']
+            volume = {'id': self.cloud._new_id(state, 'vol'), 'kind': 'volume',
+                      'status': 'creating', 'size': volume_size,
+                      'snapshot_id': snapshot, 'instance_id': None,
+                      'device': None, 'create_time': time.time()}
+            self.cloud._copy(source, self.cloud._path('volume', volume['id']),
+                             volume_size * self.cloud.gb)
+            status = 'available'
+            if self.cloud.errors.fails('volume.create'):
+                status = 'error'
+            self.cloud._schedule(volume, 'volume.create', status)
+            state['volume'][volume['id']] = volume
+            return self._volume(state, volume)
+        return self.cloud.call('create_volume', change)
+
+    def get_all_volumes(self, volume_ids=None, *args, **kwargs):
+        return self._describe('volume', volume_ids, self._volume)
+
+    def delete_volume(self, volume_id):
+        def change(state):
+            volume = self.cloud._get(state, 'volume', volume_id)
+            if volume['status'] not in ('available', 'error'):
+                raise _ec2_error(400, 'VolumeInUse',
+                                 "Volume %s is %s" % (volume_id,
+                                                      volume['status']))
+            volume['status'] = 'deleting'
+            self.cloud._schedule(volume, 'volume.delete', 'deleted',
+                                 'delete')
+            return True
+        return self.cloud.call('delete_volume', change)
+
+    def attach_volume(self, volume_id, instance_id, device):
+        def change(state):
+            volume = self.cloud._get(state, 'volume', volume_id)
+            instance = self.cloud._get(state, 'instance', instance_id)
+            if volume['status'] != 'available':
+                raise _ec2_error(400, 'IncorrectState',
+                                 "Volume %s is %s" % (volume_id,
+                                                      volume['status']))
+            if instance['status'] != 'running':
+                raise _ec2_error(400, 'IncorrectInstanceState',
+                                 "Instance %s is %s" % (instance_id,
+                                                        instance['status']))
+            for other in state['volume'].values():
+                if other['instance_id'] == instance_id and \
+                        other['device'] == device:
+                    raise _ec2_error(400, 'InvalidDevice',
+                                     "%s is already in use" % device)
+            volume.update(status='attaching', instance_id=instance_id,
+                          device=device)
+            self.cloud._schedule(volume, 'volume.attach', 'in-use',
+                                 'attach')
+            return True
+        return self.cloud.call('attach_volume', change)
+
+    def detach_volume(self, volume_id, instance_id=None, force=False):
+        def change(state):
+            volume = self.cloud._get(state, 'volume', volume_id)
+            if volume['status'] != 'in-use':
+                raise _ec2_error(400, 'IncorrectState',
+                                 "Volume %s is %s" % (volume_id,
+                                                      volume['status']))
+            volume['status'] = 'detaching'
+            self.cloud._schedule(volume, 'volume.detach', 'available',
+                                 'detach')
+            return True
+        return self.cloud.call('detach_volume', change)
+
+    def create_snapshot(self, volume_id, description=None):
+        def change(state):
+            volume = self.cloud._get(state, 'volume', volume_id)
+            snapshot = {'id': self.cloud._new_id(state, 'snap'),
+                        'kind': 'snapshot', 'status': 'creating',
+                        'volume_id': volume_id, 'size': volume['size'],
+                        'create_time': time.time()}
+            # The snapshot holds what the volume holds now
+            self.cloud._copy(self.cloud._path('volume', volume_id),
+                             self.cloud._path('snapshot', snapshot['id']))
+            status = 'available'
+            if self.cloud.errors.fails('snapshot.create'):
+                status = 'error'
+            self.cloud._schedule(snapshot, 'snapshot.create', status)
+            state['snapshot'][snapshot['id']] = snapshot
+            return self._snapshot(state, snapshot)
+        return self.cloud.call('create_snapshot', change)
+
+    def get_all_snapshots(self, snapshot_ids=None, *args, **kwargs):
+        return self._describe('snapshot', snapshot_ids, self._snapshot)
+
+    def delete_snapshot(self, snapshot_id):
+        def change(state):
+            snapshot = self.cloud._get(state, 'snapshot', snapshot_id)
+            snapshot['status'] = 'deleting'
+            self.cloud._schedule(snapshot, 'snapshot.delete', 'deleted',
+                                 'delete')
+            return True
+        return self.cloud.call('delete_snapshot', change)
+
+
+def fake_cloud_enabled():
+    return bool(os.environ.get(FAKE_CLOUD_ENV))
+
+
+_fake_cloud = None
+_fake_cloud_lock = threading.Lock()
+
+
+def get_fake_cloud():
+    """
+    Get the FakeCloud in the directory named by NOVA_VOLUME_TEST_FAKE_CLOUD,
+    set up from the environment as described above.
+    """
+    global _fake_cloud
+    with _fake_cloud_lock:
+        if _fake_cloud == None:
+            latency = LatencyModel(
+                    _parse_spec(os.environ.get(
+                                    'NOVA_VOLUME_TEST_FAKE_LATENCY')),
+                    float(os.environ.get('NOVA_VOLUME_TEST_FAKE_TIME_SCALE',
+                                         1.0)))
+            errors = ErrorModel(_parse_spec(os.environ.get(
+                                    'NOVA_VOLUME_TEST_FAKE_ERRORS')))
+            _fake_cloud = FakeCloud(
+                    os.path.expanduser(os.environ[FAKE_CLOUD_ENV]),
+                    latency, errors,
+                    int(os.environ.get('NOVA_VOLUME_TEST_FAKE_GB',
+                                       DEFAULT_GB)),
+                    os.environ.get('NOVA_VOLUME_TEST_FAKE_SERIALS',
+                                   '1') != '0')
+        return _fake_cloud
@@ -0,0 +1,157 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A stand-in for an ssh connection to a VM instance, used with the fake cloud.
+
+Commands are run on the test host, in a shell, with the guest agent pointed
+at the directory that plays the instance's root file system, so that the
+files the fake cloud puts in its dev directory act as the instance's block
+devices.
+"""
+import os
+import os.path
+import pipes
+import shutil
+import subprocess
+import sys
+import threading
+from tracing import get_tracer
+
+
+class FakeChannel(object):
+    """
+    The channel of a command run by FakeSSHClient, which is the process
+    running it.
+    """
+    def __init__(self, proc):
+        self.proc = proc
+
+    def shutdown_write(self):
+        self.proc.stdin.close()
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        if self.proc.poll() == None:
+            try:
+                self.proc.terminate()
+            except OSError:
+                pass
+        self.proc.wait()
+
+
+class FakeStream(object):
+    """
+    One of the standard streams of a command, with the channel attribute
+    that paramiko's streams have.
+    """
+    def __init__(self, fd, channel):
+        self._fd = fd
+        self.channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self._fd, name)
+
+
+class FakeSFTPClient(object):
+    """
+    The few SFTP operations the harness uses, carried out on the test host.
+    """
+    def stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError as e:
+            # paramiko raises IOError for missing files
+            raise IOError(e.errno, e.strerror, path)
+
+    def put(self, localpath, remotepath):
+        shutil.copyfile(localpath, remotepath)
+
+    def rename(self, oldpath, newpath):
+        os.rename(oldpath, newpath)
+
+    def close(self):
+        pass
+
+
+class FakeTransport(object):
+    def __init__(self, username):
+        self.username = username
+
+    def get_username(self):
+        return self.username
+
+    def is_active(self):
+        return True
+
+
+class FakeSSHClient(object):
+    """
+    Runs commands for the instance whose root file system is played by the
+    directory root.
+    """
+    def __init__(self, root, username='root'):
+        self.root = root
+        self.username = username
+        self._lock = threading.Lock()
+        self._channels = []
+
+    def _local_command(self, command):
+        """
+        Turn a command meant for the instance into one for the test host.
+        Everything runs as the user running the tests, and python is
+        whichever python is running them.
+        """
+        if command.startswith('sudo '):
+            command = command[len('sudo '):]
+        if command.startswith('/usr/bin/python'):
+            command = pipes.quote(sys.executable) + \
+                        command[len('/usr/bin/python'):]
+        return command
+
+    def exec_command(self, command):
+        env = dict(os.environ, NOVA_VOLUME_TEST_AGENT_ROOT=self.root)
+        with get_tracer().span('ssh.exec', self.root, command=command[:200]):
+            proc = subprocess.Popen(self._local_command(command), shell=True,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    close_fds=True, env=env)
+        channel = FakeChannel(proc)
+        with self._lock:
+            self._channels.append(channel)
+        return (FakeStream(proc.stdin, channel),
+                FakeStream(proc.stdout, channel),
+                FakeStream(proc.stderr, channel))
+
+    def open_sftp(self):
+        return FakeSFTPClient()
+
+    def get_transport(self):
+        return FakeTransport(self.username)
+
+    def close(self):
+        """
+        Stop every command still running.
+        """
+        with self._lock:
+            channels = self._channels
+            self._channels = []
+        for channel in channels:
+            channel.close()
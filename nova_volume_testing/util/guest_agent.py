@@ -0,0 +1,226 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Host side of the agent that runs on VM instances.
+
+The agent, nova_volume_testing/guest/agent.py, is copied onto the instance
+once and then kept running, taking JSON requests over a single ssh channel.
+"""
+import hashlib
+import json
+import os.path
+import threading
+import time
+from tracing import get_tracer
+
+
+AGENT_SOURCE = os.path.join(os.path.dirname(os.path.dirname(
+                                os.path.abspath(__file__))),
+                            'guest', 'agent.py')
+
+
+class GuestAgentError(Exception):
+    """
+    The agent failed to carry out a request.
+    """
+    pass
+
+
+class GuestAgent(object):
+    """
+    A connection to the agent running on a VM instance.
+    """
+    def __init__(self, sshclient, python='sudo /usr/bin/python'):
+        """
+        Install the agent on the instance at the other end of sshclient, if
+        it is not already there, and start it.
+        """
+        self.sshclient = sshclient
+        self.python = python
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.remote_path = self._install()
+
+        # Use sudo since we will be accessing raw devices. If we are
+        # connected as root then sudo will silently just work, and if we are
+        # connected as user ubuntu then passwordless sudo should be enabled.
+        cmd = "%s -u %s" % (python, self.remote_path)
+        self._stdin, self._stdout, self._stderr = \
+                self.sshclient.exec_command(cmd)
+
+    def _install(self):
+        """
+        Copy the agent onto the instance. The remote file name includes a
+        digest of the agent, so an instance that already has this version
+        of the agent is not sent it again.
+        """
+        with open(AGENT_SOURCE) as fd:
+            source = fd.read()
+        digest = hashlib.md5(source).hexdigest()[:12]
+        remote_path = '/tmp/nova_volume_test_agent_%s.py' % digest
+
+        sftp = self.sshclient.open_sftp()
+        try:
+            try:
+                sftp.stat(remote_path)
+            except IOError:
+                sftp.put(AGENT_SOURCE, remote_path + '.tmp')
+                sftp.rename(remote_path + '.tmp', remote_path)
+        finally:
+            sftp.close()
+        return remote_path
+
+    def call(self, op, **args):
+        """
+        Ask the agent to perform op with the given arguments and return the
+        result.
+        """
+        with get_tracer().span('agent.%s' % op, args.get('device')):
+            with self._lock:
+                self._next_id += 1
+                request = {'id': self._next_id, 'op': op, 'args': args}
+                self._stdin.write(json.dumps(request) + '\n')
+                self._stdin.flush()
+                line = self._stdout.readline()
+
+            if not line:
+                raise GuestAgentError("Agent exited while running %s: %s" %
+                                      (op, self._stderr.read()))
+            reply = json.loads(line)
+            if not reply['ok']:
+                raise GuestAgentError("Agent failed to run %s: %s" %
+                                      (op, reply['error']))
+            return reply['result']
+
+    def watch_devices(self):
+        """
+        Start a second copy of the agent that reports changes to the
+        instance's block devices, and return a DeviceWatcher for it.
+        """
+        return DeviceWatcher(self.sshclient,
+                             "%s -u %s --watch" % (self.python,
+                                                   self.remote_path))
+
+    def close(self):
+        """
+        Stop the agent.
+        """
+        channel = self._stdin.channel
+        # Closing stdin tells the agent to exit
+        channel.shutdown_write()
+        channel.close()
+
+
+class DeviceWatcher(object):
+    """
+    The block devices on a VM instance, kept up to date by the events sent
+    by an agent started with --watch.
+    """
+    def __init__(self, sshclient, cmd):
+        self._cond = threading.Condition()
+        self._devices = None
+        # When the devices last changed, as seen by the host
+        self._changed = None
+        self._error = None
+        self._stdin, self._stdout, self._stderr = sshclient.exec_command(cmd)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """
+        Apply each event from the agent to the list of devices, until the
+        agent exits.
+        """
+        while True:
+            line = self._stdout.readline()
+            now = time.time()
+            with self._cond:
+                if not line:
+                    self._error = "Device watcher exited: %s" % \
+                            self._stderr.read()
+                    self._cond.notify_all()
+                    return
+                event = json.loads(line)
+                if event['event'] == 'list':
+                    self._devices = dict((d['name'], d) for d in
+                                         event['devices'])
+                elif event['event'] == 'add':
+                    # The agent also reports a change to a device, e.g. a
+                    # new size, as an add. Update the device in place so
+                    # that it is still the same device to anything holding
+                    # it; one replaced under the same name is removed first.
+                    device = event['device']
+                    if device['name'] in self._devices:
+                        self._devices[device['name']].update(device)
+                    else:
+                        self._devices[device['name']] = device
+                elif event['event'] == 'remove':
+                    self._devices.pop(event['device']['name'], None)
+                self._changed = now
+                self._cond.notify_all()
+
+    def _current(self):
+        """
+        Return the devices and when they last changed, waiting for the
+        agent to list them if it has not yet done so.
+        """
+        with self._cond:
+            while self._devices == None and self._error == None:
+                self._cond.wait(1)
+            if self._error != None:
+                raise GuestAgentError(self._error)
+            return self._devices.values(), self._changed
+
+    def devices(self):
+        """
+        Return the list of block devices on the instance, as returned by the
+        agent's list_devices operation.
+        """
+        return self._current()[0]
+
+    def wait(self, check, timeout, recheck=1.0):
+        """
+        Call check() with the list of devices each time the devices change,
+        and at least every recheck seconds, until it returns something other
+        than None. Returns what check() returned and the time at which the
+        devices it was given last changed.
+
+        Returns (None, None) if timeout seconds pass first.
+        """
+        deadline = time.time() + timeout
+        while True:
+            devices, changed = self._current()
+            result = check(devices)
+            if result != None:
+                return result, changed
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None, None
+            with self._cond:
+                if self._changed == changed and self._error == None:
+                    self._cond.wait(min(remaining, recheck))
+
+    def close(self):
+        """
+        Stop the agent watching the devices.
+        """
+        channel = self._stdin.channel
+        channel.shutdown_write()
+        channel.close()
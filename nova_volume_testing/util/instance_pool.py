@@ -0,0 +1,224 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A pool of warm instances shared between scenarios.
+
+The pool boots its instances up front and records each one as a file in a
+pool directory. A scenario, which may be running in a different process,
+takes an instance by atomically renaming its file from the free directory to
+the busy directory, and gives it back by renaming it back again once the
+instance's devices have been checked and reset.
+
+Scenarios use get_instance() and release_instance(). When the environment
+variable NOVA_VOLUME_TEST_POOL_DIR is not set these simply create and delete
+a fresh instance, so scenarios behave as before when run without a pool.
+"""
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+from novaexerciser import Instance, get_status_poller
+from waiter import wait_for, WaitTimeout
+
+
+POOL_DIR_ENV = 'NOVA_VOLUME_TEST_POOL_DIR'
+
+
+def _pool_dirs(pool_dir):
+    return os.path.join(pool_dir, 'free'), os.path.join(pool_dir, 'busy')
+
+
+def _take_lease(pool_dir):
+    """
+    Take the lease on a free instance in the pool directory, returning
+    (instance_id, keypair_name), or None if no instance is free.
+    """
+    free_dir, busy_dir = _pool_dirs(pool_dir)
+    for instance_id in sorted(os.listdir(free_dir)):
+        try:
+            os.rename(os.path.join(free_dir, instance_id),
+                      os.path.join(busy_dir, instance_id))
+        except OSError:
+            # Somebody else got there first
+            continue
+        with open(os.path.join(busy_dir, instance_id)) as fd:
+            keypair_name = fd.read().strip()
+        return instance_id, keypair_name
+    return None
+
+
+def _return_lease(pool_dir, instance_id):
+    free_dir, busy_dir = _pool_dirs(pool_dir)
+    os.rename(os.path.join(busy_dir, instance_id),
+              os.path.join(free_dir, instance_id))
+
+
+def _drop_lease(pool_dir, instance_id):
+    free_dir, busy_dir = _pool_dirs(pool_dir)
+    os.unlink(os.path.join(busy_dir, instance_id))
+
+
+def reset_instance(instance):
+    """
+    Return an instance to the state it was in when it was booted. Any volume
+    still attached to it is detached.
+
+    Returns True if the instance is clean and can be reused.
+    """
+    start = time.time()
+    attached = [v for v in instance.ec2.euca.get_all_volumes() if
+                v.attach_data and v.attach_data.instance_id == instance.id]
+    for volume in attached:
+        print "Detaching leftover volume %s from pooled instance %s" % \
+                (volume.id, instance.id)
+        instance.ec2.euca.detach_volume(volume.id, instance.id, True)
+    for volume in attached:
+        wait_for('volume.detach', volume.id,
+                 lambda: get_status_poller().lookup(
+                            'volume', volume.id).status.split()[0],
+                 lambda status: status != "in-use")
+
+    def extra(devices):
+        return [d['name'] for d in devices if
+                d['name'] not in instance.base_devices]
+
+    def clean(devices):
+        if not extra(devices):
+            return True
+
+    if attached:
+        try:
+            instance.wait_for_device('pool.reset_detach', instance.id,
+                                     clean, start)
+        except WaitTimeout:
+            pass
+
+    extra_devices = extra(instance.list_devices())
+    if extra_devices:
+        print "Instance %s still has devices %s, not reusing it" % \
+                (instance.id, extra_devices)
+        return False
+
+    instance.reset_devices()
+    return True
+
+
+class InstancePool(object):
+    """
+    A set of instances booted ahead of time and handed out to scenarios.
+    """
+    def __init__(self, size, pool_dir=None):
+        """
+        Create an empty pool that will hold size instances. The instances
+        are not booted until start() is called.
+        """
+        self.size = size
+        if pool_dir == None:
+            pool_dir = tempfile.mkdtemp(prefix='nova-volume-pool-')
+        self.pool_dir = pool_dir
+        self.instances = {}
+        self._lock = threading.Lock()
+        for d in _pool_dirs(self.pool_dir):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    def _boot_one(self, errors):
+        try:
+            instance = Instance()
+        except Exception as e:
+            errors.append(e)
+            return
+        with self._lock:
+            self.instances[instance.id] = instance
+        free_dir, busy_dir = _pool_dirs(self.pool_dir)
+        with open(os.path.join(free_dir, instance.id), 'w') as fd:
+            fd.write(instance.keypair_name)
+
+    def start(self):
+        """
+        Boot the instances in the pool, all at the same time.
+        """
+        errors = []
+        threads = [threading.Thread(target=self._boot_one, args=(errors,))
+                   for n in xrange(self.size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors and not self.instances:
+            raise errors[0]
+        print "Instance pool %s has %d instances" % \
+                (self.pool_dir, len(self.instances))
+
+    def shutdown(self):
+        """
+        Destroy every instance in the pool, including any still handed out.
+        """
+        for instance in self.instances.values():
+            try:
+                instance.delete()
+            except Exception as e:
+                print "Failed to delete pooled instance %s: %s" % \
+                        (instance.id, e)
+        self.instances = {}
+        shutil.rmtree(self.pool_dir, ignore_errors=True)
+
+
+def get_instance():
+    """
+    Get an instance for a scenario to use. If a pool is available take an
+    instance from it, otherwise boot a new instance.
+    """
+    pool_dir = os.environ.get(POOL_DIR_ENV)
+    if pool_dir:
+        wait = int(os.environ.get('NOVA_VOLUME_TEST_POOL_WAIT', 300))
+        deadline = time.time() + wait
+        while True:
+            lease = _take_lease(pool_dir)
+            if lease != None:
+                instance = Instance(instance_id=lease[0],
+                                    keypair_name=lease[1])
+                instance.pooled = True
+                return instance
+            if time.time() >= deadline:
+                break
+            time.sleep(1)
+        print "No pooled instance became free, booting a new one"
+    return Instance()
+
+
+def release_instance(instance):
+    """
+    Finish with an instance returned by get_instance(). Pooled instances are
+    reset and returned to the pool, other instances are deleted.
+    """
+    pool_dir = os.environ.get(POOL_DIR_ENV)
+    if not (pool_dir and getattr(instance, 'pooled', False)):
+        instance.delete()
+        return
+
+    if reset_instance(instance):
+        instance.sshclient.close()
+        _return_lease(pool_dir, instance.id)
+    else:
+        # Leave the dirty instance out of the pool, the pool will delete it
+        # when it shuts down.
+        instance.sshclient.close()
+        _drop_lease(pool_dir, instance.id)
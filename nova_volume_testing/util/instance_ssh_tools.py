@@ -24,8 +24,30 @@ from paramiko.client import SSHClient
 from paramiko.rsakey import RSAKey
 from paramiko import SSHException
 from StringIO import StringIO
+import random
+import socket
 import subprocess
 import os
+import time
+from fake_cloud import fake_cloud_enabled, get_fake_cloud
+from tracing import get_tracer
+
+
+class TracedSSHClient(SSHClient):
+    """
+    An SSHClient whose connects and commands are traced.
+    """
+    host = None
+
+    def connect(self, hostname, *args, **kwargs):
+        self.host = hostname
+        with get_tracer().span('ssh.connect', hostname):
+            return SSHClient.connect(self, hostname, *args, **kwargs)
+
+    def exec_command(self, command, *args, **kwargs):
+        # Only starting the command is traced, its output is read later
+        with get_tracer().span('ssh.exec', self.host, command=command[:200]):
+            return SSHClient.exec_command(self, command, *args, **kwargs)
 
 
 def setup_ssh_connection(ip, key, user='root', port=22, timeout=10):
@@ -35,11 +57,13 @@ def setup_ssh_connection(ip, key, user='root', port=22, timeout=10):
     print "Attempting to setup ssh connection to %s@%s:%d" % (user, ip, port)
     if key is None:
         raise Exception("setup_ssh_connection: You didn't supply a key!")
+    if fake_cloud_enabled():
+        return get_fake_cloud().ssh_connect(ip, user)
 
     try:
         if os.getenv("BOCK_TEST_DEBUG", 0) > 0:
             paramiko.common.logging.basicConfig(level=paramiko.common.DEBUG)
-        client = SSHClient()
+        client = TracedSSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         client.connect(ip, port, user, pkey=key, timeout=timeout)
         print "SSH connection successful"
@@ -57,7 +81,7 @@ def setup_ssh_connection(ip, key, user='root', port=22, timeout=10):
 
         if stdout == 'Please login as the user "ubuntu" rather than the user "root".\n':
             print "New style ubuntu image found, using user ubuntu"
-            client = SSHClient()
+            client = TracedSSHClient()
             client.set_missing_host_key_policy(paramiko.WarningPolicy())
             client.connect(ip, port, "ubuntu", pkey=key, timeout=timeout)
             print "SSH connection successful"
@@ -74,6 +98,48 @@ def setup_ssh_connection(ip, key, user='root', port=22, timeout=10):
             raise Exception("SSH connection test failed")
     return client
 
+def wait_for_ssh_ready(ip, key, user='root', port=22, timeout=300,
+                       initial_delay=1, max_delay=16, connect_timeout=10):
+    """
+    Wait for the VM instance to accept ssh connections, and return a working
+    connection to it.
+
+    First check that the ssh port accepts TCP connections, then make a full
+    ssh connection, which is only returned once "echo YES" works over it.
+    Failed attempts are retried with exponential backoff, starting at
+    initial_delay seconds and capped at max_delay seconds, with random jitter
+    so that many instances booting at once do not probe in lock step. If the
+    instance is still not reachable after timeout seconds the last error is
+    raised.
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
+    with get_tracer().span('wait.ssh_ready', ip) as span:
+        while True:
+            try:
+                if not fake_cloud_enabled():
+                    sock = socket.create_connection((ip, port),
+                                                    connect_timeout)
+                    sock.close()
+                client = setup_ssh_connection(ip=ip, key=key, user=user,
+                                              port=port,
+                                              timeout=connect_timeout)
+                print "ssh to %s ready after %d attempts" % \
+                        (ip, span.retries + 1)
+                return client
+            except Exception as e:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print "ssh to %s not ready after %d attempts" % \
+                            (ip, span.retries + 1)
+                    raise
+                if isinstance(e, socket.error):
+                    print "ssh port on %s not open yet (%s)" % (ip, e)
+            time.sleep(min(random.uniform(delay / 2.0, delay), remaining))
+            delay = min(delay * 2, max_delay)
+            span.retries += 1
+
+
 def generate_keypair_files(filename, passphrase="", type="rsa"):
     print "Generating new ssh keypair %s" % (filename)
     cmd = ["ssh-keygen", "-f", str(filename), "-t", type, "-N", passphrase]
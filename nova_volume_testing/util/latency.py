@@ -0,0 +1,112 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Record how long operations take and summarise them as percentiles.
+"""
+import json
+import math
+import threading
+
+
+def percentile(values, pct):
+    """
+    Return the pct percentile of values, using the nearest rank method.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def summarise(values):
+    """
+    Return a dictionary of summary statistics for a list of latencies.
+    """
+    return {'count': len(values),
+            'min': min(values),
+            'mean': sum(values) / len(values),
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': max(values)}
+
+
+def ordered_names(names, order=None):
+    """
+    Return names sorted, except that those in the list order come first, in
+    the order given there.
+    """
+    order = [name for name in (order or []) if name in names]
+    return order + sorted(name for name in names if name not in order)
+
+
+def format_table(summaries, title="operation", unit="s", order=None):
+    """
+    Format a dictionary of summarise() results, keyed by name, as a table.
+    Rows are sorted by name, apart from the names in order, which come
+    first.
+    """
+    columns = ['count', 'min', 'mean', 'p50', 'p90', 'p99', 'max']
+    width = max([len(title)] + [len(name) for name in summaries])
+    lines = ["%-*s %6s %9s %9s %9s %9s %9s %9s" %
+             ((width, title) + tuple(columns))]
+    for name in ordered_names(summaries, order):
+        s = summaries[name]
+        lines.append("%-*s %6d " % (width, name, s['count']) +
+                     " ".join("%8.2f%s" % (s[c], unit) for c in columns[1:]))
+    return "\n".join(lines)
+
+
+class LatencyRecorder(object):
+    """
+    A thread safe collection of latency samples, in seconds, grouped by
+    operation name.
+    """
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds):
+        with self._lock:
+            self.samples.setdefault(operation, []).append(seconds)
+
+    def merge(self, samples):
+        """
+        Add the samples from another recorder's samples dictionary.
+        """
+        with self._lock:
+            for operation, values in samples.items():
+                self.samples.setdefault(operation, []).extend(values)
+
+    def summary(self):
+        with self._lock:
+            return dict((operation, summarise(values)) for
+                        operation, values in self.samples.items() if values)
+
+    def report(self):
+        return format_table(self.summary())
+
+    def dump(self, filename):
+        with self._lock:
+            with open(filename, 'w') as fd:
+                json.dump(self.samples, fd)
+
+    def load(self, filename):
+        with open(filename) as fd:
+            self.merge(json.load(fd))
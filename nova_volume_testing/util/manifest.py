@@ -0,0 +1,104 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Manifests of per extent digests of a volume's contents.
+
+A manifest is computed on the instance by reading the device once, and only
+the digests are sent back. Manifests can then be compared with each other,
+or with the manifest the volume is expected to have given the test patterns
+written to it, on the host without reading the device again.
+"""
+from nova_volume_testing.guest.agent import BLOCK_SIZE, PatternBuffer, \
+                                            digest, unpack_digests
+
+
+# Default size of the extents digested in a manifest
+EXTENT_SIZE = 1024 * 1024
+
+
+class Manifest(object):
+    """
+    The digest of each extent_size extent of the first length bytes of a
+    device. A digest of None means the contents of that extent are not
+    known, and it is skipped when comparing manifests.
+    """
+    def __init__(self, extent_size, length, digests):
+        self.extent_size = extent_size
+        self.length = length
+        self.digests = digests
+
+    @classmethod
+    def from_reply(cls, reply):
+        """
+        Build a manifest from the agent's reply to a manifest request.
+        """
+        return cls(reply['extent_size'], reply['length'],
+                   unpack_digests(reply['digests']))
+
+    @classmethod
+    def expected(cls, written, length, extent_size):
+        """
+        Build the manifest a device should have if it holds what the
+        ExtentMap written says was written to it.
+        """
+        patterns = {}
+        digests = []
+        for start in xrange(0, length, extent_size):
+            end = min(start + extent_size, length)
+            pieces = written.pieces(start, end)
+            if [p for p in pieces if p[2] == None]:
+                digests.append(None)
+                continue
+            data = []
+            for piece_start, piece_end, key in pieces:
+                if key not in patterns:
+                    patterns[key] = PatternBuffer(key, extent_size)
+                data.append(bytes(patterns[key].fill(
+                                piece_start // BLOCK_SIZE,
+                                piece_end - piece_start)))
+            digests.append(digest(''.join(data)))
+        return cls(extent_size, length, digests)
+
+    def diff(self, other):
+        """
+        Return the byte offsets of the extents that differ between this
+        manifest and other. Extents whose digest is unknown in either
+        manifest are not compared.
+        """
+        if self.extent_size != other.extent_size:
+            raise Exception("Cannot compare manifests with extent sizes "
+                            "%d and %d" % (self.extent_size,
+                                           other.extent_size))
+        differ = []
+        for i in xrange(min(len(self.digests), len(other.digests))):
+            mine, theirs = self.digests[i], other.digests[i]
+            if mine != None and theirs != None and mine != theirs:
+                differ.append(i * self.extent_size)
+        return differ
+
+    def known_ranges(self):
+        """
+        Return the [start, end) byte ranges of the extents whose digest is
+        known.
+        """
+        ranges = []
+        for i, d in enumerate(self.digests):
+            if d != None:
+                ranges.append([i * self.extent_size,
+                               min((i + 1) * self.extent_size, self.length)])
+        return ranges
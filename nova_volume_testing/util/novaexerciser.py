@@ -21,14 +21,33 @@ Interface to Nova and Euca tools for system tests.
 import boto
 import euca2ools
 import random
+import sys
+import threading
 import time
 import os
 import os.path
+from multiprocessing.pool import ThreadPool
 from paramiko import SSHException
+from connection_pool import ConnectionPool, PooledConnection
+from discovery_cache import get_discovery_cache
+from fake_cloud import FakeEC2Connection, fake_cloud_enabled, get_fake_cloud
+from registry import get_registry
+from extents import ExtentMap
+from guest_agent import GuestAgent
+from manifest import Manifest, EXTENT_SIZE
+from nova_volume_testing.guest.agent import BLOCK_SIZE, pattern_blocks
+from status_poller import StatusPoller
+from tracing import get_tracer
+from waiter import latencies, operation_timeout, wait_for, WaitTimeout
 from instance_ssh_tools import load_ssh_key_from_file,    \
                                load_ssh_key_from_keypair, \
                                generate_keypair_files,    \
-                               setup_ssh_connection
+                               setup_ssh_connection,      \
+                               wait_for_ssh_ready
+
+
+# The devices volumes are asked to be attached to an instance as
+ATTACH_DEVICES = ["/dev/vd" + chr(d) for d in range(ord('g'), ord('z'))]
 
 
 try:
@@ -39,59 +58,38 @@ except:
     novaclient_version = 'V1.0'
 
 
-#
-# These multiline strings are python scripts that are injected onto VM
-# instances to test volumes, and snapshots, on the instances. They are placed
-# here, at the head of the file, because they cannot be indented in line with
-# the functions where they are used. This makes the functions where theses
-# multiline strings are used more readable.
-#
-WRITE_PATTERN_SCRIPT = """
-#!/usr/bin/env python
-import os
-fd = os.open('{device}', os.O_RDWR)
-size = os.lseek(fd, 0, os.SEEK_END)
-os.lseek(fd, 0, os.SEEK_SET)
-data = ''.join(chr((i + {key_value}) % 255) for i in xrange(4096))
-for i in xrange(int((size / 4096) / (float(100)/{percentage_value}))):
-    os.write(fd, data)
-"""
+def _make_euca_connection():
+    if fake_cloud_enabled():
+        return FakeEC2Connection(get_fake_cloud())
+    return euca2ools.Euca2ool('ao:x:', compat=True).make_connection()
 
-CHECK_PATTERN_SCRIPT = """
-#!/usr/bin/env python
-import os
-check_str = ''.join(chr((i + {key_value}) % 255) for i in xrange(4096))
-result_str = "Pass"
-fd = os.open('{device}', os.O_RDONLY)
-size = os.lseek(fd, 0, os.SEEK_END)
-os.lseek(fd, 0, os.SEEK_SET)
-for i in xrange(int((size / 4096) / (float(100)/{percentage_value}))):
-    tst_str = os.read(fd, 4096)
-    if len(tst_str) == 4096 and tst_str != check_str:
-        result_str = "Fail sector %d of %d" % (i, size / 4096)
-        break
-print result_str
-"""
 
-CHECK_MOUNT_VOLUME = """
-#!/usr/bin/env python
-import os
-import subprocess
-res_str = 'Fail'
-mnt_dir = '/tmp/bocktest_mnt'
-if os.path.isdir(mnt_dir) == False:
-    os.makedirs(mnt_dir)
-try:
-    subprocess.check_call(['mount', '{device}', mnt_dir])
-    subprocess.check_call(['umount', mnt_dir])
-    os.rmdir(mnt_dir)
-    mount_status = 1
-    res_str = 'Pass'
-except:
-    res_str = 'Fail'
+def _bytes_per_gb():
+    """
+    The number of bytes in each GB of a volume's size, which the fake cloud
+    scales down.
+    """
+    if fake_cloud_enabled():
+        return get_fake_cloud().gb
+    return 1024 * 1024 * 1024
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def _get_connection_pool():
+    """
+    Get the pool of Euca API connections shared by every thread in this
+    process. Its size can be set with NOVA_VOLUME_TEST_CONNECTIONS.
+    """
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool == None:
+            size = int(os.environ.get('NOVA_VOLUME_TEST_CONNECTIONS', 8))
+            _connection_pool = ConnectionPool(_make_euca_connection, size)
+        return _connection_pool
 
-print res_str
-"""
 
 class EucaConnection(object):
     """
@@ -99,10 +97,10 @@ class EucaConnection(object):
     """
     def __init__(self):
         """
-        Initialise the objcet
+        Initialise the objcet. API calls made through self.euca use the
+        connections in the process wide pool.
         """
-        self.eucahandle = euca2ools.Euca2ool('ao:x:', compat=True)
-        self.euca = self.eucahandle.make_connection()
+        self.euca = PooledConnection(_get_connection_pool())
 
     def get_runnable_images(self):
         """
@@ -126,22 +124,100 @@ class EucaConnection(object):
 
         return image_list
 
+    def choose_image(self):
+        """
+        Choose the image to boot instances from, preferring the images we
+        know work. Returns the id and name of the image. The choice is kept
+        in the discovery cache.
+        """
+        def discover():
+            images = self.get_runnable_images()
+            preferred_images = ['Oneiric', 'Natty', 'natty_server_uec']
+            for preference in preferred_images:
+                for image in images:
+                    if preference in image.displayName:
+                        return [image.id, image.displayName]
+            return [images[0].id, images[0].displayName]
+
+        return get_discovery_cache().lookup('image', discover)
+
     def get_default_zone(self):
         """
-        Get the first availability zone on this nova instance
+        Get the first availability zone on this nova instance. The zones are
+        kept in the discovery cache.
         """
-        #FIXME: Clearly this should query the system
-        return "nova"
+        zones = get_discovery_cache().lookup('zones',
+                    lambda: [zone.name for zone in self.euca.get_all_zones()])
+        if not zones:
+            return "nova"
+        return zones[0]
+
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def get_connection():
+    """
+    Get the EucaConnection shared by every resource in this process.
+    """
+    global _connection
+    with _connection_lock:
+        if _connection == None:
+            _connection = EucaConnection()
+        return _connection
+
+
+_status_poller = None
+_status_poller_lock = threading.Lock()
+
+
+def get_status_poller():
+    """
+    Get the StatusPoller shared by every resource in this process. The poll
+    interval can be set with NOVA_VOLUME_TEST_POLL_INTERVAL.
+    """
+    global _status_poller
+    with _status_poller_lock:
+        if _status_poller == None:
+            ec2 = get_connection()
+
+            def describe_volumes(ids):
+                return dict((v.id, v) for v in
+                            ec2.euca.get_all_volumes(volume_ids=ids))
+
+            def describe_snapshots(ids):
+                return dict((s.id, s) for s in
+                            ec2.euca.get_all_snapshots(snapshot_ids=ids))
+
+            def describe_instances(ids):
+                return dict((i.id, i) for r in ec2.euca.get_all_instances(ids)
+                            for i in r.instances)
+
+            interval = float(os.environ.get('NOVA_VOLUME_TEST_POLL_INTERVAL',
+                                            0.5))
+            _status_poller = StatusPoller({'volume': describe_volumes,
+                                           'snapshot': describe_snapshots,
+                                           'instance': describe_instances},
+                                          interval)
+        return _status_poller
 
 
 class Instance(object):
     """
     Class representing an instance of a Nova VM
     """
-    def __init__(self):
+    kind = 'instance'
+
+    def __init__(self, instance_id=None, keypair_name=None):
         """
-        Create a new instance
+        Create a new instance, or if instance_id is supplied connect to an
+        existing instance that was started with the keypair keypair_name.
         """
+        if instance_id != None:
+            self._adopt(instance_id, keypair_name)
+            return
+
         # Create a short random tag to add to our keypair name so we hopefully
         # don't collide with anybody else running the testsuite under the same
         # nova account
@@ -153,7 +229,13 @@ class Instance(object):
 
         print("Using keypair name: %s" % self.keypair_name)
 
-        self.ec2 = EucaConnection()
+        # The phases of the boot, in order, each as (phase, start time, end
+        # time), and how long each phase took, in seconds
+        self.boot_phases = []
+        self.boot_times = {}
+        boot_start = phase_start = time.time()
+
+        self.ec2 = get_connection()
         self.keypair = self.ec2.euca.create_key_pair(self.keypair_name)
 
         keyfile = '%s.priv' % self.keypair_name
@@ -163,61 +245,164 @@ class Instance(object):
             fd.write(self.keypair.material)
 
         self.key = load_ssh_key_from_file(keyfile)
+        phase_start = self._boot_phase('keypair', phase_start)
 
-        images = self.ec2.get_runnable_images()
-        preferred_images = ['Oneiric', 'Natty', 'natty_server_uec']
-
-        self.image = None
-        for preference in preferred_images:
-            if self.image != None:
-                break
-            for image in images:
-                if preference in image.displayName:
-                    self.image = image
-                    break
-
-        if image != None:
-            self.image = image
-        else:
-            self.image = images[0]
+        try:
+            self.image_id, self.image_name = self.ec2.choose_image()
+            phase_start = self._boot_phase('image', phase_start)
 
-        print "Using image %s" % self.image.displayName
+            print "Using image %s" % self.image_name
 
-        # FIXME Automatic flavor selection requires using the nova api since
-        # the euca api doesn't appear to support enumerating the available
-        # flavors.
-        # self.flavor = self.get_flavor()
-        self.flavor = "standard.small"
+            # FIXME Automatic flavor selection requires using the nova api
+            # since the euca api doesn't appear to support enumerating the
+            # available flavors.
+            # self.flavor = self.get_flavor()
+            self.flavor = "standard.small"
 
-        print "Using image %s on instance type %s" % (self.image, self.flavor)
+            print "Using image %s on instance type %s" % (self.image_id,
+                                                          self.flavor)
 
-        self.reservation = self.ec2.euca.run_instances(self.image.id,
+            self.reservation = self.ec2.euca.run_instances(self.image_id,
                                                    min_count=1,
                                                    max_count=1,
                                                    key_name=self.keypair_name,
                                                    instance_type=self.flavor)
+            phase_start = self._boot_phase('run_instances', phase_start)
+        except:
+            self._delete_keypair()
+            raise
 
         self.instance = self.reservation.instances[0]
         self.id = self.instance.id
+        self.public_ip = None
         self.sshclient = None
-
-        self._free_devices = ["/dev/vd" + chr(d) for d in
-                                            range(ord('g'), ord('z'))]
-        #FIXME: Can we check what devices are actually free?
+        self._agent = None
+        self._device_watcher = None
+        self._agent_lock = threading.Lock()
+
+        self._device_lock = threading.Lock()
+        # Whether the hypervisor gives the instance's devices serial numbers,
+        # None until a volume has been attached. Until it is known they do,
+        # attaches are made one at a time so that each volume's device can
+        # be told apart from any other being attached.
+        self.serials = None
+        self._attach_lock = threading.Lock()
+        self.reset_devices()
+
+        # From here on the instance is deleted if the test fails
+        get_registry().register(self, keypair=self.keypair_name)
 
         print "Waiting for instance %s to start" % self.id
-        while self.status() == "pending":
-            time.sleep(2)
+        wait_for('instance.start', self.id, self.status,
+                 lambda status: status != "pending",
+                 error_states=('error', 'shutting-down', 'terminated'))
+        phase_start = self._boot_phase('pending', phase_start)
 
         self.public_ip = self._get_public_ip_address()
+        phase_start = self._boot_phase('public_ip', phase_start)
 
-        print "Waiting for instance %s to boot" % self.id
-        self.wait_for_console_shows_booted()
+        print "Waiting for instance %s to accept ssh" % self.id
+        ssh_timeout = int(os.environ.get('NOVA_VOLUME_TEST_SSH_TIMEOUT', 300))
+        try:
+            self.sshclient = wait_for_ssh_ready(self.public_ip, self.key,
+                                                user=self._ssh_user(),
+                                                timeout=ssh_timeout)
+            phase_start = self._boot_phase('ssh_ready', phase_start)
+        except Exception:
+            phase_start = self._boot_phase('ssh_failed', phase_start)
+            # The cached user may be the reason we could not connect
+            get_discovery_cache().invalidate(self._ssh_user_entry())
+            # Fall back to waiting for the console to say that the instance
+            # has booted, in case it is just slow
+            print "Instance %s not reachable by ssh, checking console" % \
+                    self.id
+            self.wait_for_console_shows_booted()
+            phase_start = self._boot_phase('console', phase_start)
+            self.sshclient = setup_ssh_connection(ip=self.public_ip,
+                                                  key=self.key)
+            phase_start = self._boot_phase('ssh_connect', phase_start)
+        get_discovery_cache().set(self._ssh_user_entry(),
+                            self.sshclient.get_transport().get_username())
+        self.boot_times['total'] = phase_start - boot_start
+
+        print "Instance %s booted in %.1fs (%s)" % \
+                (self.id, self.boot_times['total'],
+                 ", ".join("%s %.1fs" % (phase, end - start)
+                           for phase, start, end in self.boot_phases))
+        self.base_devices = self.get_dev_names()
+
+    def _boot_phase(self, phase, start):
+        """
+        Record that the named boot phase ran from start until now, and
+        return the time now, which is when the next phase starts.
+        """
+        end = time.time()
+        self.boot_phases.append((phase, start, end))
+        self.boot_times[phase] = end - start
+        latencies.record('boot.%s' % phase, end - start)
+        return end
 
-        print "Waiting 30 seconds for ssh to be started"
-        time.sleep(60)
-        self.sshclient = setup_ssh_connection(ip=self.public_ip, key=self.key)
+    def _adopt(self, instance_id, keypair_name):
+        """
+        Connect to an instance that is already running, using the private
+        key that was saved when the instance was created.
+        """
+        if keypair_name == None:
+            raise Exception("Usage: keypair_name must be supplied with "
+                            "instance_id")
+
+        self.keypair_name = keypair_name
+        self.keypair = None
+        self.key = load_ssh_key_from_file('%s.priv' % self.keypair_name)
+
+        self.ec2 = get_connection()
+        self.id = instance_id
+        # Adopted instances have already booted
+        self.boot_phases = []
+        self.boot_times = {}
+        self.sshclient = None
+        self._agent = None
+        self._device_watcher = None
+        self._agent_lock = threading.Lock()
+        self._device_lock = threading.Lock()
+        # Whether the hypervisor gives the instance's devices serial numbers,
+        # None until a volume has been attached. Until it is known they do,
+        # attaches are made one at a time so that each volume's device can
+        # be told apart from any other being attached.
+        self.serials = None
+        self._attach_lock = threading.Lock()
+        self.reset_devices()
+
+        if self.status() != "running":
+            raise Exception("Instance %s is not running" % self.id)
+        self.public_ip = self.instance.ip_address
+        self.image_id = self.instance.image_id
+
+        print "Using existing instance %s" % self.id
+        self.sshclient = setup_ssh_connection(ip=self.public_ip, key=self.key,
+                                              user=self._ssh_user())
+        self.base_devices = self.get_dev_names()
+
+    def _ssh_user_entry(self):
+        return 'ssh_user/%s' % self.image_id
+
+    def _ssh_user(self):
+        """
+        Get the user to log in to the instance as, which is the user that
+        worked last time for this image, or root if that is not known.
+        """
+        return get_discovery_cache().get(self._ssh_user_entry()) or 'root'
 
+    def reset_devices(self):
+        """
+        Forget which devices have been handed out, so that the instance can
+        be reused once every volume has been detached from it.
+        """
+        with self._device_lock:
+            self._free_devices = list(ATTACH_DEVICES)
+            # The devices on the instance that belong to attached volumes,
+            # mapped to the id of the volume
+            self.claimed_devices = {}
 
     def get_flavor(self):
         """
@@ -234,12 +419,13 @@ class Instance(object):
             #
             # Since we have nova client V1.1 get the list of flavors available.
             #
-            nova = novaclient.v1_1.Client(os.environ['NOVA_USERNAME'],
-                                          os.environ['NOVA_API_KEY'],
-                                          os.environ['NOVA_PROJECT_ID'],
-                                          os.environ['NOVA_URL'])
-            flavor_list = nova.flavors.list()
-            flavor_names = [flavor.name for flavor in flavor_list]
+            def discover():
+                nova = novaclient.v1_1.Client(os.environ['NOVA_USERNAME'],
+                                              os.environ['NOVA_API_KEY'],
+                                              os.environ['NOVA_PROJECT_ID'],
+                                              os.environ['NOVA_URL'])
+                return [flavor.name for flavor in nova.flavors.list()]
+            flavor_names = get_discovery_cache().lookup('flavors', discover)
 
         desired_flavor = os.environ.get('NOVA_VOLUME_TEST_FLAVOR',
                                         'standard.small')
@@ -286,43 +472,139 @@ class Instance(object):
         self.instance = self.reservation[0].instances[0]
         return public_ip
 
-    def copy_file(self, fname, file_txt):
+    @property
+    def agent(self):
+        """
+        The agent running on the instance, which is started the first time
+        it is needed.
+        """
+        with self._agent_lock:
+            if self._agent == None:
+                self._agent = GuestAgent(self.sshclient)
+            return self._agent
+
+    @property
+    def device_watcher(self):
         """
-        Push a file onto the instance with the given file name and containing
-        the text supplied.
+        The DeviceWatcher following the instance's block devices, which is
+        started the first time it is needed.
         """
-        cmd = "/bin/cat << EOF > " + fname + " " + file_txt + "\nEOF"
-        stdin, stdout, stderr = self.sshclient.exec_command(cmd)
+        agent = self.agent
+        with self._agent_lock:
+            if self._device_watcher == None:
+                self._device_watcher = agent.watch_devices()
+            return self._device_watcher
 
-    def run_python_file(self, fname):
+    def list_devices(self):
+        """
+        Get a list of the block devices on the instance, each a dictionary
+        holding its name, its size in bytes and its serial number.
         """
-        Run a python file on the target instance.
+        return self.device_watcher.devices()
+
+    def wait_for_device(self, operation, resource_id, check, since):
         """
-        # Use sudo since we will be accessing raw devices. If we are connected
-        # as root then sudo will silently just work, and if we are connected
-        # as user ubuntu then passwordless ssh should be enabled.
+        Wait for a change to the instance's block devices, as seen by the
+        kernel on the instance. check() is called with the list of devices
+        each time they change, until it returns something other than None,
+        which is returned.
 
-        # FIXME: spot sudo prompts / errors and raise an exception
-        # FIXME: check nothing gets printed to stderr, if anything does then
-        #        raise an exception
-        cmd = "sudo /usr/bin/python " + fname
-        stdin, stdout, stderr = self.sshclient.exec_command(cmd)
-        out_str = stdout.read().strip()
-        return out_str
+        The time from since until the change happened is recorded as the
+        latency of operation.
+        """
+        timeout = operation_timeout(operation)
+        with get_tracer().span('wait.%s' % operation, resource_id):
+            result, changed = self.device_watcher.wait(check, timeout)
+            if result == None:
+                raise WaitTimeout("%s of %s timed out after %ds" %
+                                  (operation, resource_id, timeout))
+        latencies.record(operation, max(0, changed - since))
+        return result
+
+    def get_devices(self):
+        """
+        Get a dictionary mapping the name of each block device on the
+        instance to its size in bytes.
+        """
+        return dict((dev['name'], dev['size']) for dev in
+                    self.list_devices())
+
+    def get_dev_names(self):
+        """
+        Get the list of block devices on the instance.
+        """
+        return self.get_devices().keys()
+
+    def check_test_patterns(self, specs):
+        """
+        Check the test patterns on several volumes attached to this instance
+        at the same time, in one request to the agent.
+
+        specs is a list of (volume, key, percentage, expected) tuples, where
+        key and percentage are as for Volume.check_test_pattern() and
+        expected is the result the check should give. Returns a list holding,
+        for each spec, True if the check gave the expected result.
+        """
+        requests = []
+        for volume, key, percentage, expected in specs:
+            if not volume.attached(self):
+                raise Exception("Usage: volume %s must be attached to %s to "
+                                "check a test pattern" % (volume.id, self.id))
+            requests.append({'op': 'check_pattern',
+                             'args': volume._check_args(percentage, key)})
+
+        replies = self.agent.call('batch', requests=requests)
+
+        results = []
+        for spec, request, reply in zip(specs, requests, replies):
+            volume, key, percentage, expected = spec
+            if not reply['ok']:
+                raise Exception("Checking pattern on %s failed: %s" %
+                                (volume.id, reply['error']))
+            passed = volume._check_done(request['args'], reply['result'])
+            results.append(passed == expected)
+        return results
 
     def status(self):
         """
         Return the status of the VM instance.
         """
-        self.instance = \
-                self.ec2.euca.get_all_instances([self.id])[0].  instances[0]
+        self.instance = get_status_poller().lookup('instance', self.id)
         return self.instance.state.split()[0]
 
     def next_device(self):
         """
-        Get the next available device for the list of free devices.
+        Get the next available device for the list of free devices, skipping
+        any that the instance already has.
+        """
+        with self._device_lock:
+            in_use = set(self.base_devices) | set(self.claimed_devices)
+            while self._free_devices:
+                device = self._free_devices.pop()
+                if device not in in_use:
+                    return device
+        raise Exception("No free devices left on instance %s" % self.id)
+
+    def claim_device(self, dev_name, volume_id):
+        """
+        Record that dev_name on the instance belongs to the volume volume_id.
+        Returns False if it already belongs to another volume.
+        """
+        with self._device_lock:
+            if self.claimed_devices.get(dev_name, volume_id) != volume_id:
+                return False
+            self.claimed_devices[dev_name] = volume_id
+            return True
+
+    def release_device(self, dev_name, requested_device):
+        """
+        Record that the volume that was attached as dev_name, having asked
+        for requested_device, has been detached.
         """
-        return self._free_devices.pop()
+        with self._device_lock:
+            self.claimed_devices.pop(dev_name, None)
+            if requested_device not in self._free_devices:
+                self._free_devices.append(requested_device)
 
     def delete(self):
         """
@@ -330,11 +612,25 @@ class Instance(object):
         """
         print "Terminating instance:", str(self.instance)
 
+        if self._device_watcher != None:
+            self._device_watcher.close()
+            self._device_watcher = None
+        if self._agent != None:
+            self._agent.close()
+            self._agent = None
+
         if self.public_ip != None:
             self.ec2.euca.disassociate_address(self.public_ip)
             self.ec2.euca.release_address(self.public_ip)
             self.public_ip = None
         self.ec2.euca.terminate_instances(str(self.instance))
+        self._delete_keypair()
+        get_registry().unregister(self)
+
+    def _delete_keypair(self):
+        """
+        Delete the instance's keypair and its private key file.
+        """
         self.ec2.euca.delete_key_pair(str(self.keypair_name))
         if os.path.isfile('%s.priv' % self.keypair_name):
             os.unlink('%s.priv' % self.keypair_name)
@@ -344,6 +640,8 @@ class Volume(object):
     """
     Class representing a Nova Volume
     """
+    kind = 'volume'
+
     def __init__(self, zone=None, size=None, snapshot=None, volume_id=None):
         """
         Create a volume, either empty of the specified size or from the
@@ -355,36 +653,54 @@ class Volume(object):
             raise Exception("Usage: one and only one of size, snapshot and "
                             "volume_id must be specified")
 
-        self.ec2 = EucaConnection()
+        self.ec2 = get_connection()
 
         if zone == None:
             zone = self.ec2.get_default_zone()
+        # What has been written to the volume, and which parts of that have
+        # since been confirmed by reading them back, as maps from byte
+        # ranges to test pattern keys. A volume created from a snapshot
+        # starts out with the snapshot's contents, none of which has been
+        # read back from the new volume yet.
+        self.written = ExtentMap()
+        self.confirmed = ExtentMap()
+
+        self._attached = False
+        self.instance = None
+        self.dev_name = ""
+        self.dev_size = 0
+        self._device = None
+        self.requested_device = None
+        # Results, including throughput, of the last pattern operation
+        self.last_io = None
+
         snapid = None
         if volume_id == None:
             if snapshot != None:
                 snapid = snapshot.id
+                self.written = snapshot.written.copy()
 
             self.volume = self.ec2.euca.create_volume(size=size,
                                                       zone=zone,
                                                       snapshot=snapid)
+            self.id = self.volume.id
+            # Volumes we did not create, such as pre-existing volumes, are
+            # never deleted behind the test's back
+            get_registry().register(self,
+                                    [snapshot] if snapshot != None else [])
             print "Waiting for volume", self.volume.id, "to be created"
-
-            while self.status() == "creating":
-                time.sleep(1)
+            wait_for('volume.create', self.volume.id, self.status,
+                     lambda status: status != "creating")
         else:
             self.volume = \
                     self.ec2.euca.get_all_volumes(volume_ids=volume_id)[0]
-
-        self.id = self.volume.id
-        self._attached = False
-        self.instance = None
-        self.dev_name = ""
+            self.id = self.volume.id
 
     def status(self):
         """
         Return the status of the Nova volume.
         """
-        volume = self.ec2.euca.get_all_volumes([self.volume.id])[0]
+        volume = get_status_poller().lookup('volume', self.volume.id)
         return volume.status.split()[0]
 
     def attached(self, instance=None):
@@ -403,7 +719,26 @@ class Volume(object):
 
         return True
 
-    def write_test_pattern(self, percentage=0, key=0):
+    def _use_direct_io(self, direct):
+        """
+        Decide whether pattern I/O should bypass the guest's page cache.
+        Unless told otherwise this is set by NOVA_VOLUME_TEST_DIRECT_IO.
+        """
+        if direct == None:
+            direct = os.environ.get('NOVA_VOLUME_TEST_DIRECT_IO', '0') != '0'
+        return direct
+
+    def _io_streams(self, streams):
+        """
+        Decide how many parallel I/O streams pattern operations use. Unless
+        told otherwise this is set by NOVA_VOLUME_TEST_STREAMS.
+        """
+        if streams == None:
+            streams = int(os.environ.get('NOVA_VOLUME_TEST_STREAMS', 1))
+        return streams
+
+    def write_test_pattern(self, percentage=0, key=0, direct=None,
+                           streams=None):
         """
         Write a test pattern to the volume.
 
@@ -412,6 +747,11 @@ class Volume(object):
         If a key is supplied, generate the test pattern from that key, so that
         test patterns can be differentiated
 
+        If direct is True the guest's page cache is bypassed.
+
+        If streams is more than one the volume is split into that many
+        parts which are written at the same time.
+
         Volume must be attached.
         """
 
@@ -421,14 +761,76 @@ class Volume(object):
         if percentage == 0:
             percentage = os.environ.get('NOVA_VOLUME_TEST_USE_PERCENTAGE', 100)
 
-        file_txt = WRITE_PATTERN_SCRIPT.format(key_value=key,
-                                               device=self.dev_name,
-                                               percentage_value=percentage)
+        self.last_io = self.instance.agent.call('write_pattern',
+                                device=self.dev_name, key=key,
+                                percentage=float(percentage),
+                                direct=self._use_direct_io(direct),
+                                streams=self._io_streams(streams))
+        self.written.set(0, self.last_io['bytes'], key)
+        self.confirmed.clear(0, self.last_io['bytes'])
+        print "Wrote pattern %d to %s at %.1f MB/s" % \
+                (key, self.id, self.last_io['mb_per_sec'])
+
+    def wipe(self, direct=None, streams=None):
+        """
+        Write zeros over the whole of the volume, so that nothing written to
+        it before can be read back.
+
+        Volume must be attached.
+        """
+        if not self.attached():
+            raise Exception("Usage: volume must be attached to wipe it")
 
-        self.instance.copy_file("write_pattern.py", file_txt)
-        self.instance.run_python_file("write_pattern.py")
+        self.last_io = self.instance.agent.call('wipe', device=self.dev_name,
+                                direct=self._use_direct_io(direct),
+                                streams=self._io_streams(streams))
+        self.written.clear(0, self.last_io['bytes'])
+        self.confirmed.clear(0, self.last_io['bytes'])
+        print "Wiped %s at %.1f MB/s" % (self.id, self.last_io['mb_per_sec'])
 
-    def check_test_pattern(self, percentage=0, key=0):
+    def benchmark(self, mode='seqread', length=0, count=1000, direct=None,
+                  block_size=None):
+        """
+        Measure the performance of the volume's device, with one of the
+        agent's benchmark modes: seqread, randread or randwrite, doing I/O
+        in blocks of block_size bytes if given. Random writes destroy what
+        the volume holds, so it is forgotten.
+
+        Volume must be attached.
+        """
+        if not self.attached():
+            raise Exception("Usage: volume must be attached to benchmark it")
+
+        args = {}
+        if block_size != None:
+            args['block_size'] = block_size
+        self.last_io = self.instance.agent.call('benchmark',
+                                device=self.dev_name, mode=mode,
+                                length=length, count=count,
+                                direct=self._use_direct_io(direct), **args)
+        if mode == 'randwrite':
+            self.written.clear(0, self.dev_size)
+            self.confirmed.clear(0, self.dev_size)
+        return self.last_io
+
+    def _verify_plan(self, key, length):
+        """
+        Split the first length bytes of the volume into the ranges that
+        must be read in full to confirm that they hold the pattern for key,
+        because they have not been confirmed to hold it already, and the
+        ranges that have been, which only need to be sampled.
+        """
+        ranges = []
+        sample_ranges = []
+        for start, end, confirmed_key in self.confirmed.pieces(0, length):
+            if confirmed_key == key:
+                sample_ranges.append([start, end])
+            else:
+                ranges.append([start, end])
+        return ranges, sample_ranges
+
+    def check_test_pattern(self, percentage=0, key=0, direct=None,
+                           sample=None, incremental=None, streams=None):
         """
         Check a test pattern previously written to the volume.
 
@@ -437,25 +839,140 @@ class Volume(object):
         If a key is supplied, generate the test pattern from that key, so that
         test patterns can be differentiated
 
+        If direct is True the guest's page cache is bypassed.
+
+        If streams is more than one the volume is split into that many
+        parts which are checked at the same time.
+
+        If sample is non zero only that many blocks, chosen at random from
+        across the checked area, are read instead of the whole area. If a
+        fraction f of the blocks are bad the check misses them with
+        probability (1 - f) ** sample. The default is taken from
+        NOVA_VOLUME_TEST_SAMPLE, and is to check every block.
+
+        Otherwise, if incremental is True, only the parts of the volume
+        that have not already been confirmed to hold the pattern, either on
+        this volume or on the volume it was created from, are read in full.
+        A sample of NOVA_VOLUME_TEST_RESAMPLE blocks is checked from the
+        rest. This is the default unless NOVA_VOLUME_TEST_INCREMENTAL_VERIFY
+        is set to 0.
+
         Volume must be attached.
         """
 
         if not self.attached():
             Exception("Usage: volume must be attached to check a test pattern")
 
+        args = self._check_args(percentage, key, direct, sample, incremental,
+                                streams)
+        result = self.instance.agent.call('check_pattern', **args)
+        return self._check_done(args, result)
+
+    def _check_args(self, percentage=0, key=0, direct=None, sample=None,
+                    incremental=None, streams=None):
+        """
+        Build the arguments of the agent's check_pattern request for
+        check_test_pattern().
+        """
         if percentage == 0:
             percentage = os.environ.get('NOVA_VOLUME_TEST_USE_PERCENTAGE', 100)
 
-        file_txt = CHECK_PATTERN_SCRIPT.format(key_value=key,
-                                               device=self.dev_name,
-                                               percentage_value=percentage)
+        if sample == None:
+            sample = int(os.environ.get('NOVA_VOLUME_TEST_SAMPLE', 0))
+        if incremental == None:
+            incremental = os.environ.get('NOVA_VOLUME_TEST_INCREMENTAL_VERIFY',
+                                         '1') != '0'
+
+        args = {'device': self.dev_name,
+                'key': key,
+                'percentage': float(percentage),
+                'direct': self._use_direct_io(direct),
+                'sample': sample,
+                'streams': self._io_streams(streams)}
+        if incremental and not sample:
+            args['ranges'], args['sample_ranges'] = \
+                    self._verify_plan(key, self._check_length(args))
+            args['sample'] = int(os.environ.get('NOVA_VOLUME_TEST_RESAMPLE',
+                                                256))
+        return args
+
+    def _check_length(self, args):
+        return pattern_blocks(self.dev_size, args['percentage']) * BLOCK_SIZE
+
+    def _check_done(self, args, result):
+        """
+        Record the result of an agent check_pattern request made with args,
+        and return whether the check passed.
+        """
+        self.last_io = result
+        length = self._check_length(args)
+        if not result['passed']:
+            self.confirmed.clear(0, length)
+        elif 'ranges' in args or not args['sample']:
+            # The whole area has now been confirmed, either by reading it or
+            # by reading what had not been confirmed already
+            self.confirmed.set(0, length, args['key'])
+        print "Checked pattern %d on %s: %d of %d blocks read at %.1f MB/s, " \
+              "%d of them sampled with seed %s" % \
+                (args['key'], self.id, result['bytes'] / BLOCK_SIZE,
+                 result['blocks'], result['mb_per_sec'], result['sampled'],
+                 result['seed'])
+        if not result['passed']:
+            print "check_test_pattern of %s: %s" % (self.id, result['result'])
+        return result['passed']
+
+    def manifest(self, extent_size=EXTENT_SIZE, direct=None):
+        """
+        Read the whole volume once, on the instance, and return a Manifest
+        holding the digest of every extent_size extent of it.
 
-        self.instance.copy_file("check_pattern.py", file_txt)
-        out_str = self.instance.run_python_file("check_pattern.py")
-        if out_str == 'Pass':
-            return True
-        else:
-            return False
+        Volume must be attached.
+        """
+
+        if not self.attached():
+            raise Exception("Usage: volume must be attached to read its "
+                            "manifest")
+
+        self.last_io = self.instance.agent.call('manifest',
+                                device=self.dev_name,
+                                extent_size=extent_size,
+                                direct=self._use_direct_io(direct))
+        print "Read manifest of %s at %.1f MB/s" % \
+                (self.id, self.last_io['mb_per_sec'])
+        return Manifest.from_reply(self.last_io)
+
+    def expected_manifest(self, extent_size=EXTENT_SIZE, length=None):
+        """
+        Return the Manifest the volume should have, given the test patterns
+        written to it. Extents that have not been completely written with
+        test patterns have a digest of None.
+        """
+        if length == None:
+            length = self.dev_size
+        return Manifest.expected(self.written, length, extent_size)
+
+    def verify_manifest(self, manifest):
+        """
+        Check a manifest read from this volume against the test patterns
+        written to it, without reading the volume again. The extents that
+        match are recorded as confirmed.
+
+        Returns True if no extent differs from what is expected.
+        """
+        expected = self.expected_manifest(manifest.extent_size,
+                                          manifest.length)
+        bad = expected.diff(manifest)
+        for start, end in expected.known_ranges():
+            if start in bad:
+                self.confirmed.clear(start, end)
+                continue
+            for piece_start, piece_end, key in \
+                                    self.written.pieces(start, end):
+                self.confirmed.set(piece_start, piece_end, key)
+        if bad:
+            print "Manifest of %s differs in %d extents, the first at " \
+                  "byte %d" % (self.id, len(bad), bad[0])
+        return not bad
 
     def check_mount_device(self):
         """
@@ -465,32 +982,63 @@ class Volume(object):
         if not self.attached():
             Exception("Usage: volume must be attached to attempt to mount it")
 
-        file_txt = CHECK_MOUNT_VOLUME.format(device=self.dev_name)
+        result = self.instance.agent.call('check_mount', device=self.dev_name)
+        print "check_mount_device got result : <%s>" % (result)
+        return result['passed']
 
-        self.instance.copy_file("check_mount_volume.py", file_txt)
-        out_str = self.instance.run_python_file("check_mount_volume.py")
-        print "check_mount_device got result : <%s>" % (out_str)
-        if out_str == 'Pass':
-            return True
-        else:
+    def _serial_matches(self, serial):
+        """
+        Check if serial is the serial number the hypervisor gives this
+        volume's device, which is the volume id with or without its vol-
+        prefix, cut short to the 20 characters virtio allows.
+        """
+        if not serial:
             return False
+        return serial in [self.id[:20], self.id.split('-', 1)[-1][:20]]
 
-    def _get_dev_names(self):
+    def _reported_device(self):
         """
-        Get the list of devices on the current instance.
+        Return the device the API says this volume is attached as, or None.
         """
+        volume = get_status_poller().lookup('volume', self.id)
+        if volume.attach_data and \
+                volume.attach_data.instance_id == self.instance.id:
+            return volume.attach_data.device
+        return None
 
-        cmd = "/bin/cat /proc/partitions"
-        stdin, stdout, stderr = self.instance.sshclient.exec_command(cmd)
-        out = stdout.read()
-        devs = []
-        for line in out.splitlines():
-            words = line.split()
-            if len(words) > 2:
-                if words[3] == 'name':
-                    continue
-                devs.append('/dev/%s' % words[3])
-        return devs
+    def _find_device(self, devices):
+        """
+        Look for the device this volume is attached as among the instance's
+        devices, and claim it. Returns the device, or None if it has not
+        shown up yet.
+
+        The device is found by its serial number. If the hypervisor does not
+        give devices serial numbers, the device the API says the volume is
+        attached as is used, if the instance has one by that name. Otherwise,
+        as the name the guest gives a device rarely matches the one asked
+        for, a new device of the volume's size is used, as long as there is
+        only one that no other volume has claimed. Other volumes may have
+        been attached to the instance by something else, so a device can
+        not be picked just because it is new.
+        """
+        found = [d for d in devices if self._serial_matches(d['serial'])]
+        if not found:
+            new = [d for d in devices if d['serial'] == None and
+                   d['name'] not in self.instance.base_devices and
+                   d['name'] not in self.instance.claimed_devices]
+            reported = self._reported_device()
+            found = [d for d in new if d['name'] == reported]
+            if not found:
+                size = int(get_status_poller().lookup('volume',
+                                                      self.id).size)
+                found = [d for d in new if
+                         d['size'] == size * _bytes_per_gb()]
+                if len(found) != 1:
+                    found = []
+        for device in found:
+            if self.instance.claim_device(device['name'], self.id):
+                return device
+        return None
 
     def attach(self, instance):
         """
@@ -503,50 +1051,77 @@ class Volume(object):
         volume_id = self.id
         instance_id = instance.id
         device = instance.next_device()
-        devs_before = self._get_dev_names()
+        self.requested_device = device
+        # The volume must be detached before the instance is deleted
+        get_registry().depends(self, instance)
         print "Attaching volume:", volume_id, "status:", self.status()
         print "to instance:", instance_id, "Using device:", device
-        self.ec2.euca.attach_volume(volume_id, instance_id, device)
-
-        print "Waiting for volume", volume_id, "to be attached to instance", \
-                instance_id
-        while self.status() != "in-use":
-            time.sleep(1)
-
-        devs_after = self._get_dev_names()
-
-        if len(devs_after) != len(devs_before) + 1:
-            Exception("attach(): Failed to detect attached device.")
-        self.dev_name = [d for d in devs_after if d not in devs_before][0]
+        serialised = instance.serials != True
+        if serialised:
+            instance._attach_lock.acquire()
+        try:
+            start = time.time()
+            self.ec2.euca.attach_volume(volume_id, instance_id, device)
+
+            print "Waiting for volume", volume_id, \
+                  "to be attached to instance", instance_id
+            found = instance.wait_for_device('volume.guest_attach',
+                                             volume_id, self._find_device,
+                                             start)
+            instance.serials = found['serial'] != None
+        finally:
+            if serialised:
+                instance._attach_lock.release()
+        wait_for('volume.attach', volume_id, self.status,
+                 lambda status: status == "in-use")
+
+        self._device = found
+        self.dev_name = found['name']
+        self.dev_size = found['size']
         print("Volume %s attached as %s" % (volume_id, self.dev_name))
         self._attached = True
         self.instance = instance
 
-    def detach(self):
+    def detach(self, guest=True):
         """
         Attempt to detach from the specified instance
+
+        If guest is False only the API is waited on, not the device going
+        away on the instance, which may not be reachable any more.
         """
         if self.instance == None:
-            Exception("detach: no instance available.")
+            raise Exception("detach: no instance available.")
 
         volume_id = self.id
         instance_id = self.instance.id
+        start = time.time()
         self.ec2.euca.detach_volume(volume_id, instance_id, True)
 
         print "Waiting for volume", volume_id, \
                 "to be detached from instance", instance_id
-        while self.status() == "in-use":
-            time.sleep(1)
+        # Another volume may be attached under the same name as soon as
+        # this one has gone, so look for the device, not just its name
+        def gone(devices):
+            if not [d for d in devices if d is self._device]:
+                return True
+        if guest:
+            self.instance.wait_for_device('volume.guest_detach', volume_id,
+                                          gone, start)
+            wait_for('volume.detach', volume_id, self.status,
+                     lambda status: status != "in-use")
+        else:
+            wait_for('volume.detach', volume_id, self.status,
+                     lambda status: status == "available")
+        self.instance.release_device(self.dev_name, self.requested_device)
         self._attached = False
 
-    def delete(self):
+    def delete(self, guest=True):
         """
-        Destroy this volume.
-
-        Volume must be detached.
+        Destroy this volume, detaching it first if it is attached, waiting
+        for the instance to see it go unless guest is False.
         """
         if self.attached() == True:
-            self.detach()
+            self.detach(guest)
 
         retry_limit = os.environ.get('NOVA_VOLUME_TEST_RETRY_LIMIT', 3)
         #
@@ -562,12 +1137,60 @@ class Volume(object):
                 if n >= retry_limit - 1:
                     raise
                 print "Got an EC2 error, try again to delete ", self.id
+        get_registry().unregister(self)
+
+    def teardown(self):
+        """
+        Destroy this volume when cleaning up after a test, when the
+        instance it is attached to may have stopped responding.
+        """
+        if not self.attached() and self.instance != None:
+            # An attach may have been asked for and then not been seen
+            # through, e.g. because the device never showed up on the
+            # instance, leaving the volume attached
+            status = self.status()
+            if status == "attaching":
+                status = wait_for('volume.attach', self.id, self.status,
+                                  lambda status: status != "attaching")
+            self._attached = status == "in-use"
+        self.delete(guest=False)
+
+
+def _in_parallel(func, items):
+    """
+    Call func on each of items at the same time, and return the results.
+    """
+    if not items:
+        return []
+    pool = ThreadPool(len(items))
+    try:
+        # A timeout makes the wait interruptible
+        return pool.map_async(func, items).get(sys.maxint)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def attach_volumes(volumes, instance):
+    """
+    Attach several volumes to instance at the same time.
+    """
+    _in_parallel(lambda volume: volume.attach(instance), volumes)
+
+
+def detach_volumes(volumes):
+    """
+    Detach several volumes at the same time.
+    """
+    _in_parallel(lambda volume: volume.detach(), volumes)
 
 
 class Snapshot(object):
     """
     Class representing a Nova Volume
     """
+    kind = 'snapshot'
+
     def __init__(self, volume=None):
         """
         Create a snapshot from the volume identified.
@@ -577,20 +1200,26 @@ class Snapshot(object):
 
         self.volume = volume
 
-        self.ec2 = EucaConnection()
+        # The snapshot holds whatever the volume held when it was taken,
+        # but what it holds has not been read back from it
+        self.written = volume.written.copy()
+        self.confirmed = ExtentMap()
+
+        self.ec2 = get_connection()
         self.snapshot = self.ec2.euca.create_snapshot(volume_id=volume.id)
         self.id = self.snapshot.id
+        get_registry().register(self, [volume])
         self.volume = self.volume.id
         print "Waiting for snapshot", self.id, "to be created"
-        while self.status() == "creating":
-            time.sleep(1)
+        wait_for('snapshot.create', self.id, self.status,
+                 lambda status: status != "creating")
 
     def status(self):
         """
         Return the status of the Nova volume.
         """
-        snaps = self.ec2.euca.get_all_snapshots(snapshot_ids=[self.id])
-        return snaps[0].status.split()[0]
+        snap = get_status_poller().lookup('snapshot', self.id)
+        return snap.status.split()[0]
 
     def delete(self):
         """
@@ -610,3 +1239,4 @@ class Snapshot(object):
                 if n >= retry_limit - 1:
                     raise
                 print "Got an EC2 error, try again to delete ", self.id
+        get_registry().unregister(self)
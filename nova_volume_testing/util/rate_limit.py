@@ -0,0 +1,131 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Limit the rate at which API calls are made, per API operation.
+
+NOVA_VOLUME_TEST_API_RATES sets the rates, in calls per second, for example
+
+    create_volume=0.5,attach_volume=2,*=20
+
+where '*' applies to every operation without a rate of its own. Operations
+with no rate are not limited. Each rate is enforced by a token bucket, so
+short bursts of up to NOVA_VOLUME_TEST_API_BURST calls, by default one
+second's worth, go through at once.
+"""
+import os
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows rate events per second on average, and up to burst at once.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        # A bucket that can not hold a whole token would never allow an
+        # event
+        self.burst = max(1.0, burst or rate)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until an event is allowed. Returns how long that took, in
+        seconds.
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class RateLimiter(object):
+    """
+    A token bucket for each rate limited operation.
+    """
+    def __init__(self, rates=None, burst=None):
+        """
+        rates maps operation names, or '*' for any other operation, to calls
+        per second.
+        """
+        self.rates = dict(rates or {})
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, operation):
+        with self._lock:
+            if operation not in self._buckets:
+                rate = self.rates.get(operation, self.rates.get('*'))
+                self._buckets[operation] = None
+                if rate:
+                    self._buckets[operation] = TokenBucket(rate, self.burst)
+            return self._buckets[operation]
+
+    def acquire(self, operation):
+        """
+        Wait until operation may be called. Returns how long that took, in
+        seconds.
+        """
+        bucket = self._bucket(operation)
+        if bucket == None:
+            return 0
+        return bucket.acquire()
+
+
+def parse_rates(spec):
+    """
+    Parse "name=rate,name=rate" into a dictionary of rates.
+    """
+    rates = {}
+    for part in (spec or '').split(','):
+        if not part.strip():
+            continue
+        name, rate = part.split('=', 1)
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Get the RateLimiter for the API calls made by this process, set up from
+    NOVA_VOLUME_TEST_API_RATES and NOVA_VOLUME_TEST_API_BURST.
+    """
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter == None:
+            burst = os.environ.get('NOVA_VOLUME_TEST_API_BURST')
+            _rate_limiter = RateLimiter(
+                    parse_rates(os.environ.get('NOVA_VOLUME_TEST_API_RATES')),
+                    float(burst) if burst else None)
+        return _rate_limiter
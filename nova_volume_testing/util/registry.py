@@ -0,0 +1,250 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Track the cloud resources a test process creates, so that they are deleted
+even if the test fails part way through.
+
+Every instance, volume and snapshot created by novaexerciser is registered
+here, and unregistered when it is deleted. Whatever is still registered
+when the process exits, including when it exits because of an uncaught
+exception or SIGTERM, is deleted then. Set NOVA_VOLUME_TEST_KEEP_RESOURCES=1
+to leave the resources of a failed test behind for debugging.
+
+Resources are also written to a ledger file, NOVA_VOLUME_TEST_LEDGER, by
+default ~/.cache/nova-volume-test/ledger.jsonl, so that resources left by a
+process that was killed outright can be found and deleted later by
+nova-volume-sweep.
+"""
+import atexit
+import fcntl
+import json
+import os
+import os.path
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+
+DEFAULT_LEDGER = os.path.join('~', '.cache', 'nova-volume-test',
+                              'ledger.jsonl')
+
+
+class Ledger(object):
+    """
+    A file recording each resource created and deleted, one JSON object per
+    line.
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def record(self, event, kind, resource_id, **details):
+        """
+        Record that the resource_id of the given kind was created or
+        deleted, as event says.
+        """
+        entry = dict(details, event=event, kind=kind, id=resource_id,
+                     time=time.time(), pid=os.getpid(),
+                     host=socket.gethostname())
+        with open(self.path, 'a') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            fd.write(json.dumps(entry) + '\n')
+
+    def entries(self):
+        """
+        Return every entry in the ledger, oldest first.
+        """
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path) as fd:
+            for line in fd:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass
+        return entries
+
+    def outstanding(self):
+        """
+        Return the creation entries of the resources that have not been
+        recorded as deleted.
+        """
+        created = {}
+        for entry in self.entries():
+            key = (entry['kind'], entry['id'])
+            if entry['event'] == 'create':
+                created[key] = entry
+            else:
+                created.pop(key, None)
+        return sorted(created.values(), key=lambda e: e['time'])
+
+    def forget(self, kind, resource_id):
+        """
+        Record that a resource no longer needs deleting.
+        """
+        self.record('delete', kind, resource_id)
+
+
+def teardown(resources, dependencies, workers=8):
+    """
+    Delete resources, each of which has a kind, an id and a delete() method,
+    as many at a time as possible. A resource's teardown() method is used
+    instead of delete() if it has one. dependencies maps a resource to the
+    resources it depends on, which are only deleted after it.
+
+    Returns a list of (resource, error message) for each resource that
+    could not be deleted.
+    """
+    remaining = list(resources)
+    errors = []
+    pool = ThreadPool(workers)
+
+    def delete(resource):
+        try:
+            getattr(resource, 'teardown', resource.delete)()
+        except Exception:
+            return traceback.format_exc()
+
+    try:
+        while remaining:
+            needed = set()
+            for resource in remaining:
+                needed.update(dependencies.get(resource, ()))
+            ready = [r for r in remaining if r not in needed]
+            if not ready:
+                # Circular dependencies, just delete everything
+                ready = remaining
+            print "Deleting %s" % ", ".join("%s %s" % (r.kind, r.id)
+                                            for r in ready)
+            results = pool.map_async(delete, ready).get(sys.maxint)
+            for resource, error in zip(ready, results):
+                if error != None:
+                    errors.append((resource, error))
+            remaining = [r for r in remaining if r not in ready]
+    finally:
+        pool.close()
+    return errors
+
+
+class ResourceRegistry(object):
+    """
+    The resources created by this process that have not been deleted yet.
+    """
+    def __init__(self, ledger=None):
+        self.ledger = ledger
+        self._lock = threading.Lock()
+        self._resources = []
+        self._dependencies = {}
+
+    def register(self, resource, depends_on=(), **details):
+        """
+        Record that resource has been created. It has a kind and an id, a
+        delete() method, and it will be deleted before any of the resources
+        in depends_on.
+        """
+        with self._lock:
+            self._resources.append(resource)
+            self._dependencies[resource] = set(depends_on)
+        if self.ledger != None:
+            self.ledger.record('create', resource.kind, resource.id,
+                               **details)
+
+    def depends(self, resource, on):
+        """
+        Record that resource must be deleted before on.
+        """
+        with self._lock:
+            if resource in self._dependencies:
+                self._dependencies[resource].add(on)
+
+    def unregister(self, resource):
+        """
+        Record that resource has been deleted.
+        """
+        with self._lock:
+            if resource not in self._dependencies:
+                return
+            self._resources.remove(resource)
+            del self._dependencies[resource]
+        if self.ledger != None:
+            self.ledger.record('delete', resource.kind, resource.id)
+
+    def teardown(self):
+        """
+        Delete every registered resource, in parallel and in dependency
+        order. Returns a list of (resource, error message) for the resources
+        that could not be deleted.
+        """
+        with self._lock:
+            resources = list(self._resources)
+            dependencies = dict((r, set(d)) for r, d in
+                                self._dependencies.items())
+        return teardown(resources, dependencies)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    Get the ResourceRegistry for this process.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry == None:
+            path = os.environ.get('NOVA_VOLUME_TEST_LEDGER', DEFAULT_LEDGER)
+            _registry = ResourceRegistry(Ledger(os.path.expanduser(path)))
+        return _registry
+
+
+def _teardown_at_exit():
+    """
+    Delete whatever resources the process is exiting without deleting.
+    """
+    if _registry == None or not _registry._resources:
+        return
+    if os.environ.get('NOVA_VOLUME_TEST_KEEP_RESOURCES', '0') != '0':
+        print "Leaving behind %d resources" % len(_registry._resources)
+        return
+    print "Cleaning up %d resources left behind" % len(_registry._resources)
+    for resource, error in _registry.teardown():
+        print "Failed to delete %s %s: %s" % (resource.kind, resource.id,
+                                              error)
+
+
+def _exit_on_signal(signum, frame):
+    # Exiting normally runs the atexit handlers, so resources get cleaned up
+    sys.exit(128 + signum)
+
+
+atexit.register(_teardown_at_exit)
+if threading.current_thread().name == 'MainThread' and \
+        signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+    signal.signal(signal.SIGTERM, _exit_on_signal)
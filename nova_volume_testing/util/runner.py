@@ -0,0 +1,383 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Run the volume end to end scenarios concurrently.
+
+Each scenario is run as a separate python process, exactly as the old shell
+loop did, but up to a configurable number of them run at the same time. The
+output of each scenario goes to its own log file so that the output of
+concurrent scenarios is not interleaved.
+"""
+import glob
+import optparse
+import os
+import os.path
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from latency import LatencyRecorder
+from tracing import TRACE_FILE_ENV, read_spans, write_chrome_trace
+from waiter import latencies as runner_latencies, set_exit_report
+
+
+SCENARIO_DIR = os.path.join(os.path.dirname(os.path.dirname(
+                                os.path.abspath(__file__))),
+                            'volume_end_to_end')
+
+# Scenarios are the numbered scripts in the scenario directory,
+# e.g. 001_basic_volume_create_attach.py
+SCENARIO_GLOB = '[0-9][0-9][0-9]_*.py'
+
+# How long a hung scenario is given to clean up after SIGTERM before it is
+# killed outright.
+TERMINATE_GRACE_PERIOD = 60
+
+
+class ScenarioResult(object):
+    """
+    The outcome of a single scenario run.
+    """
+    def __init__(self, name, returncode, elapsed, timed_out, log_file,
+                 latency_file):
+        self.name = name
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.log_file = log_file
+        self.latency_file = latency_file
+
+    @property
+    def passed(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __str__(self):
+        if self.timed_out:
+            outcome = "TIMEOUT"
+        elif self.passed:
+            outcome = "PASS"
+        else:
+            outcome = "FAIL (%s)" % self.returncode
+        return "%-40s %-12s %8.1fs" % (self.name, outcome, self.elapsed)
+
+
+def find_scenarios(scenario_dir=SCENARIO_DIR, names=None):
+    """
+    Return the paths of the scenarios in scenario_dir, in order.
+
+    If names is given only scenarios whose file name starts with, or
+    contains, one of the names are returned.
+    """
+    paths = sorted(glob.glob(os.path.join(scenario_dir, SCENARIO_GLOB)))
+    if names:
+        paths = [p for p in paths if
+                 [n for n in names if n in os.path.basename(p)]]
+    return paths
+
+
+def _scenario_env(latency_file):
+    """
+    Build the environment for a scenario process, making sure the package
+    this runner came from is importable by the scenario.
+    """
+    env = os.environ.copy()
+    env['NOVA_VOLUME_TEST_LATENCY_FILE'] = latency_file
+    package_root = os.path.dirname(os.path.dirname(SCENARIO_DIR))
+    python_path = env.get('PYTHONPATH')
+    if python_path:
+        env['PYTHONPATH'] = package_root + os.pathsep + python_path
+    else:
+        env['PYTHONPATH'] = package_root
+    return env
+
+
+def _kill_process_group(proc, grace_period=TERMINATE_GRACE_PERIOD):
+    """
+    Ask a scenario, and anything it started, to stop. If it is still running
+    after the grace period kill it.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.time() + grace_period
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(1)
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+
+
+class RunningScenarios(object):
+    """
+    The scenario processes that are running, so that they can all be
+    stopped if the runner is.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = set()
+        self._stopped = False
+
+    def start(self, *args, **kwargs):
+        """
+        Start a scenario process, passing the arguments on to
+        subprocess.Popen. Returns None if stop() has been called.
+        """
+        with self._lock:
+            if self._stopped:
+                return None
+            proc = subprocess.Popen(*args, **kwargs)
+            self._procs.add(proc)
+            return proc
+
+    def finished(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def stop(self):
+        """
+        Kill the scenarios that are running, along with anything they
+        started, and do not start any more.
+        """
+        with self._lock:
+            self._stopped = True
+            procs = list(self._procs)
+        if not procs:
+            return
+        pool = ThreadPool(len(procs))
+        try:
+            pool.map_async(_kill_process_group, procs).get(sys.maxint)
+        finally:
+            pool.close()
+
+
+def run_scenario(path, timeout, log_dir, running=None):
+    """
+    Run one scenario to completion, or until it has run for timeout seconds.
+
+    The scenario is started through running, a RunningScenarios, if given.
+    Returns None if running has been stopped.
+    """
+    if running == None:
+        running = RunningScenarios()
+    name = os.path.splitext(os.path.basename(path))[0]
+    log_file = os.path.join(log_dir, name + '.log')
+    latency_file = os.path.join(log_dir, name + '.latency.json')
+    if os.path.exists(latency_file):
+        os.unlink(latency_file)
+
+    start = time.time()
+    with open(log_file, 'w') as log:
+        # Put the scenario in its own process group so that a hung scenario
+        # can be killed along with any children it started. Other threads
+        # may be holding file locks, such as on the ledger, which the
+        # scenario would hold for as long as it ran if it inherited them.
+        proc = running.start([sys.executable, path],
+                             stdout=log,
+                             stderr=subprocess.STDOUT,
+                             env=_scenario_env(latency_file),
+                             preexec_fn=os.setsid,
+                             close_fds=True)
+        if proc == None:
+            return None
+        timed_out = False
+        try:
+            while proc.poll() is None:
+                if timeout and time.time() - start > timeout:
+                    timed_out = True
+                    _kill_process_group(proc)
+                    break
+                time.sleep(1)
+        finally:
+            running.finished(proc)
+
+    return ScenarioResult(name, proc.returncode, time.time() - start,
+                          timed_out, log_file, latency_file)
+
+
+def run_scenarios(paths, concurrency, timeout, log_dir):
+    """
+    Run the scenarios, at most concurrency of them at the same time, and
+    return a list of ScenarioResult in the same order as paths.
+    """
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    lock = threading.Lock()
+    running = RunningScenarios()
+
+    def _run(path):
+        result = run_scenario(path, timeout, log_dir, running)
+        if result != None:
+            with lock:
+                print result
+                sys.stdout.flush()
+        return result
+
+    pool = ThreadPool(max(1, min(concurrency, len(paths))))
+    try:
+        # map_async().get() with a timeout keeps the main thread responsive
+        # to KeyboardInterrupt, where a plain map() would not be.
+        return pool.map_async(_run, paths).get(sys.maxint)
+    except BaseException:
+        # The scenarios are in their own process groups, so an interrupt
+        # does not reach them. Stop them before the pools they use are
+        # shut down.
+        running.stop()
+        raise
+    finally:
+        pool.close()
+
+
+def main(argv=None):
+    """
+    Entry point for the nova-volume-test command.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option('-c', '--concurrency', type='int',
+                      default=int(os.environ.get(
+                                    'NOVA_VOLUME_TEST_CONCURRENCY', 0)),
+                      help="Number of scenarios to run at the same time, "
+                           "defaults to all of them")
+    parser.add_option('-t', '--timeout', type='int',
+                      default=int(os.environ.get(
+                                    'NOVA_VOLUME_TEST_SCENARIO_TIMEOUT',
+                                    3600)),
+                      help="Seconds a scenario may run before it is "
+                           "killed, 0 for no limit")
+    parser.add_option('-p', '--instance-pool', type='int',
+                      default=int(os.environ.get(
+                                    'NOVA_VOLUME_TEST_INSTANCE_POOL', 0)),
+                      help="Boot this many instances up front and share "
+                           "them between the scenarios")
+    parser.add_option('-v', '--volume-pool',
+                      default=os.environ.get('NOVA_VOLUME_TEST_VOLUME_POOL',
+                                             ''),
+                      help="Keep volumes ready for the scenarios, for "
+                           "example 1:4,10:2 keeps four 1GB and two 10GB "
+                           "volumes ready")
+    parser.add_option('-d', '--scenario-dir', default=SCENARIO_DIR,
+                      help="Directory containing the scenarios")
+    parser.add_option('-l', '--log-dir',
+                      default=os.environ.get('NOVA_VOLUME_TEST_LOG_DIR',
+                                             'nova-volume-test-logs'),
+                      help="Directory to write scenario logs to")
+    parser.add_option('-r', '--refresh-cache', action='store_true',
+                      default=False,
+                      help="Forget the cached images, flavors, zones and "
+                           "ssh users and discover them again")
+    parser.add_option('-f', '--fake-cloud',
+                      default=os.environ.get('NOVA_VOLUME_TEST_FAKE_CLOUD'),
+                      help="Run against a fake cloud, keeping its state in "
+                           "this directory, instead of EC2_URL")
+    parser.add_option('--trace',
+                      default=os.environ.get(TRACE_FILE_ENV),
+                      help="Trace every API call, ssh command and wait to "
+                           "this file, as JSON lines")
+    parser.add_option('--chrome-trace',
+                      help="Also save the trace in Chrome trace event "
+                           "format to this file")
+    options, names = parser.parse_args(argv)
+    # The latencies of the pools' waits are reported with the scenarios'
+    set_exit_report(False)
+
+    if options.chrome_trace and not options.trace:
+        options.trace = os.path.join(options.log_dir, 'trace.jsonl')
+    if options.trace:
+        # Start afresh, every scenario appends to the file
+        if os.path.exists(options.trace):
+            os.unlink(options.trace)
+        os.environ[TRACE_FILE_ENV] = options.trace
+
+    if options.fake_cloud:
+        os.environ['NOVA_VOLUME_TEST_FAKE_CLOUD'] = options.fake_cloud
+    if options.refresh_cache:
+        from discovery_cache import get_discovery_cache
+        get_discovery_cache().invalidate()
+
+    paths = find_scenarios(options.scenario_dir, names)
+    if not paths:
+        print "No scenarios found in %s" % options.scenario_dir
+        return 1
+
+    concurrency = options.concurrency or len(paths)
+    print "Running %d scenarios, %d at a time, logs in %s" % \
+            (len(paths), concurrency, options.log_dir)
+
+    start = time.time()
+    pool = None
+    volume_pool = None
+    if options.volume_pool:
+        # Imported here so that the runner itself does not need the cloud
+        # libraries unless it is going to create resources.
+        from volume_pool import VolumePool, VOLUME_POOL_DIR_ENV, parse_sizes
+        volume_pool = VolumePool(parse_sizes(options.volume_pool))
+        volume_pool.start()
+        os.environ[VOLUME_POOL_DIR_ENV] = volume_pool.pool_dir
+    if options.instance_pool > 0:
+        from instance_pool import InstancePool, POOL_DIR_ENV
+        pool = InstancePool(options.instance_pool)
+        pool.start()
+        os.environ[POOL_DIR_ENV] = pool.pool_dir
+    try:
+        results = run_scenarios(paths, concurrency, options.timeout,
+                                options.log_dir)
+    finally:
+        # Volumes first, so that any left attached are detached from
+        # instances that still exist
+        if volume_pool != None:
+            volume_pool.shutdown()
+        if pool != None:
+            pool.shutdown()
+    elapsed = time.time() - start
+
+    failed = [r for r in results if not r.passed]
+    print
+    print "Summary:"
+    for result in results:
+        print result
+    print "%d of %d scenarios passed in %.1fs" % \
+            (len(results) - len(failed), len(results), elapsed)
+    for result in failed:
+        print "See %s for the output of %s" % (result.log_file, result.name)
+
+    latencies = LatencyRecorder()
+    latencies.merge(runner_latencies.samples)
+    for result in results:
+        if os.path.exists(result.latency_file):
+            latencies.load(result.latency_file)
+    if latencies.samples:
+        print
+        print "Transition latencies across all scenarios:"
+        print latencies.report()
+
+    if options.trace and os.path.exists(options.trace):
+        print "Trace written to %s" % options.trace
+        if options.chrome_trace:
+            write_chrome_trace(read_spans(options.trace),
+                               options.chrome_trace)
+            print "Chrome trace written to %s" % options.chrome_trace
+
+    if failed:
+        return 1
+    return 0
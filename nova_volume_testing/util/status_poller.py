@@ -0,0 +1,169 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Batched status polling for volumes, snapshots and instances.
+
+Rather than every waiting object describing its own resource, callers ask a
+shared StatusPoller for the state of a resource. The poller collects the ids
+of every resource being asked about and describes all of the resources of one
+type with a single API call, at most once per interval, then wakes up all of
+the callers that were waiting on that call.
+"""
+import threading
+import time
+
+
+class ResourceNotFound(Exception):
+    """
+    The resource looked up does not exist, for example because it has been
+    deleted.
+    """
+    pass
+
+
+def _is_not_found(error):
+    """
+    Check if an error from a describe call says the resource described does
+    not exist, such as EC2's InvalidVolume.NotFound.
+    """
+    return getattr(error, 'error_code', None) and \
+           error.error_code.endswith('NotFound')
+
+
+class StatusPoller(object):
+    """
+    Serves resource status lookups from one describe call per resource type
+    per interval.
+    """
+    def __init__(self, describers, interval=1.0):
+        """
+        describers maps a resource type, e.g. 'volume', to a function that
+        takes a list of resource ids and returns a dictionary mapping each id
+        to the object describing that resource.
+        """
+        self.describers = describers
+        self.interval = interval
+        self.describe_count = 0
+        self._cond = threading.Condition()
+        self._pending = {}
+        # The latest result for, and the number of lookups waiting on, each
+        # resource being looked up. Results are only kept while waited on.
+        self._results = {}
+        self._waiters = {}
+        self._generation = {}
+        self._last_poll = {}
+        self._thread = None
+
+    def _start(self):
+        if self._thread == None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def lookup(self, kind, resource_id):
+        """
+        Return the object describing resource_id, taken from a describe call
+        made after this lookup was requested. Raises ResourceNotFound if
+        there is no such resource.
+        """
+        with self._cond:
+            self._start()
+            target = self._generation.get(kind, 0) + 1
+            self._pending.setdefault(kind, set()).add(resource_id)
+            key = (kind, resource_id)
+            self._waiters[key] = self._waiters.get(key, 0) + 1
+            self._cond.notify_all()
+            try:
+                while True:
+                    result = self._results.get(key)
+                    if result != None and result[0] >= target:
+                        break
+                    # Wait with a timeout so that signals are still
+                    # delivered to the main thread while it waits.
+                    self._cond.wait(1)
+            finally:
+                # Later lookups need a newer result, so once nothing waits
+                # for this one it can go
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    del self._waiters[key]
+                    self._results.pop(key, None)
+
+        generation, obj, error = result
+        if error != None:
+            raise error
+        return obj
+
+    def _describe(self, kind, ids):
+        """
+        Describe the resources with the given ids, returning a dictionary
+        mapping each id to (object, error).
+        """
+        describer = self.describers[kind]
+        self.describe_count += 1
+        try:
+            found = describer(ids)
+        except Exception as e:
+            if len(ids) == 1:
+                if _is_not_found(e):
+                    e = ResourceNotFound(str(e))
+                return {ids[0]: (None, e)}
+            # One bad id, e.g. a resource that has been deleted, fails the
+            # whole call, so fall back to describing them one at a time.
+            results = {}
+            for resource_id in ids:
+                results.update(self._describe(kind, [resource_id]))
+            return results
+
+        results = {}
+        for resource_id in ids:
+            if resource_id in found:
+                results[resource_id] = (found[resource_id], None)
+            else:
+                results[resource_id] = \
+                        (None, ResourceNotFound("%s %s not found" %
+                                                (kind, resource_id)))
+        return results
+
+    def _run(self):
+        while True:
+            with self._cond:
+                waiting = [(self._last_poll.get(kind, 0) + self.interval,
+                            kind) for kind, ids in self._pending.items()
+                           if ids]
+                if not waiting:
+                    self._cond.wait()
+                    continue
+                when, kind = min(waiting)
+                now = time.time()
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                ids = sorted(self._pending.pop(kind))
+                self._last_poll[kind] = now
+
+            results = self._describe(kind, ids)
+
+            with self._cond:
+                generation = self._generation.get(kind, 0) + 1
+                self._generation[kind] = generation
+                for resource_id, (obj, error) in results.items():
+                    if (kind, resource_id) in self._waiters:
+                        self._results[(kind, resource_id)] = \
+                                                (generation, obj, error)
+                self._cond.notify_all()
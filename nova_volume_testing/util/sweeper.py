@@ -0,0 +1,238 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Find and delete the resources left behind by test runs that did not clean
+up after themselves, for example because they were killed outright.
+
+Leftover resources are found from the ledger the tests write. Only resources
+created by processes on this host that are no longer running are deleted,
+unless --all is given, in which case every resource in the ledger is
+deleted, as are the instances and keypairs of any testsuite_ keypair.
+"""
+import errno
+import glob
+import optparse
+import os
+import os.path
+import socket
+import time
+from novaexerciser import get_connection, get_status_poller
+from registry import DEFAULT_LEDGER, Ledger, teardown
+from waiter import wait_for
+
+
+KEYPAIR_PREFIX = 'testsuite_'
+
+
+class Orphan(object):
+    """
+    A resource left behind by an earlier test run.
+    """
+    def __init__(self, kind, resource_id, delete, keypair=None):
+        self.kind = kind
+        self.id = resource_id
+        self.keypair = keypair
+        self._delete = delete
+
+    def delete(self):
+        self._delete(self)
+
+
+def _process_gone(entry):
+    """
+    Check if the process that made a ledger entry has exited. Processes on
+    other hosts can not be checked, and are assumed to still be running.
+    """
+    if entry.get('host') != socket.gethostname():
+        return False
+    try:
+        os.kill(entry['pid'], 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+class Sweeper(object):
+    """
+    Deletes leftover resources, and records their deletion in the ledger.
+    """
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.ec2 = get_connection()
+
+    def _delete_instance(self, orphan):
+        for address in self.ec2.euca.get_all_addresses():
+            if address.instance_id == orphan.id:
+                self.ec2.euca.disassociate_address(address.public_ip)
+                self.ec2.euca.release_address(address.public_ip)
+        self.ec2.euca.terminate_instances([orphan.id])
+        if orphan.keypair:
+            self._delete_keypair(orphan.keypair)
+        self.ledger.forget(orphan.kind, orphan.id)
+
+    def _delete_keypair(self, keypair):
+        self.ec2.euca.delete_key_pair(keypair)
+        if os.path.isfile('%s.priv' % keypair):
+            os.unlink('%s.priv' % keypair)
+
+    def _delete_volume(self, orphan):
+        volume = get_status_poller().lookup('volume', orphan.id)
+        if volume.attach_data and volume.attach_data.instance_id:
+            self.ec2.euca.detach_volume(orphan.id,
+                                        volume.attach_data.instance_id, True)
+            wait_for('volume.detach', orphan.id,
+                     lambda: get_status_poller().lookup(
+                                'volume', orphan.id).status.split()[0],
+                     lambda status: status != "in-use")
+        self.ec2.euca.delete_volume(orphan.id)
+        self.ledger.forget(orphan.kind, orphan.id)
+
+    def _delete_snapshot(self, orphan):
+        self.ec2.euca.delete_snapshot(orphan.id)
+        self.ledger.forget(orphan.kind, orphan.id)
+
+    def find(self, everything=False, older_than=0, dry_run=False):
+        """
+        Find the leftover resources. Returns the list of them and a
+        dictionary mapping each to the ones that must be deleted after it.
+
+        Resources in the ledger that no longer exist are removed from it,
+        unless dry_run is True.
+        """
+        now = time.time()
+        entries = [e for e in self.ledger.outstanding() if
+                   now - e['time'] >= older_than and
+                   (everything or _process_gone(e))]
+        wanted = dict(((e['kind'], e['id']), e) for e in entries)
+
+        instances = dict((i.id, i) for r in self.ec2.euca.get_all_instances()
+                         for i in r.instances if i.state != 'terminated')
+        volumes = dict((v.id, v) for v in self.ec2.euca.get_all_volumes())
+        snapshots = dict((s.id, s) for s in
+                         self.ec2.euca.get_all_snapshots())
+
+        # Forget the resources that have gone away by themselves
+        existing = {'instance': instances, 'volume': volumes,
+                    'snapshot': snapshots}
+        for kind, resource_id in wanted.keys():
+            if resource_id not in existing.get(kind, {}):
+                if not dry_run:
+                    self.ledger.forget(kind, resource_id)
+                del wanted[(kind, resource_id)]
+
+        if everything:
+            for instance in instances.values():
+                if instance.key_name and \
+                        instance.key_name.startswith(KEYPAIR_PREFIX):
+                    wanted.setdefault(('instance', instance.id),
+                                      {'keypair': instance.key_name})
+
+        orphans = {}
+        for (kind, resource_id), entry in wanted.items():
+            delete = {'instance': self._delete_instance,
+                      'volume': self._delete_volume,
+                      'snapshot': self._delete_snapshot}[kind]
+            orphans[(kind, resource_id)] = Orphan(kind, resource_id, delete,
+                                                  entry.get('keypair'))
+
+        # Snapshots are deleted before the volumes they were taken of,
+        # volumes before the snapshots they were created from, and volumes
+        # are detached before the instances they are attached to go.
+        dependencies = {}
+        for (kind, resource_id), orphan in orphans.items():
+            if kind == 'volume':
+                volume = volumes[resource_id]
+                needs = [('snapshot', volume.snapshot_id)]
+                if volume.attach_data:
+                    needs.append(('instance',
+                                  volume.attach_data.instance_id))
+            elif kind == 'snapshot':
+                needs = [('volume', snapshots[resource_id].volume_id)]
+            else:
+                needs = []
+            dependencies[orphan] = set(orphans[n] for n in needs
+                                       if n in orphans)
+        return orphans.values(), dependencies
+
+    def find_keypairs(self):
+        """
+        Find testsuite_ keypairs that no instance is using.
+        """
+        in_use = set(i.key_name for r in self.ec2.euca.get_all_instances()
+                     for i in r.instances if i.state != 'terminated')
+        return [k.name for k in self.ec2.euca.get_all_key_pairs() if
+                k.name.startswith(KEYPAIR_PREFIX) and k.name not in in_use]
+
+
+def main(argv=None):
+    """
+    Entry point for the nova-volume-sweep command.
+    """
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+                      help="List the leftover resources without deleting "
+                           "them")
+    parser.add_option('-a', '--all', action='store_true', default=False,
+                      help="Delete every resource in the ledger, and every "
+                           "testsuite_ instance and keypair, even if the "
+                           "test that made them may still be running")
+    parser.add_option('-o', '--older-than', type='int', default=0,
+                      help="Only delete resources created at least this "
+                           "many seconds ago")
+    parser.add_option('-l', '--ledger',
+                      default=os.environ.get('NOVA_VOLUME_TEST_LEDGER',
+                                             DEFAULT_LEDGER),
+                      help="Ledger of the resources tests have created")
+    options, args = parser.parse_args(argv)
+
+    sweeper = Sweeper(Ledger(os.path.expanduser(options.ledger)))
+    orphans, dependencies = sweeper.find(options.all, options.older_than,
+                                         options.dry_run)
+    keypairs = []
+    if options.all:
+        keypairs = sweeper.find_keypairs()
+
+    for orphan in orphans:
+        print "Found leftover %s %s" % (orphan.kind, orphan.id)
+    for keypair in keypairs:
+        print "Found leftover keypair %s" % keypair
+    if options.dry_run:
+        return 0
+
+    errors = teardown(orphans, dependencies)
+    for keypair in keypairs:
+        try:
+            sweeper._delete_keypair(keypair)
+        except Exception as e:
+            errors.append((Orphan('keypair', keypair, None), str(e)))
+
+    # Private keys whose keypair no longer exists are of no use to anyone
+    existing = set(k.name for k in sweeper.ec2.euca.get_all_key_pairs())
+    for keyfile in glob.glob('%s*.priv' % KEYPAIR_PREFIX):
+        if keyfile[:-len('.priv')] not in existing:
+            print "Removing %s" % keyfile
+            os.unlink(keyfile)
+
+    for orphan, error in errors:
+        print "Failed to delete %s %s: %s" % (orphan.kind, orphan.id, error)
+    print "Deleted %d of %d leftover resources" % \
+            (len(orphans) + len(keypairs) - len(errors),
+             len(orphans) + len(keypairs))
+    if errors:
+        return 1
+    return 0
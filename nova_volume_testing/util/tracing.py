@@ -0,0 +1,213 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Trace the cloud API calls, ssh commands and waits a test makes.
+
+Each traced operation becomes a span recording the operation, the resource
+it acted on, when it started, how long it took, how many times it was
+retried and whether it succeeded. When NOVA_VOLUME_TEST_TRACE_FILE is set
+spans are appended to that file, one JSON object per line, by every process
+that inherits it, so concurrent scenarios can share one trace file.
+
+A trace file can be converted to the Chrome trace event format, which
+chrome://tracing and Perfetto show as a timeline with a row per thread:
+
+    python -m nova_volume_testing.util.tracing trace.jsonl trace.json
+
+nova-volume-test does this itself when given --chrome-trace.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+
+
+TRACE_FILE_ENV = 'NOVA_VOLUME_TEST_TRACE_FILE'
+
+
+class Span(object):
+    """
+    A single traced operation. Code running inside the span can count its
+    retries and add attributes to it.
+    """
+    def __init__(self, operation, resource_id, attributes):
+        self.operation = operation
+        self.resource_id = resource_id
+        self.attributes = attributes
+        self.retries = 0
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer(object):
+    """
+    Writes spans to a JSON lines file, or discards them if path is None.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.process = os.path.basename(sys.argv[0]) if sys.argv else ''
+        directory = os.path.dirname(path or '')
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def _write(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            if self._fd == None:
+                self._fd = open(self.path, 'a')
+            # Other processes append to the same file
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._fd.write(line)
+                self._fd.flush()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def span(self, operation, resource_id=None, **attributes):
+        """
+        Trace the code in a with block as operation acting on resource_id.
+        The block is given the Span. Exceptions are recorded in the span's
+        outcome and passed on.
+        """
+        span = Span(operation, resource_id, attributes)
+        if self.path == None:
+            yield span
+            return
+
+        start = time.time()
+        outcome = 'ok'
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            outcome = 'error'
+            error = "%s: %s" % (type(e).__name__, e)
+            raise
+        finally:
+            thread = threading.current_thread()
+            entry = dict(span.attributes,
+                         operation=operation,
+                         resource=resource_id,
+                         start=start,
+                         duration=time.time() - start,
+                         retries=span.retries,
+                         outcome=outcome,
+                         pid=os.getpid(),
+                         process=self.process,
+                         thread=thread.ident,
+                         thread_name=thread.name)
+            if error != None:
+                entry['error'] = error
+            self._write(entry)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """
+    Get the Tracer for this process, which writes to the file named by
+    NOVA_VOLUME_TEST_TRACE_FILE, if that is set.
+    """
+    global _tracer
+    with _tracer_lock:
+        if _tracer == None:
+            path = os.environ.get(TRACE_FILE_ENV)
+            _tracer = Tracer(os.path.expanduser(path) if path else None)
+        return _tracer
+
+
+def read_spans(path):
+    """
+    Read the spans in a trace file, skipping any line left incomplete by a
+    process that was killed while writing it.
+    """
+    spans = []
+    with open(path) as fd:
+        for line in fd:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                pass
+    return spans
+
+
+def write_chrome_trace(spans, path):
+    """
+    Save spans in the Chrome trace event format.
+    """
+    events = []
+    processes = {}
+    threads = {}
+    for span in spans:
+        processes[span['pid']] = span.get('process', '')
+        threads[(span['pid'], span['thread'])] = span.get('thread_name', '')
+        args = dict((key, value) for key, value in span.items()
+                    if key not in ('operation', 'start', 'duration', 'pid',
+                                   'process', 'thread', 'thread_name'))
+        name = span['operation']
+        if span.get('resource'):
+            name = "%s %s" % (name, span['resource'])
+        events.append({'name': name,
+                       'cat': span['operation'].split('.')[0],
+                       'ph': 'X',
+                       'ts': span['start'] * 1000000,
+                       'dur': span['duration'] * 1000000,
+                       'pid': span['pid'],
+                       'tid': span['thread'],
+                       'args': args})
+    for pid, name in processes.items():
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': "%s (%d)" % (name, pid)}})
+    for (pid, tid), name in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': name}})
+    with open(path, 'w') as fd:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fd)
+
+
+def main(argv=None):
+    """
+    Convert a trace file to the Chrome trace event format.
+    """
+    if argv == None:
+        argv = sys.argv[1:]
+    if len(argv) != 2:
+        print "usage: %s TRACE_FILE CHROME_TRACE_FILE" % sys.argv[0]
+        return 2
+    spans = read_spans(argv[0])
+    write_chrome_trace(spans, argv[1])
+    print "Wrote %d spans to %s" % (len(spans), argv[1])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A pool of volumes created ahead of time and shared between scenarios.
+
+The pool keeps a number of volumes of each of a few sizes ready, creating
+more in the background as they are taken. Like the instance pool, each
+ready volume is a file in a free directory, here one per size, and a
+scenario takes a volume by atomically renaming its file into the busy
+directory.
+
+A volume given back to the pool goes back into the free directory, with a
+record of the test patterns written to it so that the next scenario to use
+it knows what it holds, unless it was wiped first.
+
+Scenarios use get_volume() and release_volume(). When the environment
+variable NOVA_VOLUME_TEST_VOLUME_POOL_DIR is not set these simply create and
+delete a fresh volume.
+"""
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from extents import ExtentMap
+from instance_pool import _pool_dirs, _take_lease, _return_lease
+from latency import summarise
+from novaexerciser import Volume, get_connection, get_status_poller
+from registry import get_registry
+from waiter import wait_for
+
+
+VOLUME_POOL_DIR_ENV = 'NOVA_VOLUME_TEST_VOLUME_POOL_DIR'
+
+
+def parse_sizes(spec):
+    """
+    Parse a pool specification such as "1:4,10:2", meaning keep four 1GB
+    volumes and two 10GB volumes ready, into a dictionary mapping size to
+    count.
+    """
+    sizes = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        size, count = part.split(':')
+        sizes[int(size)] = int(count)
+    return sizes
+
+
+def _size_dir(pool_dir, size):
+    return os.path.join(pool_dir, str(size))
+
+
+class VolumePool(object):
+    """
+    Volumes created ahead of time and handed out to scenarios.
+    """
+    def __init__(self, sizes, pool_dir=None, workers=4, interval=1):
+        """
+        Create an empty pool that will keep sizes[size] volumes of each size
+        ready, creating up to workers volumes at a time and checking every
+        interval seconds whether more are needed. No volumes are created
+        until start() is called.
+        """
+        self.sizes = sizes
+        if pool_dir == None:
+            pool_dir = tempfile.mkdtemp(prefix='nova-volume-vpool-')
+        self.pool_dir = pool_dir
+        self.interval = interval
+        self.volumes = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._creating = dict((size, 0) for size in sizes)
+        self._workers = ThreadPool(workers)
+        self._thread = None
+        # Creation times of the volumes the pool has made, by size
+        self.create_times = dict((size, []) for size in sizes)
+        # Seconds during which at least one volume of each size was being
+        # created, not counting the current stretch, which began at
+        # _busy_since
+        self._busy = dict((size, 0.0) for size in sizes)
+        self._busy_since = {}
+        self._in_flight = dict((size, 0) for size in sizes)
+        for size in sizes:
+            for d in _pool_dirs(_size_dir(self.pool_dir, size)):
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+
+    def _free(self, size):
+        free_dir, busy_dir = _pool_dirs(_size_dir(self.pool_dir, size))
+        return len(os.listdir(free_dir))
+
+    def _create(self, size):
+        start = time.time()
+        with self._lock:
+            if not self._in_flight[size]:
+                self._busy_since[size] = start
+            self._in_flight[size] += 1
+        try:
+            volume = Volume(size=size)
+        except Exception as e:
+            print "Volume pool failed to create a %dGB volume: %s" % (size, e)
+            return
+        finally:
+            with self._lock:
+                self._creating[size] -= 1
+                self._in_flight[size] -= 1
+                if not self._in_flight[size]:
+                    self._busy[size] += time.time() - \
+                                        self._busy_since.pop(size)
+
+        with self._lock:
+            self.volumes[volume.id] = volume
+            self.create_times[size].append(time.time() - start)
+        free_dir, busy_dir = _pool_dirs(_size_dir(self.pool_dir, size))
+        with open(os.path.join(free_dir, volume.id), 'w') as fd:
+            json.dump({'written': [], 'confirmed': []}, fd)
+
+    def _refill(self):
+        """
+        Start creating volumes for the sizes that have fewer ready, or
+        being created, than the pool should hold.
+        """
+        for size, count in self.sizes.items():
+            with self._lock:
+                missing = count - self._free(size) - self._creating[size]
+                if missing <= 0:
+                    continue
+                self._creating[size] += missing
+            for i in xrange(missing):
+                self._workers.apply_async(self._create, (size,))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._refill()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Start filling the pool in the background.
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        print "Volume pool %s filling with %s" % \
+                (self.pool_dir,
+                 ", ".join("%d %dGB volumes" % (count, size)
+                           for size, count in sorted(self.sizes.items())))
+
+    def report(self):
+        """
+        Describe how quickly the backend created volumes for the pool. The
+        throughput is over the time creates were in flight, as the pool
+        spends much of its time full and waiting for volumes to be taken.
+        """
+        lines = []
+        for size in sorted(self.sizes):
+            times = self.create_times[size]
+            if not times:
+                continue
+            with self._lock:
+                busy = self._busy[size]
+                if size in self._busy_since:
+                    busy += time.time() - self._busy_since[size]
+            summary = summarise(times)
+            lines.append("%dGB: created %d volumes, mean %.1fs, p90 %.1fs, "
+                         "%.2f GB/min" %
+                         (size, summary['count'], summary['mean'],
+                          summary['p90'],
+                          size * len(times) * 60 / max(busy, 1e-6)))
+        return "\n".join(lines)
+
+    def _detach(self, volume):
+        """
+        Detach a volume from whatever instance a scenario left it attached
+        to.
+        """
+        described = get_status_poller().lookup('volume', volume.id)
+        if not (described.attach_data and described.attach_data.instance_id):
+            return
+        volume.ec2.euca.detach_volume(volume.id,
+                                      described.attach_data.instance_id, True)
+        wait_for('volume.detach', volume.id, volume.status,
+                 lambda status: status != "in-use")
+
+    def shutdown(self):
+        """
+        Stop filling the pool and delete every volume in it, including any
+        still handed out.
+        """
+        self._stop.set()
+        if self._thread != None:
+            self._thread.join()
+        self._workers.close()
+        self._workers.join()
+
+        existing = set(v.id for v in get_connection().euca.get_all_volumes())
+        for size in self.sizes:
+            for d in _pool_dirs(_size_dir(self.pool_dir, size)):
+                for volume_id in os.listdir(d):
+                    if volume_id not in existing:
+                        continue
+                    volume = self.volumes.pop(volume_id)
+                    try:
+                        self._detach(volume)
+                        volume.delete()
+                    except Exception as e:
+                        print "Failed to delete pooled volume %s: %s" % \
+                                (volume_id, e)
+        # The rest were deleted by the scenarios that took them
+        for volume in self.volumes.values():
+            get_registry().unregister(volume)
+        self.volumes = {}
+
+        report = self.report()
+        if report:
+            print "Volume pool create throughput:"
+            print report
+        shutil.rmtree(self.pool_dir, ignore_errors=True)
+
+
+def get_volume(size):
+    """
+    Get a volume of the given size for a scenario to use. If a pool is
+    available and has a volume of that size ready take it, otherwise create
+    a new, empty, volume. A pooled volume may still hold what an earlier
+    scenario wrote to it, unless that scenario wiped it, and its written and
+    confirmed maps say what that is.
+    """
+    pool_dir = os.environ.get(VOLUME_POOL_DIR_ENV)
+    size_dir = _size_dir(pool_dir or '', size)
+    if pool_dir and os.path.isdir(size_dir):
+        lease = _take_lease(size_dir)
+        if lease != None:
+            volume_id, contents = lease
+            print "Using pooled volume %s" % volume_id
+            volume = Volume(volume_id=volume_id)
+            contents = json.loads(contents)
+            volume.written = ExtentMap(contents['written'])
+            volume.confirmed = ExtentMap(contents['confirmed'])
+            volume.pooled_size = size
+            return volume
+        print "No pooled %dGB volume ready, creating a new one" % size
+    return Volume(size=size)
+
+
+def release_volume(volume, wipe=False):
+    """
+    Finish with a volume returned by get_volume(). Pooled volumes are
+    detached and returned to the pool, after being wiped if wipe is True,
+    which needs the volume to be attached. Other volumes are deleted.
+    """
+    pool_dir = os.environ.get(VOLUME_POOL_DIR_ENV)
+    size = getattr(volume, 'pooled_size', None)
+    if not (pool_dir and size != None):
+        volume.delete()
+        return
+
+    size_dir = _size_dir(pool_dir, size)
+    # If this fails the volume is left marked as busy, and the pool deletes
+    # it when it shuts down
+    if wipe:
+        volume.wipe()
+    if volume.attached():
+        volume.detach()
+
+    free_dir, busy_dir = _pool_dirs(size_dir)
+    with open(os.path.join(busy_dir, volume.id), 'w') as fd:
+        json.dump({'written': volume.written.extents,
+                   'confirmed': volume.confirmed.extents}, fd)
+    _return_lease(size_dir, volume.id)
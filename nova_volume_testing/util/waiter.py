@@ -0,0 +1,151 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Wait for resources to move through their lifecycle.
+
+Every wait has a deadline, polls quickly at first and then backs off, and
+fails as soon as the resource reaches an error state. The time every
+successful wait took is recorded in the latencies recorder, by operation, so
+that transition latency percentiles can be reported.
+
+Deadlines can be set for each operation with an environment variable named
+after it, e.g. NOVA_VOLUME_TEST_TIMEOUT_VOLUME_CREATE for 'volume.create',
+or for every operation with NOVA_VOLUME_TEST_TIMEOUT.
+"""
+import atexit
+import os
+import time
+from latency import LatencyRecorder
+from tracing import get_tracer
+
+
+# Default deadlines, in seconds, for each operation
+DEFAULT_TIMEOUTS = {
+    'instance.start': 600,
+    'pool.reset_detach': 300,
+    'volume.create': 1800,
+    'volume.attach': 300,
+    'volume.guest_attach': 300,
+    'volume.guest_detach': 300,
+    'volume.detach': 300,
+    'snapshot.create': 1800,
+}
+
+FALLBACK_TIMEOUT = 600
+
+ERROR_STATES = ('error', 'error_deleting')
+
+latencies = LatencyRecorder()
+
+
+class WaitTimeout(Exception):
+    """
+    A resource did not reach the state being waited for before the deadline.
+    """
+    pass
+
+
+class WaitError(Exception):
+    """
+    A resource went into an error state while being waited on.
+    """
+    pass
+
+
+def operation_timeout(operation):
+    """
+    Return the deadline, in seconds, for the named operation.
+    """
+    env_name = 'NOVA_VOLUME_TEST_TIMEOUT_' + \
+                    operation.upper().replace('.', '_')
+    if env_name in os.environ:
+        return float(os.environ[env_name])
+    if 'NOVA_VOLUME_TEST_TIMEOUT' in os.environ:
+        return float(os.environ['NOVA_VOLUME_TEST_TIMEOUT'])
+    return DEFAULT_TIMEOUTS.get(operation, FALLBACK_TIMEOUT)
+
+
+def wait_for(operation, resource_id, get_status, done,
+             error_states=ERROR_STATES, timeout=None, initial_interval=0.25,
+             max_interval=5.0, backoff=1.5):
+    """
+    Call get_status() until done() returns True for the status it returns,
+    and return that status.
+
+    The first check is made straight away, then the interval between checks
+    starts at initial_interval seconds and grows by a factor of backoff up to
+    max_interval. Raises WaitError if the status is one of error_states and
+    WaitTimeout if the wait takes longer than timeout seconds, which
+    defaults to the deadline for the operation.
+    """
+    if timeout == None:
+        timeout = operation_timeout(operation)
+
+    start = time.time()
+    interval = initial_interval
+    with get_tracer().span('wait.%s' % operation, resource_id) as span:
+        while True:
+            status = get_status()
+            span.set(status=status)
+            if status in error_states:
+                raise WaitError("%s of %s failed, status is %s" %
+                                (operation, resource_id, status))
+            if done(status):
+                break
+            elapsed = time.time() - start
+            if elapsed >= timeout:
+                raise WaitTimeout("%s of %s timed out after %ds, status is "
+                                  "%s" % (operation, resource_id, elapsed,
+                                          status))
+            time.sleep(min(interval, timeout - elapsed))
+            interval = min(interval * backoff, max_interval)
+            span.retries += 1
+
+    latencies.record(operation, time.time() - start)
+    return status
+
+
+_exit_report = True
+
+
+def set_exit_report(enabled):
+    """
+    Choose whether the transition latencies are reported when the process
+    exits. The runner turns this off, as it reports its own latencies along
+    with those of the scenarios.
+    """
+    global _exit_report
+    _exit_report = enabled
+
+
+def _report_latencies():
+    """
+    Print the transition latencies seen by this process, and save them to
+    NOVA_VOLUME_TEST_LATENCY_FILE if that is set so that the runner can
+    combine the latencies from every scenario.
+    """
+    if not (_exit_report and latencies.samples):
+        return
+    print "Transition latencies:"
+    print latencies.report()
+    latency_file = os.environ.get('NOVA_VOLUME_TEST_LATENCY_FILE')
+    if latency_file:
+        latencies.dump(latency_file)
+
+
+atexit.register(_report_latencies)
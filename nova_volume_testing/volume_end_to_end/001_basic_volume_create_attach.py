@@ -18,15 +18,17 @@
 """
 Script to test basic volume creation, mounting and deletion.
 """
-from nova_volume_testing.util.novaexerciser import Volume, Instance
+from nova_volume_testing.util.instance_pool import get_instance, \
+                                                   release_instance
+from nova_volume_testing.util.volume_pool import get_volume, release_volume
 
 if __name__ == "__main__":
     print "001 basic volume create attach - Create a volume, attach it to an "\
           "instance, write to it, dettach it and attach it to a different"\
           "instance, check the data"
-    instance1 = Instance()
-    instance2 = Instance()
-    volume = Volume(size=1)
+    instance1 = get_instance()
+    instance2 = get_instance()
+    volume = get_volume(size=1)
 
     assert volume.attached() == False
 
@@ -50,6 +52,6 @@ if __name__ == "__main__":
     volume.detach()
     assert volume.attached() == False
 
-    volume.delete()
-    instance1.delete()
-    instance2.delete()
+    release_volume(volume)
+    release_instance(instance1)
+    release_instance(instance2)
@@ -18,14 +18,17 @@
 """
 Script to test basic snapshot creation mounting and deletion.
 """
-from nova_volume_testing.util.novaexerciser import Volume, Instance, Snapshot
+from nova_volume_testing.util.novaexerciser import Volume, Snapshot
+from nova_volume_testing.util.instance_pool import get_instance, \
+                                                   release_instance
+from nova_volume_testing.util.volume_pool import get_volume, release_volume
 
 if __name__ == "__main__":
     print "002 basic snapshot - Create a volume, write to it, snapshot it, "\
           "create a volume from the snapshot, change original, check "\
           "snapshot, change snapshot, check original"
-    instance = Instance()
-    volume = Volume(size=1)
+    instance = get_instance()
+    volume = get_volume(size=1)
 
     assert volume.attached() == False
 
@@ -54,15 +57,15 @@ if __name__ == "__main__":
     assert volume.check_test_pattern(key=1) == True
 
     volume.write_test_pattern(key=3, percentage=10)
-    assert volume.check_test_pattern(key=3, percentage=10) == True
-    assert snapvol.check_test_pattern(key=2, percentage=10) == True
+    assert all(instance.check_test_patterns([(volume, 3, 10, True),
+                                             (snapvol, 2, 10, True)]))
 
     snapvol2 = Volume(snapshot=snapshot)
     snapvol2.attach(instance)
 
-    assert snapvol2.check_test_pattern(key=1) == True
-    assert snapvol.check_test_pattern(key=2, percentage=10) == True
-    assert volume.check_test_pattern(key=3, percentage=10) == True
+    assert all(instance.check_test_patterns([(snapvol2, 1, 0, True),
+                                             (snapvol, 2, 10, True),
+                                             (volume, 3, 10, True)]))
 
     volume.detach()
     snapvol.detach()
@@ -71,5 +74,5 @@ if __name__ == "__main__":
     snapvol.delete()
     snapvol2.delete()
     snapshot.delete()
-    volume.delete()
-    instance.delete()
+    release_volume(volume)
+    release_instance(instance)
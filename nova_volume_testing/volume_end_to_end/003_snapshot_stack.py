@@ -18,14 +18,17 @@
 """
 Script to test creation of a stack of volumes 2 voumes deep.
 """
-from nova_volume_testing.util.novaexerciser import Volume, Instance, Snapshot
+from nova_volume_testing.util.novaexerciser import Volume, Snapshot
+from nova_volume_testing.util.instance_pool import get_instance, \
+                                                   release_instance
+from nova_volume_testing.util.volume_pool import get_volume, release_volume
 
 if __name__ == "__main__":
     print "003 snapshot stack - create snapshots of volumes that were created "\
           "from snapshots, check all volumes can be changed without "\
           "corrupting other volumes"
-    instance = Instance()
-    volume = Volume(size=1)
+    instance = get_instance()
+    volume = get_volume(size=1)
     assert volume.attached() == False
 
     volume.attach(instance)
@@ -46,8 +49,8 @@ if __name__ == "__main__":
     volume.attach(instance)
     assert volume.check_test_pattern(key=1) == True
     volume.write_test_pattern(key=3)
-    assert volume.check_test_pattern(key=3) == True
-    assert snapvol.check_test_pattern(key=2) == True
+    assert all(instance.check_test_patterns([(volume, 3, 0, True),
+                                             (snapvol, 2, 0, True)]))
     snapvol.detach()
     assert snapvol.attached() == False
 
@@ -59,8 +62,13 @@ if __name__ == "__main__":
     assert snapvol2.check_test_pattern(key=4) == True
     snapvol.attach(instance)
     assert snapvol.attached() == True
-    assert snapvol.check_test_pattern(key=2) == True
-    assert volume.check_test_pattern(key=3) == True
+    # One read of each volume, checked against what was written to it on
+    # this side, and against each other as no two hold the same pattern
+    manifests = [(v, v.manifest()) for v in (volume, snapvol, snapvol2)]
+    for v, manifest in manifests:
+        assert v.verify_manifest(manifest) == True
+    assert manifests[0][1].diff(manifests[1][1]) != []
+    assert manifests[1][1].diff(manifests[2][1]) != []
 
     volume.detach()
     assert volume.attached() == False
@@ -73,5 +81,5 @@ if __name__ == "__main__":
     snapshot2.delete()
     snapvol.delete()
     snapshot.delete()
-    volume.delete()
-    instance.delete()
+    release_volume(volume)
+    release_instance(instance)
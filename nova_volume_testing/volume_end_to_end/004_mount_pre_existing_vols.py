@@ -19,7 +19,11 @@
 Script to test basic volume creation, mounting and deletion.
 """
 import os
-from nova_volume_testing.util.novaexerciser import Volume, Instance
+from nova_volume_testing.util.novaexerciser import Volume, \
+                                                   attach_volumes, \
+                                                   detach_volumes
+from nova_volume_testing.util.instance_pool import get_instance, \
+                                                   release_instance
 
 if __name__ == "__main__":
     print "004 Test pre-existing volumes - Make sure volumes from before the "\
@@ -34,15 +38,24 @@ if __name__ == "__main__":
         if len(volumes) > 0:
             print 'Testing %s volumes' % len(volumes)
 
-            instance = Instance()
-            for volume in volumes:
-                assert volume.attached() == False
-                volume.attach(instance)
-                assert volume.attached(instance) == True
-                assert volume.check_mount_device() == True
-                volume.detach()
-                assert volume.attached() == False
-            instance.delete()
+            #
+            # Attach the volumes to the instance in batches, the volumes in
+            # each batch being attached and detached at the same time.
+            batch_size = int(os.environ.get('NOVA_VOLUME_TEST_ATTACH_BATCH',
+                                            8))
+            instance = get_instance()
+            for first in xrange(0, len(volumes), batch_size):
+                batch = volumes[first:first + batch_size]
+                for volume in batch:
+                    assert volume.attached() == False
+                attach_volumes(batch, instance)
+                for volume in batch:
+                    assert volume.attached(instance) == True
+                    assert volume.check_mount_device() == True
+                detach_volumes(batch)
+                for volume in batch:
+                    assert volume.attached() == False
+            release_instance(instance)
         else:
             print "There are no volumes listed in %s" % \
                                             os.environ['BOCK_TEST_VOLUMES']
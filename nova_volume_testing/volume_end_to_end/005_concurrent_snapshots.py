@@ -0,0 +1,53 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Script to test taking several snapshots of a volume at the same time.
+"""
+from nova_volume_testing.util.async_ops import start_instance, release, \
+                                               create_volume, \
+                                               create_snapshot, attach, \
+                                               detach, write_test_pattern, \
+                                               delete, gather
+
+if __name__ == "__main__":
+    print "005 concurrent snapshots - Create a volume while the instance "\
+          "boots, write to it, take several snapshots of it at once, "\
+          "create volumes from them all at once and check them"
+    #
+    # Each step starts as soon as the steps it depends on have finished, so
+    # the volume is created while the instance boots, and the snapshots and
+    # the volumes made from them are created at the same time as each other.
+    instance = start_instance()
+    volume = create_volume(size=1)
+    written = write_test_pattern(attach(volume, instance), key=1)
+    detached = detach(written)
+
+    snapshots = [create_snapshot(detached) for i in range(3)]
+    snapvols = [attach(create_volume(snapshot=snapshot), instance)
+                for snapshot in snapshots]
+
+    instance = instance.result()
+    snapvols = gather(snapvols)
+    assert all(instance.check_test_patterns([(snapvol, 1, 0, True)
+                                             for snapvol in snapvols]))
+
+    gather([detach(snapvol) for snapvol in snapvols])
+    gather([delete(snapvol) for snapvol in snapvols])
+    gather([delete(snapshot) for snapshot in snapshots])
+    delete(volume).result()
+    release(instance).result()
@@ -0,0 +1,34 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2011 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Script to test a chain of snapshots and clones NOVA_VOLUME_TEST_CHAIN_DEPTH
+levels deep, 3 by default, reporting how performance changes with depth.
+"""
+import os
+from nova_volume_testing.benchmarks.snapshot_chain import SnapshotChain
+
+if __name__ == "__main__":
+    print "006 snapshot chain - clone snapshots of clones to a given depth, "\
+          "check every level keeps its own pattern and measure performance "\
+          "at each depth"
+    depth = int(os.environ.get('NOVA_VOLUME_TEST_CHAIN_DEPTH', 3))
+    chain = SnapshotChain(depth)
+    chain.run()
+    print chain.format_levels()
+    assert len(chain.levels) == depth + 1
+    assert all(level['verified'] for level in chain.levels)
@@ -24,7 +24,11 @@ setup(name="nova_volume_testing",
       platforms="Linux",
       packages=['nova_volume_testing',
                 'nova_volume_testing.volume_end_to_end',
-                'nova_volume_testing.util'],
-      scripts=['bin/nova-volume-test']
+                'nova_volume_testing.util',
+                'nova_volume_testing.guest',
+                'nova_volume_testing.benchmarks'],
+      scripts=['bin/nova-volume-test',
+               'bin/nova-volume-sweep',
+               'bin/nova-volume-bench']
 )
 